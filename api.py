@@ -5,56 +5,303 @@ import hashlib
 import datetime
 import json
 import logging
+import math
+import queue
+import re
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from functools import partial
 from optparse import OptionParser
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 
-from thetypes import (ClientsInterestsRequest, FieldError, OnlineScoreRequest,
+from memprof import MemoryProfiler
+from supervisor import (Supervisor, ThreadedHTTPServer, UnixHTTPServer,
+                        run_worker)
+from traffic import TrafficCapture
+from hotkeys import HotKeys
+from sharedcache import SharedCache, instance_path
+from jsonstream import loads_request
+
+from thetypes import (ClientIDStream, ClientsInterestsRequest, FieldError,
+                      OnlineScoreRequest, OnlineScoreBatchRequest,
                       MethodRequest)
-from database import RedisStore
-from scoring import get_interests, get_score
-from const import (ADMIN_SALT, SALT, INVALID_REQUEST, OK, FORBIDDEN,
-                   NOT_FOUND, BAD_REQUEST, INTERNAL_ERROR, ERRORS)
+from database import (Deadline, DeadlineExceeded, StoreUnavailable,
+                      store_from_url)
+from scoring import (ProcessPoolEngine, RulesEngine, get_interests,
+                     get_interests_many, get_score, get_scores, set_engine)
+from const import (ADMIN_LOGIN, ADMIN_SALT, SALT, INVALID_REQUEST, OK,
+                   FORBIDDEN, NOT_FOUND, BAD_REQUEST, INTERNAL_ERROR,
+                   SERVICE_UNAVAILABLE, GATEWAY_TIMEOUT, ERRORS,
+                   TOO_MANY_REQUESTS, DEFAULT_TIMEOUT, LENGTH_REQUIRED,
+                   REQUEST_ENTITY_TOO_LARGE, DEFAULT_MAX_BODY_SIZE,
+                   DEFAULT_METHOD_MAX_BODY_SIZE, MAX_BODY_SIZES,
+                   SCORE_TTL_JITTER, SCORE_STALE_TTL,
+                   ANSWER_CACHE_TTL, STREAM_MIN_BODY, INTERESTS_BATCH_SIZE,
+                   SHARED_CACHE_DIR)
 
 
-def check_auth(request) -> bool:
-    if request.is_admin:
-        digest = hashlib.sha512(
+def get_token(account: str or None, login: str,
+              is_admin: bool = False) -> str:
+    if is_admin:
+        return hashlib.sha512(
                 (
                     datetime.datetime.now().strftime("%Y%m%d%H")
                     + ADMIN_SALT
                 ).encode('utf-8')
             ).hexdigest()
-    else:
-        digest = hashlib.sha512(
-                (
-                    request.account
-                    + request.login
-                    + SALT
-                ).encode('utf-8')
-            ).hexdigest()
+    return hashlib.sha512(
+            (
+                account
+                + login
+                + SALT
+            ).encode('utf-8')
+        ).hexdigest()
+
+
+def has_valid_token(body: dict) -> bool:
+    """
+    check_auth for a raw request body, without validating it.
+    """
+    account, login = body.get('account'), body.get('login')
+    if not isinstance(account, str) or not isinstance(login, str):
+        return False
+    token = get_token(account, login, login == ADMIN_LOGIN)
+    return token == body.get('token')
+
+
+def check_auth(request) -> bool:
+    digest = get_token(request.account, request.login, request.is_admin)
     if digest == request.token:
         return True
     return False
 
 
-def online_score_handler(args: dict, ctx: dict, store,
+class ResponseCache:
+    """
+    In-process LRU cache of method responses with a TTL per entry.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class AnswerCache:
+    """
+    Serialized answers (bytes) of clients_interests requests, keyed by
+    interests_cache_key(). Entries live <ttl> seconds and are dropped
+    when one of the store keys they were built from changes (see
+    RedisStore.add_invalidation_listener). Least recently used entries
+    are evicted when the answers take over <max_bytes>.
+    """
+    # answers are built from interests keys only
+    PREFIX = 'i:'
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024,
+                 ttl: float = ANSWER_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # bumped by every interests key invalidation, see set()
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._by_store_key = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidated': 0}
+
+    def get(self, key: str) -> bytes or None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def set(self, key: str, data: bytes, store_keys: list,
+            generation: int):
+        """
+        Cache <data> built from <store_keys>, unless some store key
+        was invalidated since <generation> was read.
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, data,
+                                  store_keys)
+            self.size += len(data)
+            for store_key in store_keys:
+                self._by_store_key.setdefault(store_key, set()).add(key)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        _, data, store_keys = self._entries.pop(key)
+        self.size -= len(data)
+        for store_key in store_keys:
+            keys = self._by_store_key.get(store_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_store_key[store_key]
+
+    def invalidate(self, store_key: str):
+        if not store_key.startswith(self.PREFIX):
+            return
+        with self._lock:
+            self.generation += 1
+            for key in list(self._by_store_key.get(store_key, ())):
+                self._drop(key)
+                self.stats['invalidated'] += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._by_store_key.clear()
+            self.size = 0
+
+    def metrics(self) -> dict:
+        return dict(self.stats, entries=len(self._entries), size=self.size)
+
+
+def interests_cache_key(body: dict) -> str or None:
+    """
+    Canonical hash of a clients_interests request body: method, sorted
+    client ids and date. None if the body is not such a request.
+    """
+    if body.get('method') != 'clients_interests':
+        return None
+    args = body.get('arguments')
+    if not isinstance(args, dict) or set(args) - {'client_ids', 'date'}:
+        return None
+    client_ids, date = args.get('client_ids'), args.get('date')
+    if (not isinstance(client_ids, list)
+            or not all(type(cid) is int for cid in client_ids)
+            or not (date is None or isinstance(date, str))):
+        return None
+    canonical = json.dumps(['clients_interests', sorted(client_ids), date])
+    return hashlib.blake2b(canonical.encode('utf-8'),
+                           digest_size=16).hexdigest()
+
+
+class Method:
+    """
+    Registry entry of an API method.
+    * request_class validates method arguments;
+    * handler(request, ctx, store, is_admin) returns (response, code);
+    * max_concurrency limits parallel calls in a process (None - no
+    limit), a call waiting for a slot longer than its deadline is
+    rejected. Only reached when the server runs more threads (--threads);
+    * timeout is the default request deadline (seconds);
+    * cache_ttl > 0 caches OK responses for that many seconds;
+    * max_body_size is the request body limit (bytes), up to the
+    "method" route limit (MAX_BODY_SIZES) the body is read with.
+    """
+
+    def __init__(self, name: str, request_class, handler,
+                 max_concurrency: int or None = None,
+                 timeout: float = DEFAULT_TIMEOUT, cache_ttl: float = 0,
+                 max_body_size: int = DEFAULT_METHOD_MAX_BODY_SIZE):
+        self.name = name
+        self.request_class = request_class
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.max_body_size = max_body_size
+        self.slots = (threading.BoundedSemaphore(max_concurrency)
+                      if max_concurrency else None)
+        self.cache = ResponseCache() if cache_ttl > 0 else None
+
+    def __repr__(self):
+        return f'Method({self.name!r})'
+
+
+# dispatch table of API methods, filled by register_method()
+METHODS = {}
+
+
+def register_method(name: str, request_class, **policy):
+    """
+    Decorator adding a handler to METHODS. Usage:
+    >>> @register_method('online_score', OnlineScoreRequest, timeout=1.0)
+    ... def online_score_handler(request, ctx, store, is_admin=False):
+    ...     return {'score': 0}, OK
+    """
+    def decorator(handler):
+        METHODS[name] = Method(name, request_class, handler, **policy)
+        return handler
+    return decorator
+
+
+def get_deadline(headers, method: Method) -> Deadline:
+    """
+    Request deadline from X-Request-Timeout header (seconds)
+    or per-method default.
+    """
+    timeout = headers.get('X-Request-Timeout')
+    if timeout is None:
+        return Deadline(method.timeout)
+    timeout = float(timeout)
+    # nan would pass every budget check ('nan <= 0' is false)
+    if not math.isfinite(timeout) or timeout <= 0:
+        raise ValueError(f'Timeout should be positive, got {timeout}')
+    return Deadline(timeout)
+
+
+# at least one pair of non-null fields is needed for scoring
+SCORE_PAIRS = (
+    ('phone', 'email'),
+    ('first_name', 'last_name'),
+    ('gender', 'birthday'),
+)
+
+
+@register_method('online_score', OnlineScoreRequest, timeout=1.0)
+def online_score_handler(request: OnlineScoreRequest, ctx: dict, store,
                          is_admin=False) -> tuple:
-    try:
-        request = OnlineScoreRequest(args)
-    except FieldError as exc:
-        logging.debug('Invalid request. Exception: %s' % exc)
-        return str(exc), INVALID_REQUEST
     has = [
         name for name in request.fields
         if getattr(request, name) is not None
     ]
     ctx.update(has=has)
-    condition = any((
-            ('phone' in has) and ('email' in has),
-            ('first_name' in has) and ('last_name' in has),
-            ('gender' in has) and ('birthday' in has)
-        ))
+    condition = any(
+        (first in has) and (second in has) for first, second in SCORE_PAIRS
+    )
     if not condition:
         response = ('Please provide more client details in arg field')
         logging.debug('Insufficient online_score request: %s' % has)
@@ -66,27 +313,106 @@ def online_score_handler(args: dict, ctx: dict, store,
                first_name=request.first_name,
                last_name=request.last_name)
     logging.debug(f'Score requested with: {dct}')
-    score = get_score(store, **dct)
+    score = get_score(store, deadline=ctx.get('deadline'), **dct)
     score = score if not is_admin else 42
     response = dict(score=score)
     code = OK
     return response, code
 
 
-def clients_interests_handler(args: dict, ctx: dict, store,
-                              is_admin=False) -> tuple:
+@register_method('online_score_batch', OnlineScoreBatchRequest,
+                 max_concurrency=4, timeout=5.0,
+                 max_body_size=2 * 1024 * 1024)
+def online_score_batch_handler(request: OnlineScoreBatchRequest, ctx: dict,
+                               store, is_admin=False) -> tuple:
+    columns = request.columns()
+    nclients = len(request.clients)
+    ctx.update(nclients=nclients)
+    for i in range(nclients):
+        if not any(
+            columns[first][i] is not None and columns[second][i] is not None
+            for first, second in SCORE_PAIRS
+        ):
+            logging.debug('Insufficient online_score_batch client: %s' % i)
+            return (f'Please provide more details for client {i}',
+                    INVALID_REQUEST)
+    if is_admin:
+        scores = [42] * nclients
+    else:
+        scores = get_scores(store, columns, deadline=ctx.get('deadline'))
+    response = dict(scores=scores)
+    code = OK
+    return response, code
+
+
+@register_method('clients_interests', ClientsInterestsRequest, timeout=3.0)
+def clients_interests_handler(request: ClientsInterestsRequest, ctx: dict,
+                              store, is_admin=False) -> tuple:
+    deadline = ctx.get('deadline')
+    if isinstance(request.client_ids, ClientIDStream):
+        return stream_interests(request.client_ids, ctx, store)
+    nclients = len(request.client_ids)
+    ctx.update(nclients=nclients)
+    try:
+        response = {
+            id: get_interests(store, cid=id, deadline=deadline)
+            for id in request.client_ids
+        }
+    except StoreUnavailable as exc:
+        logging.error('Cannot get interests: %s' % exc)
+        return 'Interests storage is unavailable', SERVICE_UNAVAILABLE
+    code = OK
+    return response, code
+
+
+def stream_interests(client_ids: ClientIDStream, ctx: dict,
+                     store) -> tuple:
+    """
+    clients_interests over ids decoded from the request text: every
+    INTERESTS_BATCH_SIZE unique ids are read with one store call while
+    the rest of the array is still undecoded. A bad element raises
+    FieldError.
+    """
+    response = {}
     try:
-        request = ClientsInterestsRequest(args)
+        # ids already answered are skipped, no other set of ids is kept
+        for batch in client_ids.batches(INTERESTS_BATCH_SIZE,
+                                        known=response):
+            response.update(get_interests_many(
+                store, batch, deadline=ctx.get('deadline')
+            ))
+    except StoreUnavailable as exc:
+        logging.error('Cannot get interests: %s' % exc)
+        return 'Interests storage is unavailable', SERVICE_UNAVAILABLE
+    except ValueError as exc:
+        logging.debug('Malformed client_ids: %s' % exc)
+        return None, BAD_REQUEST
+    ctx.update(nclients=len(response), streamed=True)
+    return response, OK
+
+
+def call_method(method: Method, method_request: MethodRequest, ctx: dict,
+                store) -> tuple:
+    """
+    Validate arguments and run the method handler under
+    its response-cache policy.
+    """
+    args = method_request.arguments or {}
+    if method.cache is not None:
+        key = (json.dumps(args, sort_keys=True), method_request.is_admin)
+        cached = method.cache.get(key)
+        if cached is not None:
+            ctx.update(cached=True)
+            return cached
+    try:
+        request = method.request_class(args)
+        response, code = method.handler(request, ctx, store,
+                                        is_admin=method_request.is_admin)
     except FieldError as exc:
         logging.debug('Invalid request. Exception: %s' % exc)
         return str(exc), INVALID_REQUEST
-    nclients = len(request.client_ids)
-    ctx.update(nclients=nclients)
-    response = {
-        id: get_interests(store, cid=id)
-        for id in request.client_ids
-    }
-    code = OK
+    if method.cache is not None and code == OK:
+        method.cache.set(key, (response, code), method.cache_ttl)
     return response, code
 
 
@@ -103,63 +429,338 @@ def method_handler(request: dict, ctx: dict, store) -> tuple:
     if not check_auth(method_request):
         return 'Forbidden', FORBIDDEN
 
-    methods = {'online_score': online_score_handler,
-               'clients_interests': clients_interests_handler}
-    method = method_request.method
-    if method not in methods:
-        response = f'Invalid method name ({method}) in field method'
+    method = METHODS.get(method_request.method)
+    if method is None:
+        response = (f'Invalid method name ({method_request.method}) '
+                    'in field method')
         code = NOT_FOUND
-        logging.debug('Bad method name: %s' % method)
+        logging.debug('Bad method name: %s' % method_request.method)
         return response, code
-    logging.info('Calling %s' % methods[method])
-    response, code = methods[method](method_request.arguments, ctx,
-                                     store, is_admin=method_request.is_admin)
+    if request.get('size', 0) > method.max_body_size:
+        logging.debug('%s body too large: %s' % (method, request['size']))
+        return (f'Request body of {method.name} over '
+                f'{method.max_body_size} bytes', REQUEST_ENTITY_TOO_LARGE)
+    try:
+        ctx['deadline'] = deadline = get_deadline(
+            request.get('headers') or {}, method
+        )
+    except ValueError as exc:
+        logging.debug('Bad X-Request-Timeout header: %s' % exc)
+        return 'Bad X-Request-Timeout header', BAD_REQUEST
+    if method.slots is not None and not method.slots.acquire(
+        timeout=max(deadline.remaining(), 0)
+    ):
+        logging.warning('%s concurrency limit reached' % method)
+        return (f'Too many concurrent {method.name} requests',
+                TOO_MANY_REQUESTS)
+    logging.info('Calling %s' % method)
+    try:
+        response, code = call_method(method, method_request, ctx, store)
+    except DeadlineExceeded as exc:
+        logging.warning('Request timed out: %s' % exc)
+        return str(exc), GATEWAY_TIMEOUT
+    finally:
+        if method.slots is not None:
+            method.slots.release()
     logging.debug('ctx is: %s' % ctx)
     return response, code
 
 
+def memory_handler(request: dict, ctx: dict, store,
+                   profiler: MemoryProfiler = None) -> tuple:
+    """
+    Admin endpoint driving the memory profiler. The body is a method
+    request of the admin user, "method" is one of start, snapshot,
+    diff and stop; "arguments" may hold "limit" for diff.
+    """
+    try:
+        admin_request = MethodRequest(request['body'])
+    except FieldError as exc:
+        logging.debug('Invalid request. Exception: %s' % exc)
+        return str(exc), INVALID_REQUEST
+    if not admin_request.is_admin or not check_auth(admin_request):
+        return 'Forbidden', FORBIDDEN
+    args = admin_request.arguments or {}
+    actions = {
+        'start': profiler.start,
+        'snapshot': profiler.snapshot,
+        'stop': profiler.stop,
+        'diff': lambda: {'top': profiler.diff(int(args.get('limit', 10)))},
+    }
+    action = actions.get(admin_request.method)
+    if action is None:
+        return f'Unknown action {admin_request.method}', NOT_FOUND
+    try:
+        response = action()
+    except (RuntimeError, TypeError, ValueError) as exc:
+        return str(exc), INVALID_REQUEST
+    return response, OK
+
+
+def hot_keys_handler(request: dict, ctx: dict, store,
+                     hot_keys: HotKeys = None) -> tuple:
+    """
+    Admin endpoint reporting hot keys of this process. The body is
+    a method request of the admin user, "method" is "top" ("arguments"
+    may hold "limit") or "hot" (keys pinned with --pin-hot-keys).
+    """
+    try:
+        admin_request = MethodRequest(request['body'])
+    except FieldError as exc:
+        logging.debug('Invalid request. Exception: %s' % exc)
+        return str(exc), INVALID_REQUEST
+    if not admin_request.is_admin or not check_auth(admin_request):
+        return 'Forbidden', FORBIDDEN
+    args = admin_request.arguments or {}
+    if admin_request.method == 'top':
+        try:
+            return hot_keys.top(int(args.get('limit', hot_keys.k))), OK
+        except (TypeError, ValueError) as exc:
+            return str(exc), INVALID_REQUEST
+    if admin_request.method == 'hot':
+        return {'hot': sorted(hot_keys.hot())}, OK
+    return f'Unknown action {admin_request.method}', NOT_FOUND
+
+
+def create_store(concurrency: int = 16):
+    """
+    Store configured by REDIS_URL (several comma-separated host:port
+    nodes turn on sharding), REDIS_REPLICAS, LOCAL_CACHE_TTL
+    (in-process cache kept fresh by keyspace notifications),
+    SHARED_CACHE_MB, SHARED_CACHE_PATH and SHARED_CACHE_TTL (cache
+    shared by the workers of the host), REDIS_POOL_SIZE,
+    REDIS_POOL_TIMEOUT, REDIS_BATCH_WINDOW_US and REDIS_BATCH_SIZE
+    (commands of concurrent requests sent in one pipeline) environment
+    variables. Redis is connected by the first command, so a server
+    down at start only opens the circuit breaker. Shards are read in
+    parallel by <concurrency> request threads.
+    """
+    redis_url = os.environ.get('REDIS_URL', 'localhost:6379')
+    replicas = os.environ.get('REDIS_REPLICAS', '')
+    local_ttl = float(os.environ.get('LOCAL_CACHE_TTL', 0))
+    shared = None
+    if int(os.environ.get('SHARED_CACHE_MB', 0)):
+        shared = SharedCache(
+            os.environ.get('SHARED_CACHE_PATH')
+            or instance_path(SHARED_CACHE_DIR, redis_url),
+            size=int(os.environ['SHARED_CACHE_MB']) * 1024 ** 2
+        )
+    store = store_from_url(
+        redis_url,
+        replicas=[url for url in replicas.split(',') if url],
+        concurrency=concurrency, local_ttl=local_ttl,
+        ttl_jitter=SCORE_TTL_JITTER, stale_ttl=SCORE_STALE_TTL,
+        max_connections=int(os.environ.get('REDIS_POOL_SIZE', 50)),
+        pool_timeout=float(os.environ.get('REDIS_POOL_TIMEOUT', 1.0)),
+        shared=shared,
+        shared_ttl=float(os.environ.get('SHARED_CACHE_TTL', 10)),
+        batch_window=float(os.environ.get('REDIS_BATCH_WINDOW_US', 0)) / 1e6,
+        batch_size=int(os.environ.get('REDIS_BATCH_SIZE', 64)),
+        ping=False
+    )
+    if local_ttl or shared is not None:
+        store.subscribe_invalidations()
+    return store
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
-    redis_url = os.environ.get('REDIS_URL', 'localhost:6379')
-    host, port = redis_url.split(':')
-    store = RedisStore(host=host, port=port)
+    # the store is created by store_factory on first use, see create_app()
+    store_factory = staticmethod(create_store)
+    _store = None
+    _store_lock = threading.Lock()
+    # MemoryProfiler when profiling is enabled, see create_app()
+    memprof = None
+    # TrafficCapture when capture is enabled, see create_app()
+    capture = None
+    # AnswerCache of clients_interests answers, see create_app()
+    answer_cache = None
+    # HotKeys counting store keys and accounts, see create_app()
+    hot_keys = None
+
+    # request body buffers, taken by a request thread while it reads the
+    # body and put back after (requests run in threads of their own)
+    buffers = queue.LifoQueue()
+
+    @classmethod
+    def get_store(cls):
+        if cls._store is None:
+            with cls._store_lock:
+                if cls._store is None:
+                    cls._store = cls.bind_store(cls.store_factory())
+        return cls._store
+
+    @classmethod
+    def bind_store(cls, store):
+        if cls.answer_cache is not None:
+            store.add_invalidation_listener(cls.answer_cache.invalidate,
+                                            cls.answer_cache.clear)
+            # i: keys are only written by other clients of Redis
+            store.subscribe_invalidations()
+        if cls.hot_keys is not None:
+            store.track_hot_keys(cls.hot_keys)
+        return store
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def take_buffer(self, size: int) -> bytearray:
+        """
+        Buffer of at least <size> bytes from the pool, or a new one.
+        Give it back with buffers.put().
+        """
+        try:
+            buf = self.buffers.get_nowait()
+        except queue.Empty:
+            buf = None
+        if buf is None or len(buf) < size:
+            buf = bytearray(size)
+        return buf
+
+    def read_body(self, path: str) -> tuple:
+        """
+        Read request body into the reusable buffer.
+        Returns (decoded body or None, code). Missing, malformed or too big
+        Content-Length is rejected before anything is read.
+        """
+        length = self.headers['Content-Length']
+        if length is None:
+            return None, LENGTH_REQUIRED
+        # isdigit() would take non-ASCII digits int() refuses ('²')
+        if not re.fullmatch(r'\s*[0-9]+\s*', length):
+            return None, BAD_REQUEST
+        length = int(length)
+        if length > MAX_BODY_SIZES.get(path, DEFAULT_MAX_BODY_SIZE):
+            return None, REQUEST_ENTITY_TOO_LARGE
+        buf = self.take_buffer(length)
+        try:
+            with memoryview(buf)[:length] as view:
+                nread = 0
+                while nread < length:
+                    chunk = self.rfile.readinto(view[nread:])
+                    if not chunk:
+                        return None, BAD_REQUEST
+                    nread += chunk
+                try:
+                    return str(view, 'utf-8'), OK
+                except UnicodeDecodeError:
+                    return None, BAD_REQUEST
+        finally:
+            self.buffers.put(buf)
+
     def do_POST(self):
+        received, started = time.time(), time.perf_counter()
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
-        try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
-        except Exception:
-            code = BAD_REQUEST
+        path = self.path.strip("/")
+        if path not in self.router:
+            data_string, code = None, NOT_FOUND
+        else:
+            data_string, code = self.read_body(path)
+        if data_string is not None:
+            try:
+                if path == "method" and len(data_string) >= STREAM_MIN_BODY:
+                    request = loads_request(data_string)
+                else:
+                    request = json.loads(data_string)
+            except Exception:
+                code = BAD_REQUEST
+        else:
+            # the unread body must not be taken for the next request
+            self.close_connection = True
+        if (self.hot_keys is not None and isinstance(request, dict)
+                and isinstance(request.get('account'), str)):
+            self.hot_keys.record_account(request['account'])
+
+        cache_key = None
+        if (self.answer_cache is not None and path == "method"
+                and isinstance(request, dict)):
+            cache_key = interests_cache_key(request)
+        if cache_key is not None and has_valid_token(request):
+            generation = self.answer_cache.generation
+            answer = self.answer_cache.get(cache_key)
+            if answer is not None:
+                # repeated query: no validation, store reads or JSON
+                context.update(code=OK, cached=True)
+                logging.info(context)
+                self.send_bytes(OK, answer)
+                self.capture_request(received, started, path, data_string,
+                                     OK)
+                return
+        else:
+            cache_key = None
 
         if request:
-            path = self.path.strip("/")
             logging.info(
                 "%s: %s %s" % (self.path, data_string, context["request_id"])
             )
-            if path in self.router:
-                try:
-                    response, code = self.router[path](
-                        {"body": request, "headers": self.headers},
-                        context,
-                        self.store
-                    )
-                except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
+            if self.memprof is not None:
+                allocated = self.memprof.request_start()
+            try:
+                response, code = self.router[path](
+                    {"body": request, "headers": self.headers,
+                     "size": int(self.headers['Content-Length'])},
+                    context,
+                    self.get_store()
+                )
+            except StoreUnavailable as e:
+                logging.error("Store unavailable: %s" % e)
+                code = SERVICE_UNAVAILABLE
+            except Exception as e:
+                logging.exception("Unexpected error: %s" % e)
+                code = INTERNAL_ERROR
+            if self.memprof is not None:
+                self.memprof.request_end(allocated, context)
+
+        answer = self.send_answer(code, response, context)
+        if cache_key is not None and code == OK:
+            self.answer_cache.set(
+                cache_key, answer,
+                ["i:%s" % cid for cid in request["arguments"]["client_ids"]],
+                generation
+            )
+        self.capture_request(received, started, path, data_string, code)
+
+    def capture_request(self, received: float, started: float, path: str,
+                        data_string: str or None, code: int):
+        if (self.capture is not None and data_string is not None
+                and self.capture.sampled()):
+            self.capture.record(received, path, data_string, code,
+                                time.perf_counter() - started, self.headers)
+
+    def do_GET(self):
+        """
+        Liveness (/health) and readiness (/ready) probes.
+        Readiness includes store health, liveness does not.
+        """
+        response, code = {}, OK
+        context = {"request_id": self.get_request_id(self.headers)}
+        path = self.path.strip("/")
+        if path == "health":
+            response = {"status": "alive"}
+        elif path == "ready":
+            try:
+                store = self.get_store()
+                store.ping()
+            except (StoreUnavailable, DeadlineExceeded) as e:
+                response = f"Store is not ready: {e}"
+                code = SERVICE_UNAVAILABLE
             else:
-                code = NOT_FOUND
+                response = {"status": "ready", "store": store.metrics()}
+        else:
+            code = NOT_FOUND
+        self.send_answer(code, response, context)
 
+    def send_bytes(self, code: int, answer: bytes):
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.end_headers()
+        self.wfile.write(answer)
+
+    def send_answer(self, code: int, response, context: dict) -> bytes:
         if code not in ERRORS:
             r = {"response": response, "code": code}
         else:
@@ -169,22 +770,134 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             }
         context.update(r)
         logging.info(context)
-        self.wfile.write(json.dumps(r).encode(encoding='utf-8'))
-        return
+        answer = json.dumps(r).encode(encoding='utf-8')
+        self.send_bytes(code, answer)
+        return answer
+
+
+def create_app(store=None, store_factory=create_store,
+               memprof: bool = False, capture: TrafficCapture = None,
+               answer_cache: AnswerCache = None, hot_keys: HotKeys = None):
+    """
+    Application factory: request handler class bound to <store>,
+    or to the store made by <store_factory> on first use.
+    With <memprof> the admin/memory endpoint is added and per-request
+    allocations are put into ctx while tracing is on.
+    Requests sampled by <capture> are written to its file.
+    Repeated clients_interests requests are answered from <answer_cache>.
+    With <hot_keys> store keys and accounts are counted, and reported
+    by the admin/hotkeys endpoint.
+    """
+    attrs = {
+        'store_factory': staticmethod(store_factory),
+        'capture': capture,
+        'answer_cache': answer_cache,
+        'hot_keys': hot_keys,
+        'buffers': queue.LifoQueue(),
+    }
+    router = dict(MainHTTPHandler.router)
+    if memprof:
+        profiler = MemoryProfiler()
+        attrs.update(memprof=profiler)
+        router["admin/memory"] = partial(memory_handler, profiler=profiler)
+    if hot_keys is not None:
+        router["admin/hotkeys"] = partial(hot_keys_handler,
+                                          hot_keys=hot_keys)
+    attrs.update(router=router)
+    app = type('MainHTTPHandler', (MainHTTPHandler,), attrs)
+    if store is not None:
+        app._store = app.bind_store(store)
+    return app
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=0,
+                  help="run supervisor with this many worker processes")
+    op.add_option("--max-requests", action="store", type=int, default=0,
+                  help="recycle a worker after this many requests")
+    op.add_option("--max-rss", action="store", type=int, default=0,
+                  help="recycle a worker when its RSS is over this (MB)")
+    op.add_option("--memprof", action="store_true", default=False,
+                  help="enable admin/memory profiling endpoint")
+    op.add_option("--capture", action="store", default=None,
+                  help="append sampled requests to this file for replay")
+    op.add_option("--capture-rate", action="store", type=float,
+                  default=1.0, help="share of requests to capture")
+    op.add_option("--score-workers", action="store", type=int, default=0,
+                  help="score in this many processes, batching requests")
+    op.add_option("--answer-cache-mb", action="store", type=int, default=0,
+                  help="cache clients_interests answers, up to this (MB)")
+    op.add_option("--hot-keys", action="store_true", default=False,
+                  help="track hot keys, enable admin/hotkeys endpoint")
+    op.add_option("--pin-hot-keys", action="store_true", default=False,
+                  help="keep hot keys in the local cache (LOCAL_CACHE_TTL)")
+    op.add_option("--threads", action="store", type=int, default=16,
+                  help="requests handled at a time by each process")
+    op.add_option("--unix-socket", action="store", default=None,
+                  help="listen on this unix socket path instead of port")
+    op.add_option("--worker-fd", action="store", type=int, default=None)
+    op.add_option("--ready-fd", action="store", type=int, default=None)
     (opts, args) = op.parse_args()
     logging.basicConfig(
         filename=opts.log, level=logging.INFO,
-        format='[%(asctime)s] %(levelname).1s %(message)s',
+        format='[%(asctime)s] %(process)d %(levelname).1s %(message)s',
         datefmt='%Y.%m.%d %H:%M:%S'
     )
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+    if opts.score_workers and not opts.workers:
+        set_engine(ProcessPoolEngine(RulesEngine(),
+                                     max_workers=opts.score_workers))
+    capture = None
+    if opts.capture:
+        capture = TrafficCapture(opts.capture, opts.capture_rate)
+    answer_cache = None
+    if opts.answer_cache_mb:
+        answer_cache = AnswerCache(max_bytes=opts.answer_cache_mb * 1024 ** 2)
+    hot_keys = None
+    if opts.hot_keys or opts.pin_hot_keys:
+        hot_keys = HotKeys(pin=opts.pin_hot_keys)
+    app_options = dict(memprof=opts.memprof, capture=capture,
+                       answer_cache=answer_cache, hot_keys=hot_keys,
+                       store_factory=partial(create_store,
+                                             concurrency=opts.threads))
+    if opts.worker_fd is not None:
+        run_worker(create_app(**app_options), opts.worker_fd,
+                   ready_fd=opts.ready_fd, max_requests=opts.max_requests,
+                   max_rss=opts.max_rss, max_threads=opts.threads)
+        raise SystemExit
+    if opts.workers:
+        worker_args = ['--max-requests', str(opts.max_requests),
+                       '--max-rss', str(opts.max_rss),
+                       '--threads', str(opts.threads)]
+        if opts.log:
+            worker_args += ['--log', opts.log]
+        if opts.memprof:
+            worker_args.append('--memprof')
+        if opts.score_workers:
+            worker_args += ['--score-workers', str(opts.score_workers)]
+        if opts.answer_cache_mb:
+            worker_args += ['--answer-cache-mb', str(opts.answer_cache_mb)]
+        if opts.hot_keys:
+            worker_args.append('--hot-keys')
+        if opts.pin_hot_keys:
+            worker_args.append('--pin-hot-keys')
+        if opts.capture:
+            worker_args += ['--capture', opts.capture,
+                            '--capture-rate', str(opts.capture_rate)]
+        Supervisor(opts.unix_socket or ("localhost", opts.port),
+                   os.path.abspath(__file__), workers=opts.workers,
+                   worker_args=worker_args).run()
+        raise SystemExit
+    if opts.unix_socket:
+        server = UnixHTTPServer(opts.unix_socket, create_app(**app_options))
+    else:
+        server = ThreadedHTTPServer(("localhost", opts.port),
+                                    create_app(**app_options))
+    server.max_threads = opts.threads
+    logging.info("Starting server at %s"
+                 % (opts.unix_socket or opts.port))
     try:
         server.serve_forever()
     except KeyboardInterrupt:
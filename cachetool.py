@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+'''
+Score cache maintenance.
+
+Reclaim score keys left by older scoring model versions:
+$ python3 cachetool.py reclaim [-r, --redis host:port[,host:port]]
+                                [-b, --batch (default: 500)]
+                                [-s, --sleep (default: 0.01)]
+'''
+import argparse
+import logging
+import os
+import time
+
+from const import SCORE_NAMESPACE, SCORE_MODEL_VERSION
+from database import ShardedStore, store_from_url
+from scoring import score_prefix
+
+
+def is_stale(key: str, version: int = SCORE_MODEL_VERSION) -> bool:
+    """
+    Score key of another model version (or an unversioned legacy key).
+    """
+    return not key.startswith(score_prefix(version))
+
+
+def reclaim(store, version: int = SCORE_MODEL_VERSION, batch: int = 500,
+            pause: float = 0.01) -> int:
+    """
+    SCAN the score namespace and UNLINK keys of other model versions
+    in batches, pausing between batches to keep Redis responsive.
+    Returns the number of removed keys.
+    """
+    nodes = (store.nodes.values() if isinstance(store, ShardedStore)
+             else (store,))
+    removed = 0
+    for node in nodes:
+        stale = []
+        for key in node.cache_scan(match=f'{SCORE_NAMESPACE}:*',
+                                   count=batch):
+            if is_stale(key, version):
+                stale.append(key)
+            if len(stale) >= batch:
+                removed += node.cache_delete(stale)
+                stale = []
+                time.sleep(pause)
+        removed += node.cache_delete(stale)
+    return removed
+
+
+if __name__ == "__main__":
+    argpars = argparse.ArgumentParser()
+    argpars.add_argument('command', choices=['reclaim'])
+    argpars.add_argument('-r', '--redis',
+                         default=os.environ.get('REDIS_URL', 'localhost:6379'))
+    argpars.add_argument('-b', '--batch', type=int, default=500)
+    argpars.add_argument('-s', '--sleep', type=float, default=0.01)
+    args = argpars.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    store = store_from_url(args.redis)
+    removed = reclaim(store, batch=args.batch, pause=args.sleep)
+    logging.info('Removed %d stale score keys (model version %d)'
+                 % (removed, SCORE_MODEL_VERSION))
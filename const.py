@@ -5,15 +5,54 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+LENGTH_REQUIRED = 411
+REQUEST_ENTITY_TOO_LARGE = 413
+TOO_MANY_REQUESTS = 429
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    LENGTH_REQUIRED: "Length Required",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
 }
+# request time budget in seconds if a method sets none
+# (overridden by X-Request-Timeout header)
+DEFAULT_TIMEOUT = 2.0
+# request body limits in bytes, per route
+DEFAULT_MAX_BODY_SIZE = 64 * 1024
+MAX_BODY_SIZES = {
+    # the largest method limit (max_body_size of online_score_batch)
+    "method": 2 * 1024 * 1024,
+}
+# body limit of a method setting none
+DEFAULT_METHOD_MAX_BODY_SIZE = 1024 * 1024
+# score cache keys are "<namespace>:v<version>:<digest>",
+# bump the version when scoring rules change
+SCORE_NAMESPACE = "uid"
+SCORE_MODEL_VERSION = 1
+# score cache TTL is spread by +-10% so that entries written together
+# expire at different times; expired scores are served for 5 more minutes
+# while refreshed in background
+SCORE_TTL_JITTER = 0.1
+SCORE_STALE_TTL = 5 * 60
+# clients_interests answers cache (--answer-cache-mb) entry TTL, seconds
+ANSWER_CACHE_TTL = 60
+# clients_interests bodies from this size on are decoded incrementally,
+# interests of their client ids are read in batches of this size
+STREAM_MIN_BODY = 64 * 1024
+INTERESTS_BATCH_SIZE = 500
+# directory of the cache shared by worker processes (SHARED_CACHE_MB),
+# on tmpfs; the file is named after the Redis URL
+SHARED_CACHE_DIR = "/dev/shm"
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -2,89 +2,1614 @@
 Database
 """
 import redis
+from bisect import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import partial
+import hashlib
+import itertools
 import logging
-import time
+import queue
 import random
+import threading
+import time
+
+
+class StoreUnavailable(ConnectionError):
+    """
+    Raised when the store cannot be reached or the circuit breaker is open.
+    """
+    pass
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when the request time budget is exhausted.
+    """
+    pass
+
+
+class Deadline:
+    """
+    Absolute point in time by which a request should be served.
+    Usage:
+    >>> deadline = Deadline(1.5)  # seconds from now
+    >>> store.get(key, timeout=deadline.remaining())
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired:
+            raise DeadlineExceeded(
+                f'Request deadline of {self.timeout}s exceeded'
+            )
+
+    def __repr__(self):
+        return f'Deadline({self.timeout}, remaining={self.remaining():.3f})'
+
+
+class _BoundPipeline(redis.client.Pipeline):
+    """
+    Pipeline of <client> run on <conn>, a connection held by the caller:
+    unlike a plain pipeline it neither takes another connection from
+    the pool nor releases <conn> to it.
+    """
+
+    def __init__(self, client, conn, transaction: bool = True,
+                 shard_hint=None):
+        self.bound = conn
+        super().__init__(client.connection_pool, client.response_callbacks,
+                         transaction, shard_hint)
+
+    def reset(self):
+        self.connection = None
+        super().reset()
+        self.connection = self.bound
+
+
+def _pipelined(queue_commands):
+    """
+    Function of a client running queue_commands(pipe, *args, **kwargs)
+    in a pipeline of its own, in one round trip. CallBatcher adds the
+    commands to a shared pipeline instead.
+    """
+    def run(client, *args, **kwargs) -> list:
+        pipe = client.pipeline(transaction=False)
+        queue_commands(pipe, *args, **kwargs)
+        return pipe.execute()
+    run.__name__ = queue_commands.__name__
+    run.__doc__ = queue_commands.__doc__
+    run.queue = queue_commands
+    return run
+
+
+@_pipelined
+def _set_many(pipe, mapping: dict, ex=None):
+    """
+    SET every key of <mapping> in one pipeline round trip.
+    <ex> is the TTL or a function giving the TTL of each key.
+    """
+    for key, value in mapping.items():
+        pipe.set(key, value, ex=ex() if callable(ex) else ex)
+
+
+@_pipelined
+def _get_with_ttl(pipe, key: str):
+    """
+    GET and TTL of <key> in one pipeline round trip.
+    """
+    pipe.get(key)
+    pipe.ttl(key)
+
+
+@_pipelined
+def _dump_many(pipe, keys: list):
+    """
+    GET and PTTL of each of <keys> in one pipeline round trip.
+    """
+    for key in keys:
+        pipe.get(key)
+        pipe.pttl(key)
+
+
+@_pipelined
+def _restore_many(pipe, mapping: dict):
+    """
+    SET NX every key of <mapping> {key: (value, pttl)} in one pipeline
+    round trip, keeping its remaining TTL (pttl <= 0: no TTL).
+    """
+    for key, (value, pttl) in mapping.items():
+        pipe.set(key, value, px=pttl if pttl > 0 else None, nx=True)
+
+
+def _run(client, command, *args, **kwargs):
+    """
+    Run <command> (a client method name or a function of the client).
+    """
+    if callable(command):
+        return command(client, *args, **kwargs)
+    return getattr(client, command)(*args, **kwargs)
+
+
+class _Batch:
+    __slots__ = ('calls', 'timeouts', 'full', 'done', 'results', 'error')
+
+    def __init__(self):
+        self.calls = []
+        self.timeouts = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+def _run_batch(client, calls: list) -> list:
+    """
+    Queue all <calls> (command, args, kwargs) in one pipeline. Results
+    of pipelined functions are lists, errors are returned in place.
+    """
+    pipe = client.pipeline(transaction=False)
+    sizes = []
+    for command, args, kwargs in calls:
+        queued = len(pipe)
+        if callable(command):
+            command.queue(pipe, *args, **kwargs)
+        else:
+            getattr(pipe, command)(*args, **kwargs)
+        sizes.append(len(pipe) - queued)
+    replies = iter(pipe.execute(raise_on_error=False))
+    return [
+        [next(replies) for _ in range(size)] if callable(command)
+        else next(replies)
+        for (command, _, _), size in zip(calls, sizes)
+    ]
+
+
+class CallBatcher:
+    """
+    Gathers store calls of concurrent threads into pipelines.
+    The first caller of a batch (the leader) waits up to <window> seconds
+    for other calls, or until there are <max_calls>, then runs the batch
+    with execute(_run_batch, calls, timeout=...) and hands every caller
+    its own result. A caller alone in the store runs its command at once,
+    and so does a leader nobody joined.
+    """
+    # single-reply commands safe to pipeline with others
+    COMMANDS = frozenset(('get', 'set', 'mget', 'delete', 'unlink', 'ttl',
+                          'ping'))
+
+    def __init__(self, execute, window: float = 0.0002,
+                 max_calls: int = 64):
+        self.execute = execute
+        self.window = window
+        self.max_calls = max_calls
+        self.active = 0
+        self.stats = {'batches': 0, 'calls': 0, 'max_batch': 0}
+        self._batch = None
+        self._lock = threading.Lock()
+
+    def batchable(self, command) -> bool:
+        if callable(command):
+            return hasattr(command, 'queue')
+        return command in self.COMMANDS
+
+    def call(self, command, *args, timeout: float or None = None,
+             **kwargs):
+        with self._lock:
+            self.active += 1
+            batch = self._batch
+            alone = batch is None and self.active == 1
+            if alone:
+                self._count(1)
+            else:
+                leader = batch is None
+                if leader:
+                    batch = self._batch = _Batch()
+                index = len(batch.calls)
+                batch.calls.append((command, args, kwargs))
+                batch.timeouts.append(timeout)
+                if len(batch.calls) >= self.max_calls:
+                    self._batch = None
+                    batch.full.set()
+        if alone:
+            # nobody to wait for: no batch, no pipeline
+            try:
+                return self.execute(command, *args, timeout=timeout,
+                                    **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+        try:
+            if leader:
+                self._lead(batch)
+            elif not batch.done.wait(timeout):
+                raise DeadlineExceeded('Batched store call exceeded the '
+                                       'request deadline')
+        finally:
+            with self._lock:
+                self.active -= 1
+        if batch.error is not None:
+            raise batch.error
+        result = batch.results[index]
+        if isinstance(result, Exception):
+            raise result
+        if isinstance(result, list) and callable(command):
+            for reply in result:
+                if isinstance(reply, Exception):
+                    raise reply
+        return result
+
+    def _lead(self, batch: _Batch):
+        batch.full.wait(self.window)
+        with self._lock:
+            if self._batch is batch:
+                self._batch = None
+            calls = len(batch.calls)
+            self._count(calls)
+        # the batch may run as long as its most patient caller waits
+        timeout = (None if None in batch.timeouts
+                   else max(batch.timeouts))
+        try:
+            if calls == 1:
+                # the others were done before the window closed
+                command, args, kwargs = batch.calls[0]
+                batch.results = [self.execute(command, *args,
+                                              timeout=timeout, **kwargs)]
+            else:
+                batch.results = self.execute(_run_batch, batch.calls,
+                                             timeout=timeout)
+        except Exception as exc:
+            batch.error = exc
+        finally:
+            batch.done.set()
+
+    def _count(self, calls: int):
+        self.stats['batches'] += 1
+        self.stats['calls'] += calls
+        self.stats['max_batch'] = max(self.stats['max_batch'], calls)
+
+    def metrics(self) -> dict:
+        return dict(self.stats)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker guarding calls to a remote storage.
+
+    * closed: calls pass through, consecutive failures are counted;
+    * open: calls are rejected at once for <reset_timeout> seconds;
+    * half-open: a single trial call is let through, its result decides
+    whether the breaker closes again or goes back to open.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 3,
+                 reset_timeout: float = 5.0, name: str = 'redis',
+                 logger=logging.getLogger(__name__)):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.logger = logger
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+        self.stats = {'transitions': 0, 'rejected': 0, 'failures': 0,
+                      'opened': 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _maybe_half_open(self):
+        if (self._state == CircuitBreaker.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout):
+            self._set_state(CircuitBreaker.HALF_OPEN)
+
+    def _set_state(self, state: str):
+        if state == self._state:
+            return
+        self.logger.warning('Circuit breaker %s: %s -> %s'
+                            % (self.name, self._state, state))
+        self._state = state
+        self.stats['transitions'] += 1
+        if state == CircuitBreaker.OPEN:
+            self._opened_at = time.monotonic()
+            self.stats['opened'] += 1
+        self._trial = False
+
+    def allow(self) -> bool:
+        """
+        Check if a call may be made now.
+        In half-open state only one trial call is allowed at a time.
+        """
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == CircuitBreaker.CLOSED:
+                return True
+            if self._state == CircuitBreaker.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def release(self):
+        """
+        End a call with no outcome to record, so that a half-open
+        breaker lets another trial call through.
+        """
+        with self._lock:
+            if self._state == CircuitBreaker.HALF_OPEN:
+                self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._set_state(CircuitBreaker.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self.stats['failures'] += 1
+            if (self._state == CircuitBreaker.HALF_OPEN
+                    or self._failures >= self.failure_threshold):
+                self._set_state(CircuitBreaker.OPEN)
+
+    def metrics(self) -> dict:
+        return dict(self.stats, state=self.state)
+
+
+class LocalCache:
+    """
+    In-process cache of store values, each kept for <ttl> seconds.
+    Oldest keys are dropped when there are over <max_size>, except
+    pinned ones.
+    """
+
+    def __init__(self, ttl: float = 10, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self.pinned = frozenset()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'added': 0, 'invalidated': 0,
+                      'flushed': 0}
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            with self._lock:
+                self._entries.pop(key, None)
+            return default
+        self.stats['hits'] += 1
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self.stats['added'] += 1
+            # each key is looked at once at most, if all are pinned
+            for _ in range(len(self._entries)):
+                if len(self._entries) <= self.max_size:
+                    break
+                oldest = next(iter(self._entries))
+                if oldest in self.pinned:
+                    # moved to the end, as if just added
+                    self._entries[oldest] = self._entries.pop(oldest)
+                else:
+                    del self._entries[oldest]
+
+    def pin(self, keys):
+        """
+        Keep <keys> when the cache is full (their TTL still applies).
+        """
+        self.pinned = frozenset(keys)
+
+    def discard(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.stats['invalidated'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats['flushed'] += 1
+
+    def metrics(self) -> dict:
+        return dict(self.stats, size=len(self._entries),
+                    pinned=len(self.pinned))
+
+
+class NegativeCache(LocalCache):
+    """
+    Keys known to be missing in the store.
+    """
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, False)
+
+    def add(self, key):
+        self.set(key, True)
+
+
+class KeyspaceSubscriber(threading.Thread):
+    """
+    Background thread listening to Redis keyspace notifications of the
+    store databases. Every changed key is passed to <on_change>;
+    <on_flush> is called after each (re)connect, as notifications
+    may have been missed while disconnected.
+    Redis should have notify-keyspace-events enabled (e.g. 'K$gx'),
+    with <configure> the subscriber tries to set it itself.
+    """
+
+    def __init__(self, store, on_change, on_flush, configure: bool = False,
+                 reconnect_delay: float = 1.0,
+                 logger=logging.getLogger(__name__)):
+        super().__init__(name='keyspace-subscriber', daemon=True)
+        self.store = store
+        self.on_change = on_change
+        self.on_flush = on_flush
+        self.configure = configure
+        self.reconnect_delay = reconnect_delay
+        self.logger = logger
+        self.patterns = [f'__keyspace@{db}__:*'
+                         for db in (store.db, store.db_cache)]
+        self.connections = 0
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def handle(self, message: dict):
+        channel = message.get('channel') or ''
+        key = channel.split(':', 1)[1] if ':' in channel else None
+        if key:
+            self.on_change(key)
+
+    def listen(self):
+        # holds one connection of the store pool while listening
+        client = self.store.r
+        if self.configure:
+            try:
+                client.config_set('notify-keyspace-events', 'K$gx')
+            except redis.exceptions.ResponseError as exc:
+                self.logger.warning('Cannot enable keyspace events: %s'
+                                    % exc)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.psubscribe(*self.patterns)
+            self.connections += 1
+            self.on_flush()
+            self.logger.info('Listening to %s' % self.patterns)
+            while not self._stopped.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    self.handle(message)
+        finally:
+            pubsub.close()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.listen()
+            except (redis.exceptions.ConnectionError,
+                    redis.exceptions.TimeoutError) as exc:
+                self.logger.warning('Keyspace subscriber disconnected: %s'
+                                    % exc)
+                self._stopped.wait(self.reconnect_delay)
+
+
+class PoolExhausted(StoreUnavailable):
+    """
+    No free connection in the pool within its wait timeout.
+    """
+
+
+class PoolStats:
+    """
+    Counters of a database connection pool, kept across reconnects.
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds: float, exhausted: bool = False):
+        with self._lock:
+            self.waits += 1
+            self.wait_time += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            self.exhausted += exhausted
+
+
+class _TimedQueue(queue.LifoQueue):
+    """
+    Pool queue recording how long callers wait for a free connection.
+    """
+    stats = None
+
+    def get(self, block=True, timeout=None):
+        try:
+            return super().get(block=False)
+        except queue.Empty:
+            if not block:
+                raise
+        started = time.monotonic()
+        try:
+            connection = super().get(block=True, timeout=timeout)
+        except queue.Empty:
+            self.stats.record_wait(time.monotonic() - started, True)
+            raise
+        self.stats.record_wait(time.monotonic() - started)
+        return connection
+
+
+class InstrumentedPool(redis.BlockingConnectionPool):
+    """
+    Pool of at most <max_connections>: a caller waits up to <timeout>
+    seconds for a free connection, then gets PoolExhausted.
+    Counters go to <stats>.
+    """
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        super().__init__(queue_class=_TimedQueue, **kwargs)
+
+    def reset(self):
+        super().reset()
+        self.pool.stats = self.stats
+
+    def make_connection(self):
+        with self.stats._lock:
+            self.stats.created += 1
+        return super().make_connection()
+
+    def get_connection(self, command_name, *keys, **options):
+        try:
+            return super().get_connection(command_name, *keys, **options)
+        except redis.exceptions.ConnectionError as exc:
+            if isinstance(exc.__context__, queue.Empty):
+                raise PoolExhausted(
+                    f'No free connection in {self.timeout}s '
+                    f'({self.max_connections} in pool)'
+                ) from exc
+            raise
+
+    def metrics(self) -> dict:
+        idle = sum(1 for conn in list(self.pool.queue) if conn is not None)
+        return {
+            'max_connections': self.max_connections,
+            'in_use': len(self._connections) - idle,
+            'idle': idle,
+            'created': self.stats.created,
+            'waits': self.stats.waits,
+            'wait_time': round(self.stats.wait_time, 6),
+            'max_wait': round(self.stats.max_wait, 6),
+            'exhausted': self.stats.exhausted,
+        }
+
+
+def parse_url(url: str) -> dict:
+    """
+    RedisStore connection kwargs for a 'host:port' or 'unix:///path'
+    <url>.
+    """
+    if url.startswith('unix://'):
+        return {'unix_socket_path': url[len('unix://'):]}
+    host, port = url.split(':')
+    return {'host': host, 'port': port}
 
 
 class RedisStore:
+    READ_POLICIES = ('round-robin', 'least-outstanding')
 
     def __init__(self, host: str = 'localhost', port: int = 6379,
                  db: int = 0, password: str or None = None,
                  socket_timeout: float or None = 0.5,
                  ttl=timedelta(minutes=60).seconds,
-                 max_retry=3, connect: bool = True,
+                 max_retry=3, connect: bool = True, ping: bool = True,
+                 breaker: CircuitBreaker or None = None,
+                 replicas: list = (), read_policy: str = 'round-robin',
+                 max_replica_lag: float or None = None,
+                 lag_check_interval: float = 1.0,
+                 negative_ttl: float = 10, local_ttl: float = 0,
+                 unix_socket_path: str or None = None,
+                 ttl_jitter: float = 0, stale_ttl: int = 0,
+                 max_connections: int = 50, pool_timeout: float = 1.0,
+                 socket_connect_timeout: float or None = None,
+                 socket_keepalive: bool = True, shared=None,
+                 shared_ttl: float = 10, batch_window: float = 0,
+                 batch_size: int = 64,
                  logger=logging.getLogger(__name__)):
         """
         Init a RedisStore object.
-        * By default, cache TTL set on 60 minutes.
+        * By default, cache TTL set on 60 minutes, spread by
+        +-<ttl_jitter> (a share of TTL) so that entries written together
+        do not expire together. After that an entry is kept <stale_ttl>
+        seconds more and returned by cache_lookup as stale.
         * Using default database num. 0, standart Redis port and
-        localhost.
+        localhost. With <unix_socket_path> Redis is connected through
+        a unix domain socket instead of TCP.
+        * With <connect> the clients are made and, with <ping>, checked
+        at once (a connection error is raised). Without <ping> the first
+        command connects, through the circuit breaker.
+        * Each database has a pool of <max_connections>; a call waits
+        up to <pool_timeout> seconds for a free connection, then fails
+        with PoolExhausted (not counted by the circuit breaker).
+        Pool usage and waits are reported by metrics().
+        * After <max_retry> consecutive connection failures the circuit
+        breaker opens and every call fails fast with StoreUnavailable
+        until the breaker lets a trial call through.
+        * Reads (get, get_many, cache_get) are balanced across <replicas>
+        ('host:port' list) with 'round-robin' or 'least-outstanding'
+        <read_policy>. A replica with an open breaker is ejected; a replica
+        lagging more than <max_replica_lag> seconds behind the primary is
+        skipped (see replica_lag). Writes always go to the primary.
+        * Keys found missing by get are remembered for <negative_ttl>
+        seconds (0 - off) and fail without a round trip; set and delete
+        invalidate them.
+        * With <local_ttl> values read by get and cache_get are kept
+        in-process for that many seconds. Start invalidations with
+        subscribe_invalidations() to use long TTLs safely.
+        * <shared> (a SharedCache) keeps values read by get, cache_get
+        and cache_lookup for all worker processes of the host, for
+        <shared_ttl> seconds at most. Keys changed through the store or
+        reported by the subscriber are dropped from it too.
+        * With <batch_window> (seconds, 0 - off) single commands of
+        concurrent threads are sent together in one pipeline: a call
+        waits up to <batch_window> for others, or until <batch_size>
+        calls are gathered. A thread alone in the store does not wait.
         """
         self.host = host
         self.port = port
+        self.unix_socket_path = unix_socket_path
         self.db = db
         self.db_cache = db + 1
         self.password = password
         self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.socket_keepalive = socket_keepalive
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.pools = {}
+        self._pool_stats = {db: PoolStats(), db + 1: PoolStats()}
         self.logger = logger
         self.ttl = ttl
+        self.ttl_jitter = ttl_jitter
+        self.stale_ttl = stale_ttl
         self.max_retry = max_retry
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=max_retry, logger=logger
+        )
+        if read_policy not in RedisStore.READ_POLICIES:
+            raise ValueError(f'Unknown read policy {read_policy!r}')
+        self.read_policy = read_policy
+        self.max_replica_lag = max_replica_lag
+        self.lag_check_interval = lag_check_interval
+        self._rr = itertools.count()
+        self._outstanding = {}
+        self._lag = {}
+        # (time, primary replication offset) samples, oldest first
+        self._offsets = deque()
+        self._replica_lock = threading.Lock()
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.replicas = [self._make_replica(url, connect)
+                         for url in replicas]
+        self.negative = NegativeCache(negative_ttl) if negative_ttl else None
+        self.local = LocalCache(local_ttl) if local_ttl else None
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self.subscriber = None
+        self.listeners = []
+        self.hot_keys = None
+        self.batchers = {}
+        if batch_window > 0:
+            self.batchers = {
+                attr: CallBatcher(partial(self._call, attr, db),
+                                  batch_window, batch_size)
+                for attr, db in (('r', self.db), ('cache', self.db_cache))
+            }
         if connect:
             self.r = self._connect(self.db)
             self.cache = self._connect(self.db_cache)
-            try:
+            if ping:
                 all((self.r.ping(), self.cache.ping()))
-            except redis.exceptions.ConnectionError:
-                raise
+
+    def _make_replica(self, url: str, connect: bool):
+        """
+        Replica store sharing the primary settings. Connections are opened
+        lazily, so a replica that is down at start only opens its breaker.
+        """
+        replica = RedisStore(
+            **parse_url(url), db=self.db, password=self.password,
+            socket_timeout=self.socket_timeout, ttl=self.ttl,
+            ttl_jitter=self.ttl_jitter, stale_ttl=self.stale_ttl,
+            max_connections=self.max_connections,
+            pool_timeout=self.pool_timeout,
+            socket_connect_timeout=self.socket_connect_timeout,
+            socket_keepalive=self.socket_keepalive,
+            max_retry=self.max_retry, connect=False, logger=self.logger,
+            negative_ttl=0, local_ttl=0, batch_window=self.batch_window,
+            batch_size=self.batch_size,
+            breaker=CircuitBreaker(failure_threshold=self.max_retry,
+                                   name=f'replica {url}', logger=self.logger)
+        )
+        if connect:
+            replica.r = replica._connect(replica.db)
+            replica.cache = replica._connect(replica.db_cache)
+        self._outstanding[replica] = 0
+        return replica
+
+    @property
+    def url(self) -> str:
+        """
+        'host:port' or 'unix:///path' of the server (see parse_url).
+        """
+        if self.unix_socket_path:
+            return f'unix://{self.unix_socket_path}'
+        return f'{self.host}:{self.port}'
+
+    def replica_lag(self, replica) -> float:
+        """
+        Replica lag in seconds, checked at most every <lag_check_interval>:
+        time since the primary went past the replication offset
+        the replica has reached (0 if it has every write of the primary).
+        A replica with a broken link to the primary has infinite lag.
+        """
+        checked, lag = self._lag.get(replica, (0.0, 0.0))
+        now = time.monotonic()
+        if now - checked < self.lag_check_interval:
+            return lag
+        try:
+            info = replica._execute('r', replica.db, 'info', 'replication')
+        except (StoreUnavailable, DeadlineExceeded):
+            lag = float('inf')
+        else:
+            if info.get('master_link_status') != 'up':
+                lag = float('inf')
+            else:
+                lag = self._offset_lag(int(info.get('slave_repl_offset', 0)),
+                                       now)
+        self._lag[replica] = (now, lag)
+        return lag
+
+    def _offset_lag(self, offset: int, now: float) -> float:
+        """
+        Seconds since the first primary offset sample past <offset>.
+        The primary offset is sampled at most every <lag_check_interval>;
+        samples older than <max_replica_lag> are dropped but one.
+        """
+        offsets = self._offsets
+        with self._replica_lock:
+            sample = not offsets or (
+                now - offsets[-1][0] >= self.lag_check_interval
+            )
+            horizon = now - (self.max_replica_lag or 0) - \
+                self.lag_check_interval
+            while len(offsets) > 1 and offsets[1][0] < horizon:
+                offsets.popleft()
+        if sample:
+            try:
+                info = self._execute('r', self.db, 'info', 'replication')
+            except (StoreUnavailable, DeadlineExceeded):
+                # the primary is unavailable: replicas are not behind it
+                return 0.0
+            with self._replica_lock:
+                offsets.append((now, int(info.get('master_repl_offset', 0))))
+        with self._replica_lock:
+            samples = list(offsets)
+        for checked, primary_offset in samples:
+            if primary_offset > offset:
+                return now - checked
+        return 0.0
+
+    def _pick_replica(self):
+        """
+        Choose a healthy replica for a read, or None to read the primary.
+        """
+        healthy = [
+            replica for replica in self.replicas
+            if replica.breaker.state != CircuitBreaker.OPEN and (
+                self.max_replica_lag is None
+                or self.replica_lag(replica) <= self.max_replica_lag
+            )
+        ]
+        if not healthy:
+            return None
+        with self._replica_lock:
+            if self.read_policy == 'least-outstanding':
+                replica = min(healthy, key=self._outstanding.get)
+            else:
+                replica = healthy[next(self._rr) % len(healthy)]
+            self._outstanding[replica] += 1
+        return replica
+
+    def _read(self, method: str, *args, **kwargs):
+        """
+        Run a read <method> on a replica, falling back to the primary
+        if there is no healthy replica or the chosen one is unavailable.
+        """
+        replica = self._pick_replica() if self.replicas else None
+        if replica is not None:
+            try:
+                return getattr(replica, method)(*args, **kwargs)
+            except StoreUnavailable as exc:
+                self.logger.info('Replica read failed: %s' % exc)
+            finally:
+                with self._replica_lock:
+                    self._outstanding[replica] -= 1
+        return getattr(RedisStore, method)(self, *args, primary=True,
+                                           **kwargs)
 
     def _connect(self, db):
-        return redis.Redis(host=self.host, port=self.port, db=db,
-                           password=self.password,
-                           socket_timeout=self.socket_timeout,
-                           decode_responses=True)
+        """
+        Client of <db> on a new pool, replacing the previous pool
+        of the database (its counters are kept).
+        """
+        kwargs = dict(db=db, password=self.password,
+                      socket_timeout=self.socket_timeout,
+                      socket_connect_timeout=self.socket_connect_timeout,
+                      socket_keepalive=self.socket_keepalive,
+                      decode_responses=True)
+        if self.unix_socket_path:
+            kwargs.update(path=self.unix_socket_path,
+                          connection_class=redis.UnixDomainSocketConnection)
+            # TCP only options
+            del kwargs['socket_keepalive'], kwargs['socket_connect_timeout']
+        else:
+            kwargs.update(host=self.host, port=self.port)
+        self.pools[db] = InstrumentedPool(
+            self._pool_stats[db], max_connections=self.max_connections,
+            timeout=self.pool_timeout, **kwargs
+        )
+        return redis.Redis(connection_pool=self.pools[db])
 
-    def ping_reconnect(self, storage, db, store_name='storage'):
+    def _reconnect(self, attr: str, db: int):
+        """
+        Close the idle connections of <attr> after a connection error.
+        Its pool and counters are kept: connections are opened again on
+        demand, up to the same max_connections (the one in use was
+        closed by redis-py when its command failed).
+        """
+        pool = self.pools.get(db)
+        client = getattr(self, attr, None)
+        if pool is None or getattr(client, 'connection_pool', None) \
+                is not pool:
+            setattr(self, attr, self._connect(db))
+            return
+        for conn in list(pool.pool.queue):
+            if conn is not None:
+                conn.disconnect()
+
+    def _call_with_timeout(self, client, timeout: float, command: str,
+                           *args, **kwargs):
+        """
+        Run <command> on a pooled connection with the socket timeout
+        lowered to <timeout> for this single call.
+        """
+        pool = client.connection_pool
+        conn = pool.get_connection(getattr(command, '__name__', command))
         try:
-            conn = storage.ping()
-        except redis.exceptions.ConnectionError:
-            self.logger.info(f'Cannot connect to {store_name}. Reconnecting')
-            for i in range(self.max_retry):
-                try:
-                    storage = self._connect(db)
-                    conn = storage.ping()
-                except:  # noqa E722 (flake8 enable bare except)
-                    time.sleep(random.randint(5, 15)/10 + i/2)
-            if not conn:
-                raise ConnectionError('Cannot connect to cache')
-
-    def cache_get(self, key: str) -> str:
-        self.ping_reconnect(self.cache, self.db_cache)
-        value = self.cache.get(key) or None
-        if not value:
-            self.logger.debug('Key not in cache, trying to get from db')
+            conn.connect()
+            conn.socket_timeout = timeout
+            conn._sock.settimeout(timeout)
+            bound = redis.Redis(connection_pool=pool)
+            bound.connection = conn
+            # pipelines (pipelined functions, batches) use it too
+            bound.pipeline = partial(_BoundPipeline, bound, conn)
+            return _run(bound, command, *args, **kwargs)
+        finally:
+            conn.socket_timeout = self.socket_timeout
+            if conn._sock is not None:
+                conn._sock.settimeout(self.socket_timeout)
+            pool.release(conn)
+
+    def _execute(self, attr: str, db: int, command: str, *args,
+                 timeout: float or None = None, **kwargs):
+        """
+        Run <command> on the connection stored in <attr>, going through
+        the circuit breaker. A broken connection is re-created once.
+
+        If <timeout> (the remaining request budget) is given and shorter
+        than the store socket_timeout, the call is limited by it.
+        Commands of concurrent threads may be sent together (batch_window).
+        """
+        batcher = self.batchers.get(attr)
+        if batcher is not None and batcher.batchable(command):
+            return batcher.call(command, *args, timeout=timeout, **kwargs)
+        return self._call(attr, db, command, *args, timeout=timeout,
+                          **kwargs)
+
+    def _call(self, attr: str, db: int, command: str, *args,
+              timeout: float or None = None, **kwargs):
+        """
+        _execute without batching.
+        """
+        for attempt in range(2):
+            if timeout is not None and timeout <= 0:
+                raise DeadlineExceeded(f'No time left to call {attr}')
+            if not self.breaker.allow():
+                raise StoreUnavailable(
+                    f'Storage is unavailable (circuit {self.breaker.state})'
+                )
+            limited = timeout is not None and (
+                self.socket_timeout is None or timeout < self.socket_timeout
+            )
             try:
-                value = self.r.get(key)
-            except LookupError as exc:
-                self.logger.error('Cannot get value from db: %s' % exc)
+                if limited:
+                    result = self._call_with_timeout(
+                        getattr(self, attr), timeout, command,
+                        *args, **kwargs
+                    )
+                else:
+                    result = _run(getattr(self, attr), command,
+                                  *args, **kwargs)
+            except redis.exceptions.TimeoutError as exc:
+                if limited:
+                    self.breaker.release()
+                    raise DeadlineExceeded(
+                        f'Call to {attr} exceeded the request deadline'
+                    ) from exc
+                self.breaker.record_failure()
+                self.logger.info(f'Timeout on {attr}: {exc}. Reconnecting')
+                self._reconnect(attr, db)
+                continue
+            except redis.exceptions.ConnectionError as exc:
+                self.breaker.record_failure()
+                self.logger.info(f'Cannot connect to {attr}: {exc}. '
+                                 'Reconnecting')
+                self._reconnect(attr, db)
+                continue
+            except BaseException:
+                # says nothing of the store health (e.g. ResponseError,
+                # PoolExhausted): a trial call must not stay taken
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return result
+        raise StoreUnavailable(f'Cannot connect to {attr}')
+
+    def ping(self) -> bool:
+        return all((self._execute('r', self.db, 'ping'),
+                    self._execute('cache', self.db_cache, 'ping')))
+
+    def add_invalidation_listener(self, on_change, on_flush):
+        """
+        Call on_change(key) when <key> is changed, on_flush() when any
+        key may have been changed, to keep caches built on store
+        values in sync.
+        """
+        self.listeners.append((on_change, on_flush))
+
+    def invalidate(self, key: str):
+        """
+        Drop <key> from in-process caches.
+        """
+        if self.local is not None:
+            self.local.discard(key)
+        if self.shared is not None:
+            self.shared.discard(key)
+        if self.negative is not None:
+            self.negative.discard(key)
+        for on_change, _ in self.listeners:
+            on_change(key)
+
+    def flush_local(self, shared: bool = True):
+        """
+        Drop all in-process caches; the host-wide one too if <shared>.
+        """
+        if self.local is not None:
+            self.local.clear()
+        if shared and self.shared is not None:
+            self.shared.clear()
+        if self.negative is not None:
+            self.negative.clear()
+        for _, on_flush in self.listeners:
+            on_flush()
+
+    def _resync(self):
+        """
+        Flush after the subscriber (re)connects. Meanwhile the shared
+        cache was kept in sync by the subscribers of the other workers,
+        so it is only cleared on a reconnect, as they may all have been
+        cut off too, not on every worker start.
+        """
+        self.flush_local(shared=self.subscriber.connections > 1)
+
+    def subscribe_invalidations(self, configure: bool = False):
+        """
+        Start a KeyspaceSubscriber evicting changed keys from in-process
+        caches, with a full flush on every reconnect.
+        """
+        if self.subscriber is None:
+            self.subscriber = KeyspaceSubscriber(
+                self, self.invalidate, self._resync,
+                configure=configure, logger=self.logger
+            )
+            self.subscriber.start()
+        return self.subscriber
+
+    def track_hot_keys(self, hot_keys):
+        """
+        Count keys read by get, get_many, cache_get, cache_lookup and
+        cache_get_many in <hot_keys> (a HotKeys). With hot_keys.pin
+        the keys found hot are pinned in the local cache.
+        """
+        self.hot_keys = hot_keys
+        if hot_keys.pin and self.local is not None:
+            hot_keys.add_listener(self.local.pin)
+
+    def metrics(self) -> dict:
+        metrics = {'breaker': self.breaker.metrics()}
+        if self.pools:
+            names = {self.db: 'db', self.db_cache: 'cache'}
+            metrics['pools'] = {names[db]: pool.metrics()
+                                for db, pool in self.pools.items()}
+        if self.negative is not None:
+            metrics['negative_cache'] = self.negative.metrics()
+        if self.local is not None:
+            metrics['local_cache'] = self.local.metrics()
+        if self.shared is not None:
+            metrics['shared_cache'] = self.shared.metrics()
+        if self.batchers:
+            names = {'r': 'db', 'cache': 'cache'}
+            metrics['batching'] = {names[attr]: batcher.metrics()
+                                   for attr, batcher in self.batchers.items()}
+        if self.replicas:
+            metrics['replicas'] = {
+                replica.url: dict(
+                    replica.metrics(),
+                    outstanding=self._outstanding[replica]
+                )
+                for replica in self.replicas
+            }
+        return metrics
+
+    def _get_kept(self, key: str):
+        """
+        Value of <key> kept in the local or shared cache, or None.
+        """
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not None:
+                return value
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None and self.local is not None:
+                self.local.set(key, value)
+            return value
+        return None
+
+    def _keep(self, key: str, value: str, ttl: float or None = None):
+        """
+        Keep a value read from Redis in the local and shared caches,
+        in the shared one for <ttl> seconds if it is shorter.
+        """
+        if self.local is not None:
+            self.local.set(key, value)
+        if self.shared is not None:
+            ttl = self.shared_ttl if ttl is None else min(ttl,
+                                                          self.shared_ttl)
+            if ttl > 0:
+                self.shared.set(key, value, ttl)
+
+    def cache_get(self, key: str, timeout: float or None = None,
+                  primary: bool = False) -> str:
+        if self.hot_keys is not None:
+            self.hot_keys.record_key(key)
+        if not primary:
+            value = self._get_kept(key)
+            if value is not None:
+                return value
+        if self.replicas and not primary:
+            value = self._read('cache_get', key, timeout=timeout)
+        else:
+            value = self._execute('cache', self.db_cache, 'get', key,
+                                  timeout=timeout) or None
+            if not value:
+                self.logger.debug('Key not in cache, trying to get from db')
+                try:
+                    value = self._execute('r', self.db, 'get', key,
+                                          timeout=timeout)
+                except LookupError as exc:
+                    self.logger.error('Cannot get value from db: %s' % exc)
+        if value:
+            self._keep(key, value)
         return value
 
-    def cache_set(self, key: str, value: str):
-        self.ping_reconnect(self.cache, self.db_cache)
-        self.cache.set(key, value, ex=self.ttl)
+    def cache_expiry(self) -> int:
+        """
+        Redis TTL of a new cache entry: jittered <ttl> plus <stale_ttl>.
+        """
+        jitter = self.ttl * self.ttl_jitter
+        return max(int(self.ttl + random.uniform(-jitter, jitter)), 1) \
+            + self.stale_ttl
+
+    def cache_lookup(self, key: str, timeout: float or None = None,
+                     primary: bool = False) -> tuple:
+        """
+        Cached value of <key> (None if missing) and whether it is stale,
+        i.e. in the last <stale_ttl> seconds of its life and due for
+        a refresh. Value and TTL are read in one round trip.
+        """
+        if self.hot_keys is not None:
+            self.hot_keys.record_key(key)
+        if not primary:
+            value = self._get_kept(key)
+            if value is not None:
+                return value, False
+        if self.replicas and not primary:
+            return self._read('cache_lookup', key, timeout=timeout)
+        value, ttl = self._execute('cache', self.db_cache, _get_with_ttl,
+                                   key, timeout=timeout)
+        if not value:
+            # as in cache_get, the key may be kept in the db
+            value = self._execute('r', self.db, 'get', key, timeout=timeout)
+            return value, False
+        stale = 0 <= ttl < self.stale_ttl
+        if not stale:
+            # not kept past the point it turns stale
+            self._keep(key, value, ttl - self.stale_ttl if ttl >= 0
+                       else None)
+        return value, stale
+
+    def cache_set(self, key: str, value: str,
+                  timeout: float or None = None):
+        self._execute('cache', self.db_cache, 'set', key, value,
+                      ex=self.cache_expiry(), timeout=timeout)
+        if self.local is not None:
+            self.local.discard(key)
+        if self.shared is not None:
+            self.shared.discard(key)
+
+    def cache_get_many(self, keys: list, timeout: float or None = None,
+                       primary: bool = False) -> dict:
+        """
+        Batch cache_get: one MGET on the cache, one more on the db
+        for the keys not found in cache. Missing keys are mapped to None.
+        """
+        if not keys:
+            return {}
+        if self.hot_keys is not None:
+            self.hot_keys.record_keys(keys)
+        if self.replicas and not primary:
+            return self._read('cache_get_many', keys, timeout=timeout)
+        values = self._execute('cache', self.db_cache, 'mget', keys,
+                               timeout=timeout)
+        result = dict(zip(keys, values))
+        missed = [key for key, value in result.items() if not value]
+        if missed:
+            self.logger.debug('%d keys not in cache, trying to get from db'
+                              % len(missed))
+            result.update(zip(missed, self._execute(
+                'r', self.db, 'mget', missed, timeout=timeout
+            )))
+        return result
+
+    def cache_set_many(self, mapping: dict, timeout: float or None = None):
+        if mapping:
+            self._execute('cache', self.db_cache, _set_many, mapping,
+                          ex=self.cache_expiry, timeout=timeout)
+
+    def cache_scan(self, match: str or None = None, count: int = 1000):
+        """
+        Iterate over cache keys with SCAN, without blocking Redis.
+        """
+        return self.cache.scan_iter(match=match, count=count)
+
+    def cache_delete(self, keys: list) -> int:
+        """
+        Remove cache keys with UNLINK (memory is freed in background).
+        """
+        if not keys:
+            return 0
+        return self._execute('cache', self.db_cache, 'unlink', *keys)
 
-    def get(self, key: str) -> str:
-        self.ping_reconnect(self.r, self.db)
-        value = self.r.get(key)
+    def get(self, key: str, timeout: float or None = None,
+            primary: bool = False) -> str:
+        if self.hot_keys is not None:
+            self.hot_keys.record_key(key)
+        if self.negative is not None and key in self.negative:
+            raise LookupError(f'No key {key} in database')
+        if not primary:
+            value = self._get_kept(key)
+            if value is not None:
+                return value
+        if self.replicas and not primary:
+            try:
+                value = self._read('get', key, timeout=timeout)
+            except LookupError:
+                value = None
+        else:
+            value = self._execute('r', self.db, 'get', key, timeout=timeout)
         if value is None:
+            if self.negative is not None:
+                self.negative.add(key)
             raise LookupError(f'No key {key} in database')
+        self._keep(key, value)
         return value
 
-    def set(self, key: str, value: str) -> bool:
-        self.ping_reconnect(self.r, self.db)
-        return self.r.set(key, value)
+    def get_many(self, keys: list, timeout: float or None = None,
+                 primary: bool = False) -> dict:
+        """
+        Read several keys with one MGET. Missing keys are mapped to None.
+        """
+        if self.hot_keys is not None:
+            self.hot_keys.record_keys(keys)
+        result = dict.fromkeys(keys)
+        if self.negative is not None:
+            keys = [key for key in keys if key not in self.negative]
+        if not keys:
+            return result
+        if self.replicas and not primary:
+            values = self._read('get_many', keys, timeout=timeout)
+        else:
+            values = dict(zip(keys, self._execute('r', self.db, 'mget', keys,
+                                                  timeout=timeout)))
+        result.update(values)
+        if self.negative is not None:
+            for key, value in values.items():
+                if value is None:
+                    self.negative.add(key)
+        return result
+
+    def set(self, key: str, value: str,
+            timeout: float or None = None) -> bool:
+        result = self._execute('r', self.db, 'set', key, value,
+                               timeout=timeout)
+        self.invalidate(key)
+        return result
+
+    def delete(self, key: str, timeout: float or None = None) -> int:
+        result = self._execute('r', self.db, 'delete', key, timeout=timeout)
+        self.invalidate(key)
+        return result
+
+    def scan(self, match: str or None = None, count: int = 1000):
+        """
+        Iterate over the string keys of the database with SCAN.
+        """
+        return self.r.scan_iter(match=match, count=count, _type='string')
+
+    def dump_many(self, keys: list, timeout: float or None = None) -> dict:
+        """
+        {key: (value, pttl)} of the <keys> still in the database.
+        """
+        replies = self._execute('r', self.db, _dump_many, keys,
+                                timeout=timeout)
+        return {key: (value, pttl) for key, value, pttl
+                in zip(keys, replies[::2], replies[1::2])
+                if value is not None}
+
+    def restore_many(self, mapping: dict,
+                     timeout: float or None = None) -> int:
+        """
+        Write the dump_many() <mapping> where the keys are not set yet
+        (a newer value wins). Returns the number of keys written.
+        """
+        if not mapping:
+            return 0
+        replies = self._execute('r', self.db, _restore_many, mapping,
+                                timeout=timeout)
+        for key in mapping:
+            self.invalidate(key)
+        return sum(1 for reply in replies if reply)
+
+    def delete_many(self, keys: list, timeout: float or None = None) -> int:
+        if not keys:
+            return 0
+        result = self._execute('r', self.db, 'delete', *keys,
+                               timeout=timeout)
+        for key in keys:
+            self.invalidate(key)
+        return result
+
+
+class HashRing:
+    """
+    Consistent hashing ring with virtual nodes.
+    Each node is placed on the ring <vnodes> times, so adding or removing
+    a node moves only about 1/N of the keys.
+    """
+
+    def __init__(self, nodes: list = (), vnodes: int = 100):
+        self.vnodes = vnodes
+        self._hashes = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key: str) -> int:
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def add(self, node: str):
+        for i in range(self.vnodes):
+            h = self.hash(f'{node}#{i}')
+            if h not in self._owners:
+                self._owners[h] = node
+        self._hashes = sorted(self._owners)
+
+    def remove(self, node: str):
+        self._owners = {h: n for h, n in self._owners.items() if n != node}
+        self._hashes = sorted(self._owners)
+
+    def get_node(self, key: str) -> str:
+        if not self._hashes:
+            raise LookupError('Hash ring is empty')
+        idx = bisect(self._hashes, self.hash(key)) % len(self._hashes)
+        return self._owners[self._hashes[idx]]
+
+    @property
+    def nodes(self) -> set:
+        return set(self._owners.values())
+
+
+class ShardedStore:
+    """
+    Store spreading keys across several RedisStore nodes
+    with consistent hashing. Has the same API as RedisStore.
+    Usage:
+    >>> store = ShardedStore.from_urls(['localhost:6379', 'localhost:6380'])
+    >>> store.set('i:1', '["books"]')
+    """
+
+    def __init__(self, nodes: dict, vnodes: int = 100,
+                 max_workers: int or None = None, concurrency: int = 16,
+                 logger=logging.getLogger(__name__)):
+        """
+        <nodes> is a dict {node name: RedisStore}.
+        Reads of several shards run in parallel on up to <max_workers>
+        threads, by default a thread per node for each of <concurrency>
+        callers (the request threads, see --threads).
+        """
+        self.nodes = dict(nodes)
+        self.ring = HashRing(self.nodes, vnodes=vnodes)
+        self.logger = logger
+        self.listeners = []
+        self.hot_keys = None
+        # ring before add_node() while keys are not migrated yet
+        self.previous = None
+        self.max_workers = max_workers
+        self.concurrency = concurrency
+        self._executor = self._make_executor()
+
+    def _make_executor(self) -> ThreadPoolExecutor:
+        # threads are started on demand, up to max_workers
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers
+            or max(len(self.nodes), 1) * self.concurrency,
+            thread_name_prefix='shard'
+        )
+
+    @classmethod
+    def from_urls(cls, urls: list, vnodes: int = 100, concurrency: int = 16,
+                  **store_kwargs):
+        nodes = {}
+        for url in urls:
+            nodes[url] = RedisStore(**parse_url(url), **store_kwargs)
+        return cls(nodes, vnodes=vnodes, concurrency=concurrency)
+
+    def add_node(self, name: str, store: RedisStore,
+                 migrate: bool = True) -> int:
+        """
+        Add a node to the ring. Only the keys falling on the new node's
+        arcs change owner: they are moved to it (see migrate()), with
+        <migrate> off later on. Until then reads missing on the new
+        owner fall back to the previous one.
+        Returns the number of keys moved.
+        """
+        if self.previous is None:
+            self.previous = HashRing(self.ring.nodes,
+                                     vnodes=self.ring.vnodes)
+        self.nodes[name] = store
+        self.ring.add(name)
+        if self.max_workers is None:
+            # one more thread per caller. Not shut down, the old executor
+            # may still get reads of other threads; its threads exit once
+            # it is collected
+            self._executor = self._make_executor()
+        self.logger.info('Shard %s added, %d nodes' % (name, len(self.nodes)))
+        for on_change, on_flush in self.listeners:
+            store.add_invalidation_listener(on_change, on_flush)
+            on_flush()
+        if self.hot_keys is not None:
+            store.track_hot_keys(self.hot_keys)
+        return self.migrate() if migrate else 0
+
+    def migrate(self, count: int = 1000) -> int:
+        """
+        Move the keys whose owner changed since add_node() to their new
+        owner, <count> keys per round trip. A key already written on the
+        new owner is kept there. Cache entries are not moved,
+        they are computed again.
+        Returns the number of keys moved.
+        """
+        if self.previous is None:
+            return 0
+        moved = 0
+        for name in self.previous.nodes:
+            old = self.nodes.get(name)
+            if old is None:
+                continue
+            keys = []
+            for key in old.scan(count=count):
+                if self.ring.get_node(key) != name:
+                    keys.append(key)
+                if len(keys) >= count:
+                    moved += self._move(old, keys)
+                    keys = []
+            moved += self._move(old, keys)
+        self.previous = None
+        self.logger.info('%d keys moved to new shards' % moved)
+        return moved
+
+    def _move(self, old: RedisStore, keys: list) -> int:
+        if not keys:
+            return 0
+        dump = old.dump_many(keys)
+        moved = 0
+        for node, group in self._group(dump).items():
+            moved += self.nodes[node].restore_many(
+                {key: dump[key] for key in group}
+            )
+        old.delete_many(keys)
+        return moved
+
+    def _previous_node(self, key: str) -> RedisStore or None:
+        """
+        Node owning <key> before add_node(), if keys are being migrated
+        and it is another one.
+        """
+        previous = self.previous
+        if previous is None:
+            return None
+        name = previous.get_node(key)
+        if name == self.ring.get_node(key):
+            return None
+        return self.nodes.get(name)
+
+    def remove_node(self, name: str):
+        self.ring.remove(name)
+        self.nodes.pop(name, None)
+
+    def node_for(self, key: str) -> RedisStore:
+        return self.nodes[self.ring.get_node(key)]
+
+    def ping(self) -> bool:
+        return all(store.ping() for store in self.nodes.values())
+
+    def metrics(self) -> dict:
+        return {name: store.metrics() for name, store in self.nodes.items()}
+
+    def subscribe_invalidations(self, configure: bool = False) -> list:
+        return [store.subscribe_invalidations(configure)
+                for store in self.nodes.values()]
+
+    def add_invalidation_listener(self, on_change, on_flush):
+        self.listeners.append((on_change, on_flush))
+        for store in self.nodes.values():
+            store.add_invalidation_listener(on_change, on_flush)
+
+    def track_hot_keys(self, hot_keys):
+        self.hot_keys = hot_keys
+        for store in self.nodes.values():
+            store.track_hot_keys(hot_keys)
+
+    def cache_get(self, key: str, timeout: float or None = None) -> str:
+        return self.node_for(key).cache_get(key, timeout=timeout)
+
+    def cache_lookup(self, key: str, timeout: float or None = None) -> tuple:
+        return self.node_for(key).cache_lookup(key, timeout=timeout)
+
+    def cache_set(self, key: str, value: str,
+                  timeout: float or None = None):
+        return self.node_for(key).cache_set(key, value, timeout=timeout)
+
+    def get(self, key: str, timeout: float or None = None) -> str:
+        try:
+            return self.node_for(key).get(key, timeout=timeout)
+        except LookupError:
+            old = self._previous_node(key)
+            if old is None:
+                raise
+            return old.get(key, timeout=timeout)
+
+    def _group(self, keys) -> dict:
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.get_node(key), []).append(key)
+        return groups
+
+    def _read_many(self, method: str, keys: list,
+                   timeout: float or None = None) -> dict:
+        """
+        Group keys by shard and read the groups in parallel.
+        """
+        futures = [
+            self._executor.submit(getattr(self.nodes[node], method), group,
+                                  timeout=timeout)
+            for node, group in self._group(keys).items()
+        ]
+        result = {}
+        for future in futures:
+            result.update(future.result())
+        return {key: result[key] for key in keys}
+
+    def get_many(self, keys: list, timeout: float or None = None) -> dict:
+        result = self._read_many('get_many', keys, timeout=timeout)
+        if self.previous is not None:
+            missed = {}
+            for key, value in result.items():
+                old = self._previous_node(key) if value is None else None
+                if old is not None:
+                    missed.setdefault(old, []).append(key)
+            for old, group in missed.items():
+                result.update(old.get_many(group, timeout=timeout))
+        return result
+
+    def cache_get_many(self, keys: list,
+                       timeout: float or None = None) -> dict:
+        return self._read_many('cache_get_many', keys, timeout=timeout)
+
+    def cache_set_many(self, mapping: dict, timeout: float or None = None):
+        futures = [
+            self._executor.submit(
+                self.nodes[node].cache_set_many,
+                {key: mapping[key] for key in group}, timeout=timeout
+            )
+            for node, group in self._group(mapping).items()
+        ]
+        for future in futures:
+            future.result()
+
+    def set(self, key: str, value: str,
+            timeout: float or None = None) -> bool:
+        return self.node_for(key).set(key, value, timeout=timeout)
+
+    def delete(self, key: str, timeout: float or None = None) -> int:
+        return self.node_for(key).delete(key, timeout=timeout)
+
 
-    def delete(self, key: str) -> int:
-        self.ping_reconnect(self.r, self.db)
-        return self.r.delete(key)
+def store_from_url(redis_url: str, replicas: list = (),
+                   concurrency: int = 16, **store_kwargs):
+    """
+    RedisStore for 'host:port' or 'unix:///path/to/redis.sock',
+    or ShardedStore for several comma-separated nodes, read by
+    <concurrency> threads. Connection errors raise StoreUnavailable.
+    """
+    try:
+        if ',' in redis_url:
+            return ShardedStore.from_urls(redis_url.split(','),
+                                          concurrency=concurrency,
+                                          **store_kwargs)
+        return RedisStore(**parse_url(redis_url), replicas=replicas,
+                          **store_kwargs)
+    except redis.exceptions.RedisError as exc:
+        raise StoreUnavailable(f'Cannot connect to {redis_url}: {exc}')
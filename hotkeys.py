@@ -0,0 +1,203 @@
+"""
+Hot key detection.
+
+Every key read from the store (uid: scores, i: interests) and every
+requesting account is counted in a Count-Min sketch; the most frequent
+keys of each time window are kept in a small heap. Counts are summed
+over the last few windows, so the report follows traffic changes
+with a bounded memory cost, whatever the number of distinct keys.
+"""
+import heapq
+import threading
+import time
+from collections import deque
+
+
+class CountMinSketch:
+    """
+    Approximate counter of <depth> rows of <width> counters
+    (width is rounded up to a power of two). An estimate is never below
+    the real count, and over it by at most ~2/width of the total count
+    with probability 1 - 2^-depth.
+    """
+    __slots__ = ('width', 'depth', 'mask', 'counts')
+
+    def __init__(self, width: int = 1024, depth: int = 4):
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.depth = depth
+        self.mask = self.width - 1
+        self.counts = [0] * (self.width * depth)
+
+    def _cells(self, key) -> list:
+        # row hashes derived from one hash: h1 + i * h2
+        h = hash(key)
+        h1, h2 = h & self.mask, (h >> 16) | 1
+        width, mask = self.width, self.mask
+        return [row * width + ((h1 + row * h2) & mask)
+                for row in range(self.depth)]
+
+    def add(self, key, count: int = 1) -> int:
+        """
+        Count <key>, return its new estimate.
+        """
+        # _cells inlined, this runs on every store read
+        h = hash(key)
+        h1, h2 = h & self.mask, (h >> 16) | 1
+        width, mask, counts = self.width, self.mask, self.counts
+        estimate = None
+        for row in range(self.depth):
+            cell = row * width + ((h1 + row * h2) & mask)
+            counts[cell] += count
+            if estimate is None or counts[cell] < estimate:
+                estimate = counts[cell]
+        return estimate
+
+    def estimate(self, key) -> int:
+        counts = self.counts
+        return min(counts[cell] for cell in self._cells(key))
+
+
+class _Window:
+    """
+    Sketch of one time window and the top keys seen in it.
+    """
+    __slots__ = ('sketch', 'top', 'heap', 'total')
+
+    def __init__(self, width: int, depth: int):
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}  # key: estimate
+        self.heap = []  # (estimate, key) of top keys, may lag behind top
+        self.total = 0
+
+
+class SlidingTopK:
+    """
+    Approximate <k> most frequent keys of the last <windows> windows
+    of <window> seconds (the current one included).
+    """
+
+    def __init__(self, k: int = 20, window: float = 10.0, windows: int = 6,
+                 width: int = 1024, depth: int = 4, clock=time.monotonic):
+        self.k = k
+        self.window = window
+        self.width = width
+        self.depth = depth
+        self.clock = clock
+        self.windows = deque([self._new_window()], maxlen=windows)
+        self.window_end = clock() + window
+        self.on_rotate = []
+        self._lock = threading.Lock()
+
+    def _new_window(self) -> _Window:
+        return _Window(self.width, self.depth)
+
+    def _rotate(self, now: float):
+        elapsed = int((now - self.window_end) // self.window) + 1
+        for _ in range(min(elapsed, self.windows.maxlen)):
+            self.windows.append(self._new_window())
+        self.window_end += elapsed * self.window
+
+    def add(self, key, count: int = 1):
+        now = self.clock()
+        with self._lock:
+            rotated = now >= self.window_end
+            if rotated:
+                self._rotate(now)
+            window = self.windows[-1]
+            window.total += count
+            estimate = window.sketch.add(key, count)
+            top, heap = window.top, window.heap
+            if key in top:
+                # its heap entry is updated when it gets to the top
+                top[key] = estimate
+            elif len(top) < self.k:
+                top[key] = estimate
+                heapq.heappush(heap, (estimate, key))
+            else:
+                while heap[0][0] != top[heap[0][1]]:
+                    heapq.heapreplace(heap, (top[heap[0][1]], heap[0][1]))
+                if estimate > heap[0][0]:
+                    del top[heapq.heapreplace(heap, (estimate, key))[1]]
+                    top[key] = estimate
+        if rotated:
+            for callback in self.on_rotate:
+                callback(self)
+
+    def top(self, limit: int or None = None) -> list:
+        """
+        [(key, estimated count over the live windows), ...], most
+        frequent first.
+        """
+        with self._lock:
+            windows = list(self.windows)
+            candidates = set()
+            for window in windows:
+                candidates.update(window.top)
+            counts = [
+                (sum(window.sketch.estimate(key) for window in windows), key)
+                for key in candidates
+            ]
+        counts.sort(key=lambda item: item[0], reverse=True)
+        return [(key, count) for count, key in counts[:limit or self.k]]
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(window.total for window in self.windows)
+
+
+class HotKeys:
+    """
+    Top keys by category: 'scores' (uid: keys), 'interests' (i: keys)
+    and 'accounts'. Store keys of other kinds are not tracked.
+    Keys of 'scores' and 'interests' counted <pin_min> times or more
+    are hot(); with <pin> the store keeps them in its local cache.
+    """
+    PREFIXES = (('uid:', 'scores'), ('i:', 'interests'))
+
+    def __init__(self, k: int = 20, window: float = 10.0, windows: int = 6,
+                 pin: bool = False, pin_min: int = 100, **tracker_kwargs):
+        self.k = k
+        self.pin = pin
+        self.pin_min = pin_min
+        self.trackers = {
+            name: SlidingTopK(k, window, windows, **tracker_kwargs)
+            for name in ('scores', 'interests', 'accounts')
+        }
+
+    def record_key(self, key: str):
+        for prefix, name in self.PREFIXES:
+            if key.startswith(prefix):
+                self.trackers[name].add(key)
+                return
+
+    def record_keys(self, keys):
+        for key in keys:
+            self.record_key(key)
+
+    def record_account(self, account: str):
+        self.trackers['accounts'].add(account)
+
+    def top(self, limit: int or None = None) -> dict:
+        return {
+            name: {'total': tracker.total(),
+                   'top': [{'key': key, 'count': count}
+                           for key, count in tracker.top(limit)]}
+            for name, tracker in self.trackers.items()
+        }
+
+    def hot(self) -> set:
+        """
+        Store keys counted at least <pin_min> times in the live windows.
+        """
+        return {key for _, name in self.PREFIXES
+                for key, count in self.trackers[name].top()
+                if count >= self.pin_min}
+
+    def add_listener(self, on_rotate):
+        """
+        Call on_rotate(hot keys) whenever a store key window closes.
+        """
+        for _, name in self.PREFIXES:
+            self.trackers[name].on_rotate.append(
+                lambda tracker: on_rotate(self.hot())
+            )
@@ -0,0 +1,78 @@
+"""
+Request decoding for big clients_interests requests.
+
+json.loads builds the whole client_ids list before anything is checked.
+loads_request decodes the rest of the request as usual but leaves
+a flat arguments.client_ids array undecoded (ClientIDStream): the handler
+reads ids one by one, rejecting the request at the first bad element
+and reading interests in batches as ids are decoded.
+"""
+import json
+import re
+from json.decoder import scanstring
+
+from thetypes import ClientIDStream
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+# non-empty array without strings, arrays or objects inside: its first ']'
+# closes it, so it is skipped without decoding
+_flat_array = re.compile(r'\[[ \t\n\r]*[^ \t\n\r\[\]{}"][^\[\]{}"]*\]')
+
+STREAMED_PATH = ('arguments', 'client_ids')
+
+
+def _skip(text: str, pos: int) -> int:
+    return _whitespace.match(text, pos).end()
+
+
+def _decode(text: str, pos: int, path: tuple) -> tuple:
+    """
+    Value starting at <pos> and the position after it. A flat array
+    found at <path> (keys of nested objects) is left as ClientIDStream.
+    """
+    if not path:
+        flat = _flat_array.match(text, pos)
+        if flat is not None:
+            return ClientIDStream(text, pos, flat.end()), flat.end()
+        return _decoder.raw_decode(text, pos)
+    if not text.startswith('{', pos):
+        return _decoder.raw_decode(text, pos)
+    obj = {}
+    pos = _skip(text, pos + 1)
+    if text.startswith('}', pos):
+        return obj, pos + 1
+    while True:
+        if not text.startswith('"', pos):
+            raise json.JSONDecodeError(
+                'Expecting property name enclosed in double quotes',
+                text, pos
+            )
+        key, pos = scanstring(text, pos + 1)
+        pos = _skip(text, pos)
+        if not text.startswith(':', pos):
+            raise json.JSONDecodeError("Expecting ':' delimiter", text, pos)
+        pos = _skip(text, pos + 1)
+        if key == path[0]:
+            obj[key], pos = _decode(text, pos, path[1:])
+        else:
+            obj[key], pos = _decoder.raw_decode(text, pos)
+        pos = _skip(text, pos)
+        if text.startswith('}', pos):
+            return obj, pos + 1
+        if not text.startswith(',', pos):
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, pos)
+        pos = _skip(text, pos + 1)
+
+
+def loads_request(text: str):
+    """
+    json.loads for a method request, with arguments.client_ids left
+    as ClientIDStream. Raises ValueError on malformed JSON, except inside
+    the streamed array: that one is only found out when it is read.
+    """
+    value, pos = _decode(text, _skip(text, 0), STREAMED_PATH)
+    pos = _skip(text, pos)
+    if pos != len(text):
+        raise json.JSONDecodeError('Extra data', text, pos)
+    return value
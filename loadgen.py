@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+'''
+Open-loop load generator.
+
+Requests are started on a fixed schedule (constant arrival rate) whatever
+the response times are, and latency is measured from the scheduled start,
+so a stalled server cannot hide its queueing delay (coordinated omission).
+
+Usage:
+$ python3 loadgen.py [-t, --target (default: http://localhost:8080/method/)]
+                     [-r, --rate (default: 100 requests/s)]
+                     [-d, --duration (default: 10 s)]
+                     [-m, --mix (default: 0.5, share of online_score)]
+                     [-c, --clients (default: 1000 client ids)]
+                     [--seed-interests]
+
+--target inprocess calls method_handler directly with the store from
+REDIS_URL, skipping HTTP; --target memory does the same with
+a MemoryStore, so that no Redis is needed.
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from api import create_store, get_token, method_handler
+from const import OK
+from traffic import percentile
+
+ACCOUNT = "horns&hoofs"
+LOGIN = "h&f"
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books",
+             "tv", "cinema", "geek", "otus"]
+
+
+def online_score_request(rnd: random.Random) -> dict:
+    arguments = {"phone": "79%09d" % rnd.randrange(10 ** 9),
+                 "email": "user%d@otus.ru" % rnd.randrange(10 ** 6)}
+    if rnd.random() < 0.5:
+        arguments.update(first_name="Ivan", last_name="Petrov",
+                         gender=rnd.choice((0, 1, 2)), birthday="01.01.1990")
+    return {"account": ACCOUNT, "login": LOGIN, "method": "online_score",
+            "token": get_token(ACCOUNT, LOGIN), "arguments": arguments}
+
+
+def clients_interests_request(rnd: random.Random, clients: int) -> dict:
+    client_ids = rnd.sample(range(clients), min(rnd.randint(1, 10), clients))
+    return {"account": ACCOUNT, "login": LOGIN, "method": "clients_interests",
+            "token": get_token(ACCOUNT, LOGIN),
+            "arguments": {"client_ids": client_ids, "date": "20.07.2017"}}
+
+
+class MemoryStore:
+    """
+    In-process store with the API of RedisStore used by the handlers,
+    for --target memory. Cache entries never expire.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.cache = {}
+
+    def get(self, key: str, timeout: float or None = None) -> str:
+        try:
+            return self.data[key]
+        except KeyError:
+            raise LookupError(f'No key {key} in database')
+
+    def get_many(self, keys: list, timeout: float or None = None) -> dict:
+        return {key: self.data.get(key) for key in keys}
+
+    def set(self, key: str, value: str,
+            timeout: float or None = None) -> bool:
+        self.data[key] = value
+        return True
+
+    def cache_get(self, key: str, timeout: float or None = None) -> str:
+        return self.cache.get(key)
+
+    def cache_lookup(self, key: str, timeout: float or None = None) -> tuple:
+        return self.cache.get(key), False
+
+    def cache_get_many(self, keys: list,
+                       timeout: float or None = None) -> dict:
+        return {key: self.cache.get(key) for key in keys}
+
+    def cache_set(self, key: str, value, timeout: float or None = None):
+        self.cache[key] = str(value)
+
+    def cache_set_many(self, mapping: dict, timeout: float or None = None):
+        for key, value in mapping.items():
+            self.cache_set(key, value)
+
+
+class LoadGenerator:
+
+    def __init__(self, target: str, rate: float, duration: float,
+                 mix: float = 0.5, clients: int = 1000,
+                 max_workers: int = 256, seed: int or None = None):
+        self.target = target
+        self.rate = rate
+        self.duration = duration
+        self.mix = mix
+        self.clients = clients
+        self.rnd = random.Random(seed)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.store = None
+        if target == 'inprocess':
+            self.store = create_store()
+        elif target == 'memory':
+            self.store = MemoryStore()
+        self.results = []
+        self._lock = threading.Lock()
+
+    def make_request(self) -> dict:
+        if self.rnd.random() < self.mix:
+            return online_score_request(self.rnd)
+        return clients_interests_request(self.rnd, self.clients)
+
+    def send(self, request: dict) -> int:
+        if self.store is not None:
+            _, code = method_handler({"body": request, "headers": {}}, {},
+                                     self.store)
+            return code
+        data = json.dumps(request).encode('utf-8')
+        http_request = urllib.request.Request(
+            self.target, data=data,
+            headers={"Content-Type": "application/json"}
+        )
+        try:
+            with urllib.request.urlopen(http_request, timeout=30) as answer:
+                return json.loads(answer.read())["code"]
+        except urllib.error.HTTPError as exc:
+            return exc.code
+        except OSError:
+            return 0  # connection failure
+
+    def call(self, request: dict, scheduled: float):
+        code = self.send(request)
+        latency = time.perf_counter() - scheduled
+        with self._lock:
+            self.results.append((request["method"], code, latency))
+
+    def run(self) -> dict:
+        """
+        Dispatch requests at constant rate for <duration> seconds and
+        wait for all of them to finish.
+        """
+        interval = 1 / self.rate
+        total = int(self.rate * self.duration)
+        start = time.perf_counter()
+        for i in range(total):
+            scheduled = start + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.executor.submit(self.call, self.make_request(), scheduled)
+        self.executor.shutdown(wait=True)
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed: float) -> dict:
+        latencies = sorted(latency for _, _, latency in self.results)
+        errors, methods = {}, {}
+        for method, code, _ in self.results:
+            methods[method] = methods.get(method, 0) + 1
+            if code != OK:
+                errors[code] = errors.get(code, 0) + 1
+        count = len(self.results)
+        return {
+            "requests": count,
+            "methods": methods,
+            "throughput": count / elapsed if elapsed else 0.0,
+            "error_rate": sum(errors.values()) / count if count else 0.0,
+            "errors": errors,
+            "latency_ms": {
+                name: percentile(latencies, p) * 1000
+                for name, p in (("p50", 50), ("p90", 90), ("p99", 99),
+                                ("p999", 99.9))
+            },
+        }
+
+
+def seed_interests(store, clients: int, rnd: random.Random):
+    for cid in range(clients):
+        store.set("i:%s" % cid, json.dumps(rnd.sample(INTERESTS, 2)))
+
+
+if __name__ == "__main__":
+    argpars = argparse.ArgumentParser()
+    argpars.add_argument('-t', '--target',
+                         default='http://localhost:8080/method/')
+    argpars.add_argument('-r', '--rate', type=float, default=100)
+    argpars.add_argument('-d', '--duration', type=float, default=10)
+    argpars.add_argument('-m', '--mix', type=float, default=0.5,
+                         help='share of online_score requests')
+    argpars.add_argument('-c', '--clients', type=int, default=1000)
+    argpars.add_argument('--seed-interests', action='store_true',
+                         help='write i:<cid> keys to the store first '
+                              '(REDIS_URL unless --target memory)')
+    args = argpars.parse_args()
+    loadgen = LoadGenerator(args.target, args.rate, args.duration,
+                            mix=args.mix, clients=args.clients)
+    if args.seed_interests:
+        seed_interests(loadgen.store or create_store(), args.clients,
+                       random.Random(0))
+    print(json.dumps(loadgen.run(), indent=2))
@@ -0,0 +1,98 @@
+"""
+Memory profiling with tracemalloc, driven by the admin endpoint.
+"""
+import logging
+import threading
+import tracemalloc
+
+
+class MemoryProfiler:
+    """
+    Start/stop tracemalloc, take a baseline snapshot and report the top
+    allocation sites grown since the baseline.
+    """
+
+    def __init__(self, nframes: int = 1,
+                 logger=logging.getLogger(__name__)):
+        self.nframes = nframes
+        self.logger = logger
+        self.baseline = None
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, nframes: int or None = None) -> dict:
+        with self._lock:
+            if not self.tracing:
+                tracemalloc.start(nframes or self.nframes)
+                self.logger.info('tracemalloc started')
+            self.baseline = tracemalloc.take_snapshot()
+        return self.status()
+
+    def stop(self) -> dict:
+        with self._lock:
+            tracemalloc.stop()
+            self.baseline = None
+            self.logger.info('tracemalloc stopped')
+        return self.status()
+
+    def snapshot(self) -> dict:
+        """
+        Take a new baseline for the next diff.
+        """
+        if not self.tracing:
+            raise RuntimeError('Memory tracing is not started')
+        with self._lock:
+            self.baseline = tracemalloc.take_snapshot()
+        return self.status()
+
+    def diff(self, limit: int = 10) -> list:
+        """
+        Top <limit> allocation sites by size growth since the baseline.
+        """
+        if not self.tracing or self.baseline is None:
+            raise RuntimeError('Memory tracing is not started')
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        stats = snapshot.compare_to(self.baseline, 'lineno')
+        return [
+            {
+                'site': str(stat.traceback),
+                'size': stat.size,
+                'size_diff': stat.size_diff,
+                'count': stat.count,
+                'count_diff': stat.count_diff,
+            }
+            for stat in stats[:limit]
+        ]
+
+    def status(self) -> dict:
+        if not self.tracing:
+            return {'tracing': False}
+        current, peak = tracemalloc.get_traced_memory()
+        return {'tracing': True, 'current': current, 'peak': peak}
+
+    def request_start(self) -> int or None:
+        """
+        Traced memory before a request (None if not tracing).
+        """
+        if not self.tracing:
+            return None
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def request_end(self, before: int or None, ctx: dict):
+        """
+        Put bytes allocated by the request into <ctx>: net (still held
+        after the request) and peak. Figures are process-wide, so they are
+        exact only when requests are served one at a time.
+        """
+        if before is None or not self.tracing:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        ctx.update(allocated=current - before,
+                   peak_allocated=max(peak - before, 0))
@@ -1,21 +1,57 @@
 import hashlib
 import json
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+# not the builtin TimeoutError before Python 3.11
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial
 
+from database import DeadlineExceeded, StoreUnavailable
+from const import SCORE_NAMESPACE, SCORE_MODEL_VERSION
 
-def get_score(store, phone=None, email=None, birthday=None,
-              gender=None, first_name=None, last_name=None):
+try:
+    import numpy as np
+except ImportError:  # pure Python scoring is used then
+    np = None
+
+
+def remaining(deadline) -> float or None:
+    """
+    Time budget left for a store call (None if there is no deadline).
+    """
+    return deadline.remaining() if deadline is not None else None
+
+
+def score_prefix(version: int = SCORE_MODEL_VERSION) -> str:
+    """
+    Key prefix of scores cached by the given scoring model version.
+    Bumping SCORE_MODEL_VERSION makes all older scores unreachable.
+    """
+    return f"{SCORE_NAMESPACE}:v{version}:"
+
+
+def score_key(phone=None, birthday=None, first_name=None, last_name=None,
+              **kwargs) -> str:
     key_parts = [
         first_name or "",
         last_name or "",
         phone or "",
         birthday or "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return float(score)  # score would be a str
+    digest = hashlib.blake2b("".join(key_parts).encode('utf-8'),
+                             digest_size=16).hexdigest()
+    return score_prefix() + digest
+
+
+def compute_score(phone=None, email=None, birthday=None, gender=None,
+                  first_name=None, last_name=None) -> float:
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -24,11 +60,367 @@ def get_score(store, phone=None, email=None, birthday=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
+    return score
+
+
+def score_columns(columns: dict) -> list:
+    """
+    Scores for columns of client fields ({field name: list of values}),
+    computed over presence masks. Same rules as get_score.
+    """
+    def mask(name):
+        return [bool(value) for value in columns[name]]
+
+    phone, email = mask('phone'), mask('email')
+    birthday, gender = mask('birthday'), mask('gender')
+    first_name, last_name = mask('first_name'), mask('last_name')
+    if np is not None:
+        phone, email, birthday, gender, first_name, last_name = (
+            np.array(m, dtype=bool) for m in
+            (phone, email, birthday, gender, first_name, last_name)
+        )
+        scores = (1.5 * phone + 1.5 * email + 1.5 * (birthday & gender)
+                  + 0.5 * (first_name & last_name))
+        return scores.tolist()
+    return [
+        1.5 * p + 1.5 * e + 1.5 * (b and g) + 0.5 * (f and ln)
+        for p, e, b, g, f, ln in zip(phone, email, birthday, gender,
+                                     first_name, last_name)
+    ]
+
+
+SCORE_FIELDS = ('phone', 'email', 'birthday', 'gender', 'first_name',
+                'last_name')
+
+
+class ScoringEngine(ABC):
+    """
+    Scoring model interface. Engines get client fields by name
+    (see SCORE_FIELDS), as one client for score() or as columns
+    ({field name: list of values}) for score_columns(). Engines taking
+    long should raise DeadlineExceeded after <timeout> seconds.
+    """
+
+    def score(self, timeout: float or None = None, **fields) -> float:
+        return self.score_columns(
+            {name: [fields.get(name)] for name in SCORE_FIELDS},
+            timeout=timeout
+        )[0]
+
+    @abstractmethod
+    def score_columns(self, columns: dict,
+                      timeout: float or None = None) -> list:
+        pass
+
+    def close(self):
+        pass
+
+
+class RulesEngine(ScoringEngine):
+    """
+    Additive rules over present fields: the default engine.
+    """
+
+    def score(self, timeout: float or None = None, **fields) -> float:
+        return compute_score(**fields)
+
+    def score_columns(self, columns: dict,
+                      timeout: float or None = None) -> list:
+        return score_columns(columns)
+
+
+# engine of a process pool worker, see ProcessPoolEngine
+_worker_engine = None
+
+
+def _init_worker(engine: ScoringEngine):
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _score_in_worker(columns: dict) -> list:
+    return _worker_engine.score_columns(columns)
+
+
+class ProcessPoolEngine(ScoringEngine):
+    """
+    Runs <engine> in <max_workers> processes, so that CPU-heavy scoring
+    does not hold the GIL of the serving threads. Concurrent single
+    scores are sent to a worker together, up to <batch_size> of them:
+    a batch waits up to <batch_window> seconds only for calls already
+    made, a lone score is sent at once. The pool is started on first use.
+    """
+
+    def __init__(self, engine: ScoringEngine, max_workers: int = 2,
+                 batch_size: int = 64, batch_window: float = 0.002,
+                 timeout: float = 5.0):
+        self.engine = engine
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+        self.stats = {'batches': 0, 'scored': 0}
+        self._pool = None
+        self._pending = queue.Queue()
+        # score() calls not taken into a batch yet
+        self._unbatched = 0
+        self._lock = threading.Lock()
+        self._unbatched_lock = threading.Lock()
+
+    def start(self) -> ProcessPoolExecutor:
+        """
+        Pool of the engine, started with its batcher thread on first use.
+        """
+        with self._lock:
+            if self._pool is None:
+                # forking a process running server threads is unsafe
+                self._pool = ProcessPoolExecutor(
+                    self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker, initargs=(self.engine,)
+                )
+                threading.Thread(target=self._batch_loop,
+                                 args=(self._pool,), daemon=True,
+                                 name='score-batcher').start()
+            return self._pool
+
+    def _result(self, future: Future, timeout: float or None):
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise DeadlineExceeded(f'Scoring took over {timeout:.3f}s')
+
+    def score(self, timeout: float or None = None, **fields) -> float:
+        """
+        Score of one client, batched with concurrent calls.
+        """
+        future = Future()
+        with self._unbatched_lock:
+            self._unbatched += 1
+        self.start()
+        self._pending.put((fields, future))
+        return self._result(future, timeout)
+
+    def score_columns(self, columns: dict,
+                      timeout: float or None = None) -> list:
+        future = self.start().submit(_score_in_worker, columns)
+        self.stats['batches'] += 1
+        self.stats['scored'] += len(columns['phone'])
+        return self._result(future, timeout)
+
+    def _take(self, timeout: float or None = None):
+        item = self._pending.get(timeout=timeout)
+        if item is not None:
+            with self._unbatched_lock:
+                self._unbatched -= 1
+        return item
+
+    def _next_batch(self) -> list:
+        batch = [self._take()]
+        closes = time.monotonic() + self.batch_window
+        # nobody else is scoring: no point in waiting
+        while (batch[-1] is not None and len(batch) < self.batch_size
+               and self._unbatched > 0):
+            wait = closes - time.monotonic()
+            if wait <= 0:
+                break
+            try:
+                batch.append(self._take(timeout=wait))
+            except queue.Empty:
+                break
+        return batch
+
+    def _batch_loop(self, pool: ProcessPoolExecutor):
+        closed = False
+        while not closed:
+            batch = self._next_batch()
+            if batch[-1] is None:  # close() was called
+                batch.pop()
+                closed = True
+            if not batch:
+                continue
+            columns = {name: [fields.get(name) for fields, _ in batch]
+                       for name in SCORE_FIELDS}
+            self.stats['batches'] += 1
+            self.stats['scored'] += len(batch)
+            waiters = [waiter for _, waiter in batch]
+            try:
+                future = pool.submit(_score_in_worker, columns)
+            except RuntimeError as exc:  # pool is broken
+                for waiter in waiters:
+                    waiter.set_exception(exc)
+                continue
+            future.add_done_callback(partial(_deliver, waiters))
+
+    def metrics(self) -> dict:
+        return dict(self.stats)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pending.put(None)
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+
+def _deliver(waiters: list, future: Future):
+    """
+    Pass scores of a batch (or its error) to the waiting callers.
+    """
+    error = future.exception()
+    for i, waiter in enumerate(waiters):
+        if error is not None:
+            waiter.set_exception(error)
+        else:
+            waiter.set_result(future.result()[i])
+
+
+_engine = RulesEngine()
+
+
+def get_engine() -> ScoringEngine:
+    return _engine
+
+
+def set_engine(engine: ScoringEngine) -> ScoringEngine:
+    """
+    Make <engine> score cache misses, return the previous one.
+    """
+    global _engine
+    previous, _engine = _engine, engine
+    return previous
+
+
+class Revalidator:
+    """
+    Refreshes stale cache entries in background, at most one refresh
+    per key at a time.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='revalidate')
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, refresh, *args, **kwargs) -> bool:
+        """
+        Run refresh(*args, **kwargs) unless <key> is already being
+        refreshed.
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+        self.executor.submit(self._run, key, refresh, *args, **kwargs)
+        return True
+
+    def _run(self, key: str, refresh, *args, **kwargs):
+        try:
+            refresh(*args, **kwargs)
+        except StoreUnavailable as exc:
+            logging.warning('Cannot refresh %s: %s' % (key, exc))
+        except Exception:
+            logging.exception('Cannot refresh %s' % key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+
+revalidator = Revalidator()
+
+
+def refresh_score(store, key: str, **fields):
+    store.cache_set(key, get_engine().score(**fields))
+
+
+def get_score(store, phone=None, email=None, birthday=None,
+              gender=None, first_name=None, last_name=None, deadline=None):
+    fields = dict(phone=phone, email=email, birthday=birthday,
+                  gender=gender, first_name=first_name, last_name=last_name)
+    key = score_key(**fields)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    # in degraded mode (store unavailable) score is computed without cache
+    try:
+        score, stale = store.cache_lookup(key, timeout=remaining(deadline))
+    except StoreUnavailable as exc:
+        logging.warning('Scoring without cache: %s' % exc)
+        score, cached = None, False
+    else:
+        cached = True
+    if score:
+        # stale score is served at once and refreshed in background
+        if stale:
+            revalidator.submit(key, refresh_score, store, key, **fields)
+        return float(score)  # score would be a str
+    score = get_engine().score(timeout=remaining(deadline), **fields)
     # cache for 60 minutes (ttl defined in store)
-    store.cache_set(key, score)
+    if cached:
+        try:
+            store.cache_set(key, score, timeout=remaining(deadline))
+        except StoreUnavailable as exc:
+            logging.warning('Score not cached: %s' % exc)
     return score
 
 
-def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
+def get_scores(store, columns: dict, deadline=None) -> list:
+    """
+    Batch get_score over columns of client fields.
+    Cached scores are read with one batch call, the rest are computed
+    together and cached with one more.
+    """
+    size = len(columns['phone'])
+    keys = [
+        score_key(**{name: column[i] for name, column in columns.items()})
+        for i in range(size)
+    ]
+    try:
+        cached = store.cache_get_many(keys, timeout=remaining(deadline))
+    except StoreUnavailable as exc:
+        logging.warning('Scoring without cache: %s' % exc)
+        cached, use_cache = {}, False
+    else:
+        use_cache = True
+    scores = [float(cached[key]) if cached.get(key) else None
+              for key in keys]  # cached score would be a str
+    missed = [i for i, score in enumerate(scores) if score is None]
+    to_cache = {}
+    if missed:
+        computed = get_engine().score_columns(
+            {name: [column[i] for i in missed]
+             for name, column in columns.items()},
+            timeout=remaining(deadline)
+        )
+        for i, score in zip(missed, computed):
+            scores[i] = score
+            to_cache[keys[i]] = score
+    if use_cache and to_cache:
+        try:
+            store.cache_set_many(to_cache, timeout=remaining(deadline))
+        except StoreUnavailable as exc:
+            logging.warning('Scores not cached: %s' % exc)
+    return scores
+
+
+def get_interests(store, cid, deadline=None):
+    # unknown client has no interests
+    try:
+        r = store.get("i:%s" % cid, timeout=remaining(deadline))
+    except LookupError:
+        return []
     return json.loads(r) if r else []
+
+
+def get_interests_many(store, cids: list, deadline=None) -> dict:
+    """
+    Interests of several clients read with one store call.
+    """
+    keys = ["i:%s" % cid for cid in cids]
+    values = store.get_many(keys, timeout=remaining(deadline))
+    return {
+        cid: json.loads(values[key]) if values[key] else []
+        for cid, key in zip(cids, keys)
+    }
@@ -0,0 +1,243 @@
+"""
+Cache of store values shared by the worker processes of one host.
+
+The cache is a file mapped to memory by every worker (put it on tmpfs,
+e.g. /dev/shm). Keys are hashed to buckets of WAYS slots of fixed size:
+
+header | clock hands (a byte per bucket) | buckets
+bucket: WAYS key hashes (8 bytes each) | WAYS slots
+slot:   seq, ref, key length, value length, expires | key | value
+
+Writers take a striped lock (a thread lock and a fcntl lock on one byte
+of the file per stripe of buckets). Readers take no lock: the slot seq
+is odd while the slot is written and changes with every write,
+so a reader retries when seq moved under it. A full bucket gives its
+slot to the new key with the clock algorithm: the hand skips (and
+clears) slots read since it last passed.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'SHMCACHE'
+WAYS = 8
+
+_header = struct.Struct('<8sII')  # magic, slot size, number of buckets
+_hashes = struct.Struct('<%dQ' % WAYS)
+# seq, ref, key length, value length, expires
+_slot = struct.Struct('<IBBHd')
+
+
+def instance_path(directory: str, *names: str) -> str:
+    """
+    Cache file in <directory> of the deployment identified by <names>
+    (e.g. its Redis URL) and the user: other deployments of the host
+    get their own file.
+    """
+    digest = hashlib.blake2b('\n'.join(names).encode('utf-8'),
+                             digest_size=8).hexdigest()
+    return os.path.join(directory, 'scoring-api-%d-%s.cache'
+                        % (os.getuid(), digest))
+
+
+def key_hash(key: bytes) -> int:
+    """
+    Hash of <key>, the same in every process, never 0 (an empty slot).
+    """
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(),
+                          'little') | 1
+
+
+class SharedCache:
+    """
+    Fixed-size cache of str values in the file <path>, <size> bytes
+    (rounded down to whole buckets) of <slot_size> byte slots. Values
+    not fitting in a slot with their key are not cached. The first
+    process opening the file lays it out, the others map it as is:
+    a file laid out for another size or slot size raises ValueError,
+    as processes may have it mapped.
+    """
+
+    def __init__(self, path: str, size: int = 64 * 1024 * 1024,
+                 slot_size: int = 256, stripes: int = 64,
+                 clock=time.monotonic):
+        self.path = path
+        self.slot_size = slot_size
+        self.bucket_size = _hashes.size + WAYS * slot_size
+        self.buckets = max((size - _header.size)
+                           // (self.bucket_size + 1), 1)
+        self.stripes = min(stripes, self.buckets)
+        self.clock = clock
+        self.hands = _header.size
+        self.base = self.hands + self.buckets
+        self.size = self.base + self.buckets * self.bucket_size
+        self.stats = {'hits': 0, 'misses': 0, 'sets': 0, 'evicted': 0,
+                      'too_big': 0}
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._layout()
+            self.buf = mmap.mmap(self.fd, self.size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def _layout(self):
+        header = _header.pack(MAGIC, self.slot_size, self.buckets)
+        # the stripe lock bytes double as the layout lock
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.stripes, 0)
+        try:
+            size = os.fstat(self.fd).st_size
+            if (size == self.size
+                    and os.pread(self.fd, _header.size, 0) == header):
+                return
+            if size:
+                raise ValueError(
+                    f'{self.path} holds a cache of another layout, maybe '
+                    'in use: remove it or choose another path'
+                )
+            os.ftruncate(self.fd, self.size)
+            os.pwrite(self.fd, header, 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.stripes, 0)
+
+    def _lock(self, bucket: int):
+        stripe = bucket % self.stripes
+        lock = self._locks[stripe]
+        lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, stripe)
+        return lock, stripe
+
+    def _unlock(self, lock, stripe: int):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe)
+        lock.release()
+
+    def _locate(self, key: bytes) -> tuple:
+        h = key_hash(key)
+        bucket = h % self.buckets
+        return h, bucket, self.base + bucket * self.bucket_size
+
+    def get(self, key: str, default=None):
+        key = key.encode('utf-8')
+        h, _, offset = self._locate(key)
+        buf = self.buf
+        for _ in range(3):
+            try:
+                way = _hashes.unpack_from(buf, offset).index(h)
+            except ValueError:
+                break
+            slot = offset + _hashes.size + way * self.slot_size
+            seq, _, key_len, value_len, expires = _slot.unpack_from(buf,
+                                                                    slot)
+            data = buf[slot + _slot.size:
+                       slot + _slot.size + key_len + value_len]
+            if seq & 1 or _slot.unpack_from(buf, slot)[0] != seq:
+                continue  # written meanwhile
+            if data[:key_len] != key:
+                break
+            if expires < self.clock():
+                break
+            buf[slot + 4] = 1  # referenced, see _victim
+            self.stats['hits'] += 1
+            return data[key_len:].decode('utf-8')
+        self.stats['misses'] += 1
+        return default
+
+    def _victim(self, bucket: int, offset: int, hashes: tuple) -> int:
+        """
+        Way of a bucket to put a new key in: an empty or expired slot,
+        else the first one the clock hand finds not referenced.
+        """
+        if 0 in hashes:
+            return hashes.index(0)
+        now, buf = self.clock(), self.buf
+        slots = offset + _hashes.size
+        for way in range(WAYS):
+            expires = _slot.unpack_from(buf, slots + way * self.slot_size)[4]
+            if expires < now:
+                return way
+        hand = buf[self.hands + bucket] % WAYS
+        while buf[slots + hand * self.slot_size + 4]:
+            buf[slots + hand * self.slot_size + 4] = 0
+            hand = (hand + 1) % WAYS
+        buf[self.hands + bucket] = (hand + 1) % WAYS
+        self.stats['evicted'] += 1
+        return hand
+
+    def _write(self, offset: int, way: int, h: int, seq: int,
+               data: bytes, key_len: int, expires: float):
+        buf = self.buf
+        slot = offset + _hashes.size + way * self.slot_size
+        _slot.pack_into(buf, slot, seq + 1, 0, 0, 0, 0.0)  # odd: writing
+        buf[slot + _slot.size:slot + _slot.size + len(data)] = data
+        struct.pack_into('<Q', buf, offset + way * 8, h)
+        _slot.pack_into(buf, slot, seq + 2, 0, key_len,
+                        len(data) - key_len, expires)
+
+    def set(self, key: str, value: str, ttl: float) -> bool:
+        """
+        Keep <value> for <ttl> seconds. False if it does not fit a slot.
+        """
+        key_bytes, data = key.encode('utf-8'), value.encode('utf-8')
+        if (len(key_bytes) > 255 or
+                _slot.size + len(key_bytes) + len(data) > self.slot_size):
+            self.stats['too_big'] += 1
+            self.discard(key)  # an older value may be there
+            return False
+        h, bucket, offset = self._locate(key_bytes)
+        lock, stripe = self._lock(bucket)
+        try:
+            hashes = _hashes.unpack_from(self.buf, offset)
+            if h in hashes:
+                way = hashes.index(h)
+            else:
+                way = self._victim(bucket, offset, hashes)
+            slot = offset + _hashes.size + way * self.slot_size
+            seq = _slot.unpack_from(self.buf, slot)[0]
+            self._write(offset, way, h, seq, key_bytes + data,
+                        len(key_bytes), self.clock() + ttl)
+        finally:
+            self._unlock(lock, stripe)
+        self.stats['sets'] += 1
+        return True
+
+    def discard(self, key: str):
+        h, bucket, offset = self._locate(key.encode('utf-8'))
+        lock, stripe = self._lock(bucket)
+        try:
+            hashes = _hashes.unpack_from(self.buf, offset)
+            if h in hashes:
+                way = hashes.index(h)
+                slot = offset + _hashes.size + way * self.slot_size
+                seq = _slot.unpack_from(self.buf, slot)[0]
+                self._write(offset, way, 0, seq, b'', 0, 0.0)
+        finally:
+            self._unlock(lock, stripe)
+
+    def clear(self):
+        """
+        Drop all entries, for every process.
+        """
+        for lock in self._locks:
+            lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.stripes, 0)
+        try:
+            empty = bytes(_hashes.size)
+            for bucket in range(self.buckets):
+                offset = self.base + bucket * self.bucket_size
+                self.buf[offset:offset + _hashes.size] = empty
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.stripes, 0)
+            for lock in self._locks:
+                lock.release()
+
+    def metrics(self) -> dict:
+        return dict(self.stats, slots=self.buckets * WAYS, path=self.path)
+
+    def close(self):
+        self.buf.close()
+        os.close(self.fd)
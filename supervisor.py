@@ -0,0 +1,323 @@
+"""
+Prefork supervisor: worker recycling and graceful restart.
+
+The supervisor owns the listening socket and runs worker processes that
+inherit it. Signals:
+* SIGHUP - reload: start a new generation of workers, then drain the old;
+* SIGTERM, SIGINT - drain all workers and exit.
+Workers exit after <max_requests> requests or when RSS grows over
+<max_rss> MB, and are replaced by the supervisor.
+The listening address is a ('host', port) tuple or a unix socket path.
+"""
+import logging
+import os
+import select
+import signal
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import threading
+import time
+from http.server import HTTPServer
+
+
+def get_rss() -> int:
+    """
+    Resident set size of the current process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # peak RSS, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def remove_stale_socket(path: str):
+    """
+    Remove a unix socket left at <path> by a previous run.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def bind_socket(address) -> socket.socket:
+    """
+    Listening socket on a ('host', port) <address> or a unix socket path.
+    """
+    if isinstance(address, str):
+        remove_stale_socket(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+        sock.listen()
+        return sock
+    return socket.create_server(address, reuse_port=False)
+
+
+def format_address(address) -> str:
+    if isinstance(address, str):
+        return 'unix:%s' % address
+    return '%s:%s' % address[:2]
+
+
+class UnixSocketMixin:
+    """
+    HTTPServer support for unix sockets: peers have no address,
+    so the socket path is given to handlers for logging.
+    """
+
+    def get_request(self):
+        request, client_address = self.socket.accept()
+        if self.socket.family == socket.AF_UNIX:
+            client_address = (self.server_address, 0)
+        return request, client_address
+
+
+class BoundedThreadingMixIn(socketserver.ThreadingMixIn):
+    """
+    Handle each request in a thread of its own, <max_threads> at most:
+    when all of them are busy, the next connection is not accepted
+    until one is done. server_close() waits for in-flight requests.
+    """
+    max_threads = 16
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, '_slots'):
+            self._slots = threading.BoundedSemaphore(self.max_threads)
+        self._slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+
+class ThreadedHTTPServer(BoundedThreadingMixIn, HTTPServer):
+    pass
+
+
+class UnixHTTPServer(BoundedThreadingMixIn, UnixSocketMixin, HTTPServer):
+    """
+    HTTPServer listening on a unix socket path, e.g. behind a local
+    proxy.
+    """
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        remove_stale_socket(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = self.server_address, 0
+
+    def server_close(self):
+        super().server_close()
+        remove_stale_socket(self.server_address)
+
+
+class WorkerHTTPServer(BoundedThreadingMixIn, UnixSocketMixin, HTTPServer):
+    """
+    HTTPServer on an inherited listening socket, <max_threads> requests
+    at a time. Serves until stopped by SIGTERM (in-flight requests are
+    finished first) or until it is due for recycling.
+    """
+    # wake up regularly to check stop flag and limits
+    timeout = 0.5
+
+    def __init__(self, sock: socket.socket, handler_class,
+                 max_requests: int = 0, max_rss: int = 0,
+                 max_threads: int = BoundedThreadingMixIn.max_threads,
+                 logger=logging.getLogger(__name__)):
+        self.address_family = sock.family
+        self.max_threads = max_threads
+        super().__init__(sock.getsockname(), handler_class,
+                         bind_and_activate=False)
+        self.socket.close()
+        # the socket is shared by all workers: when another worker has
+        # taken the connection, accept() times out instead of blocking
+        # (a non-blocking socket would make handle_request() spin)
+        sock.settimeout(self.timeout)
+        self.socket = sock
+        if sock.family == socket.AF_UNIX:
+            self.server_name, self.server_port = self.server_address, 0
+        else:
+            self.server_name, self.server_port = self.server_address[:2]
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.logger = logger
+        self.handled = 0
+        self.stopping = False
+
+    def process_request(self, request, client_address):
+        super().process_request(request, client_address)
+        self.handled += 1
+
+    def handle_timeout(self):
+        pass
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def should_recycle(self) -> bool:
+        if self.max_requests and self.handled >= self.max_requests:
+            self.logger.info('Worker %s served %d requests, recycling'
+                             % (os.getpid(), self.handled))
+            return True
+        if self.max_rss and get_rss() > self.max_rss * 1024 * 1024:
+            self.logger.info('Worker %s RSS is over %d MB, recycling'
+                             % (os.getpid(), self.max_rss))
+            return True
+        return False
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping and not self.should_recycle():
+            self.handle_request()
+        self.server_close()
+
+
+def run_worker(handler_class, fd: int, ready_fd: int or None = None,
+               max_requests: int = 0, max_rss: int = 0,
+               max_threads: int = BoundedThreadingMixIn.max_threads):
+    """
+    Worker process entry point: serve on the inherited socket <fd>
+    and report readiness by writing to <ready_fd>.
+    """
+    sock = socket.socket(fileno=fd)
+    server = WorkerHTTPServer(sock, handler_class,
+                              max_requests=max_requests, max_rss=max_rss,
+                              max_threads=max_threads)
+    logging.info('Worker %s started' % os.getpid())
+    if ready_fd is not None:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+    server.serve()
+    logging.info('Worker %s stopped after %d requests'
+                 % (os.getpid(), server.handled))
+
+
+class Supervisor:
+
+    def __init__(self, address: tuple, script: str, workers: int = 2,
+                 worker_args: list = (), graceful_timeout: float = 30,
+                 start_timeout: float = 10,
+                 logger=logging.getLogger(__name__)):
+        """
+        Supervise <workers> processes running <script> with <worker_args>.
+        The script should call run_worker() given --worker-fd and
+        --ready-fd options.
+        """
+        self.address = address
+        self.script = script
+        self.nworkers = workers
+        self.worker_args = list(worker_args)
+        self.graceful_timeout = graceful_timeout
+        self.start_timeout = start_timeout
+        self.logger = logger
+        self.workers = []
+        self.draining = []
+        self.stopping = False
+        self.reloading = False
+        self.sock = bind_socket(address)
+        self.sock.set_inheritable(True)
+
+    def spawn(self) -> subprocess.Popen:
+        """
+        Start a worker and wait until it is ready to accept connections.
+        """
+        ready_r, ready_w = os.pipe()
+        fd = self.sock.fileno()
+        command = [sys.executable, self.script,
+                   '--worker-fd', str(fd), '--ready-fd', str(ready_w)]
+        worker = subprocess.Popen(command + self.worker_args,
+                                  pass_fds=(fd, ready_w))
+        os.close(ready_w)
+        ready, _, _ = select.select([ready_r], [], [], self.start_timeout)
+        if not ready or not os.read(ready_r, 1):
+            self.logger.error('Worker %s did not start' % worker.pid)
+        os.close(ready_r)
+        self.logger.info('Worker %s spawned' % worker.pid)
+        return worker
+
+    def reload(self):
+        """
+        Start a new generation of workers, then drain the old one.
+        """
+        self.logger.info('Reloading workers')
+        old, self.workers = self.workers, []
+        for i in range(self.nworkers):
+            self.workers.append(self.spawn())
+        self.drain(old)
+
+    def drain(self, workers: list):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        self.draining.extend(workers)
+
+    def on_reload(self, *args):
+        self.reloading = True
+
+    def on_stop(self, *args):
+        self.stopping = True
+
+    def reap(self):
+        for worker in list(self.draining):
+            if worker.poll() is not None:
+                self.draining.remove(worker)
+        for worker in list(self.workers):
+            if worker.poll() is not None:
+                self.logger.info('Worker %s exited with %s'
+                                 % (worker.pid, worker.returncode))
+                self.workers.remove(worker)
+                if not self.stopping:
+                    self.workers.append(self.spawn())
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.on_reload)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        self.logger.info('Supervisor %s serving %s with %d workers'
+                         % (os.getpid(), format_address(self.address),
+                            self.nworkers))
+        for i in range(self.nworkers):
+            self.workers.append(self.spawn())
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            self.reap()
+            time.sleep(0.2)
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Let workers finish in-flight requests, kill them after
+        <graceful_timeout>.
+        """
+        self.logger.info('Draining %d workers' % len(self.workers))
+        self.drain(self.workers)
+        self.workers = []
+        deadline = time.monotonic() + self.graceful_timeout
+        for worker in self.draining:
+            try:
+                worker.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.logger.warning('Killing worker %s' % worker.pid)
+                worker.kill()
+        self.draining = []
+        self.sock.close()
+        if isinstance(self.address, str):
+            remove_stale_socket(self.address)
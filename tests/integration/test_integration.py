@@ -1,13 +1,30 @@
 import os
 import hashlib
 import datetime
+import http.client
+import io
+import json
+import threading
 import unittest
-from unittest.mock import MagicMock
+from email.message import Message
+from unittest.mock import MagicMock, patch
 
-from api import method_handler
-from database import RedisStore
+from api import (METHODS, AnswerCache, create_app, create_store, get_token,
+                 interests_cache_key, method_handler, register_method)
+from database import RedisStore, StoreUnavailable
+from hotkeys import HotKeys
+from supervisor import ThreadedHTTPServer
 from tests.utils import cases
-from const import ADMIN_LOGIN, ADMIN_SALT, SALT, INVALID_REQUEST, FORBIDDEN, OK
+from const import (ADMIN_LOGIN, ADMIN_SALT, SALT, INVALID_REQUEST, FORBIDDEN,
+                   OK, BAD_REQUEST, LENGTH_REQUIRED, REQUEST_ENTITY_TOO_LARGE,
+                   MAX_BODY_SIZES, NOT_FOUND, SERVICE_UNAVAILABLE,
+                   TOO_MANY_REQUESTS, STREAM_MIN_BODY,
+                   INTERESTS_BATCH_SIZE)
+from thetypes import CharField, Request
+
+
+class EchoRequest(Request):
+    text = CharField(required=True, nullable=False)
 
 
 class TestSuite(unittest.TestCase):
@@ -175,6 +192,46 @@ class TestSuite(unittest.TestCase):
         score = response.get("score")
         self.assertEqual(score, 42)
 
+    @cases([
+        {},
+        {"clients": []},
+        {"clients": {"phone": "79175002040"}},
+        {"clients": [{"phone": "79175002040", "email": "stupnikov@otus.ru"},
+                     {"phone": "79175002040"}]},
+        {"clients": [{"phone": "89175002040", "email": "stupnikov@otus.ru"}]},
+    ])
+    def test_invalid_score_batch_request(self, arguments):
+        request = {
+            "account": "horns&hoofs", "login": "h&f",
+            "method": "online_score_batch", "arguments": arguments
+        }
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(INVALID_REQUEST, code, arguments)
+        self.assertTrue(len(response))
+
+    def test_ok_score_batch_request(self):
+        clients = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+            {"phone": 79175002040, "email": "stupnikov@otus.ru"},
+            {"gender": 1, "birthday": "01.01.2000",
+             "first_name": "a", "last_name": "b"},
+            {"gender": 0, "birthday": "01.01.2000"},
+            {"first_name": "a", "last_name": "b"},
+        ]
+        request = {
+            "account": "horns&hoofs", "login": "h&f",
+            "method": "online_score_batch", "arguments": {"clients": clients}
+        }
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(OK, code, response)
+        self.assertEqual(response["scores"], [3.0, 3.0, 2.0, 0.0, 0.5])
+        self.assertEqual(self.context["nclients"], len(clients))
+        # second call is served from cache
+        response, code = self.get_response(request)
+        self.assertEqual(response["scores"], [3.0, 3.0, 2.0, 0.0, 0.5])
+
     @cases([
         {},
         {"date": "20.07.2017"},
@@ -228,3 +285,444 @@ class TestSuite(unittest.TestCase):
     def tearDown(self):
         self.store.r.flushdb()
         self.store.cache.flushdb()
+
+
+def post(app, body: bytes, length=None, path='/method/', command='POST'):
+    """
+    Run <app> handler on a request not bound to a real socket.
+    """
+    handler = app.__new__(app)
+    handler.path = path
+    handler.headers = Message()
+    if length is not None:
+        handler.headers['Content-Length'] = str(length)
+    handler.rfile = io.BytesIO(body)
+    handler.wfile = io.BytesIO()
+    handler.request_version = 'HTTP/1.1'
+    handler.requestline = '%s %s HTTP/1.1' % (command, path)
+    handler.client_address = ('127.0.0.1', 0)
+    handler.command = command
+    handler.close_connection = False
+    handler.log_message = MagicMock()
+    getattr(handler, 'do_' + command)()
+    answer = handler.wfile.getvalue().split(b'\r\n\r\n', 1)[1]
+    return json.loads(answer), handler
+
+
+class TestHTTPHandler(unittest.TestCase):
+    """
+    Handler not bound to a real socket, with a mocked store
+    """
+
+    def setUp(self):
+        self.store = MagicMock()
+        self.store.metrics = MagicMock(return_value={})
+        self.app = create_app(store=self.store)
+
+    def post(self, body: bytes, length=None, path='/method/',
+             command='POST'):
+        return post(self.app, body, length, path, command)
+
+    @cases([
+        (b'{"a": 1}', None, LENGTH_REQUIRED),
+        (b'{"a": 1}', 'abc', BAD_REQUEST),
+        (b'{"a": 1}', -1, BAD_REQUEST),
+        (b'{"a": 1}', '\u00b2', BAD_REQUEST),
+        (b'{"a": 1}', 100, BAD_REQUEST),
+        (b'{"a": ', 6, BAD_REQUEST),
+        (b'', MAX_BODY_SIZES['method'] + 1, REQUEST_ENTITY_TOO_LARGE),
+    ])
+    def test_bad_body(self, body, length, code):
+        answer, _ = self.post(body, length)
+        self.assertEqual(answer['code'], code)
+
+    def test_body_not_read_if_too_large(self):
+        body = b'x' * 10
+        answer, handler = self.post(body, MAX_BODY_SIZES['method'] + 1)
+        self.assertEqual(answer['code'], REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(handler.rfile.tell(), 0)
+        self.assertTrue(handler.close_connection)
+
+    @cases([
+        ('online_score', {"first_name": "a" * 1100000, "gender": 1,
+                          "birthday": "01.01.2000"},
+         REQUEST_ENTITY_TOO_LARGE),
+        ('online_score_batch', {"clients": [
+            {"phone": "79175002040", "email": "client%d@otus.ru" % i,
+             "first_name": "Name%d" % i, "last_name": "Surname%d" % i,
+             "birthday": "01.01.1990", "gender": i % 3}
+            for i in range(10000)
+        ]}, OK),
+    ])
+    def test_method_body_limit(self, method, arguments, code):
+        """
+        Bodies over 1 MB are only accepted for <method> allowing them
+        """
+        request = {"login": ADMIN_LOGIN, "method": method,
+                   "token": get_token(None, ADMIN_LOGIN, is_admin=True),
+                   "arguments": arguments}
+        body = json.dumps(request).encode('utf-8')
+        self.assertGreater(len(body), 1024 * 1024)
+        answer, _ = self.post(body, len(body))
+        self.assertEqual(answer['code'], code)
+
+    def test_buffer_reused(self):
+        body = b'{"login": "h&f"}'
+        self.post(body, len(body))
+        buf = self.app.buffers.queue[0]
+        answer, _ = self.post(body, len(body))
+        self.assertEqual(self.app.buffers.queue, [buf])
+        self.assertIs(self.app.buffers.queue[0], buf)
+        self.assertEqual(answer['code'], INVALID_REQUEST)
+
+    def test_buffer_reused_served(self):
+        """
+        Requests served in threads of their own share the buffer
+        """
+        self.app.log_message = lambda *args: None
+        server = ThreadedHTTPServer(('localhost', 0), self.app)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        buffers = []
+        try:
+            for _ in range(20):
+                client = http.client.HTTPConnection(*server.server_address)
+                client.request('POST', '/method/', '{"login": "h&f"}')
+                client.getresponse().read()
+                client.close()
+                buffers.extend(getattr(self.app.buffers, 'queue', ()))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(len(buffers), 20)
+        self.assertEqual(len({id(buf) for buf in buffers}), 1)
+
+    @cases([('/health/', OK), ('/ready/', OK), ('/spam/', NOT_FOUND)])
+    def test_probes(self, path, code):
+        answer, _ = self.post(b'', path=path, command='GET')
+        self.assertEqual(answer['code'], code)
+
+    def test_not_ready(self):
+        self.store.ping = MagicMock(side_effect=StoreUnavailable('down'))
+        answer, _ = self.post(b'', path='/ready/', command='GET')
+        self.assertEqual(answer['code'], SERVICE_UNAVAILABLE)
+        answer, _ = self.post(b'', path='/health/', command='GET')
+        self.assertEqual(answer['code'], OK)
+
+    def test_memory_endpoint_off_by_default(self):
+        body = b'{"login": "admin"}'
+        answer, _ = self.post(body, len(body), path='/admin/memory/')
+        self.assertEqual(answer['code'], NOT_FOUND)
+        self.assertIsNone(self.app.memprof)
+
+    def test_memory_endpoint(self):
+        self.app = create_app(store=self.store, memprof=True)
+        request = {"login": ADMIN_LOGIN, "method": "start",
+                   "token": get_token(None, ADMIN_LOGIN, is_admin=True),
+                   "arguments": {"limit": 3}}
+        try:
+            for action in ('start', 'snapshot', 'diff'):
+                request["method"] = action
+                body = json.dumps(request).encode('utf-8')
+                answer, _ = self.post(body, len(body), path='/admin/memory/')
+                self.assertEqual(answer['code'], OK, answer)
+            self.assertLessEqual(len(answer['response']['top']), 3)
+            ctx = {}
+            before = self.app.memprof.request_start()
+            spam = [bytearray(1000) for i in range(100)]
+            self.app.memprof.request_end(before, ctx)
+            self.assertGreater(ctx['allocated'], 100000)
+            del spam
+        finally:
+            self.app.memprof.stop()
+
+    def test_memory_endpoint_needs_admin(self):
+        self.app = create_app(store=self.store, memprof=True)
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "token": get_token("horns&hoofs", "h&f"),
+                   "method": "start", "arguments": {}}
+        body = json.dumps(request).encode('utf-8')
+        answer, _ = self.post(body, len(body), path='/admin/memory/')
+        self.assertEqual(answer['code'], FORBIDDEN)
+
+    def test_hot_keys_endpoint(self):
+        self.app = create_app(store=self.store, hot_keys=HotKeys(k=2))
+        self.store.track_hot_keys.assert_called_once_with(self.app.hot_keys)
+        self.app.hot_keys.record_keys(['i:1', 'i:2', 'i:2'])
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "token": get_token("horns&hoofs", "h&f"),
+                   "method": "top", "arguments": {}}
+        body = json.dumps(request).encode('utf-8')
+        answer, _ = self.post(body, len(body), path='/admin/hotkeys/')
+        self.assertEqual(answer['code'], FORBIDDEN)
+        request.update(login=ADMIN_LOGIN, arguments={"limit": 1},
+                       token=get_token(None, ADMIN_LOGIN, is_admin=True))
+        body = json.dumps(request).encode('utf-8')
+        answer, _ = self.post(body, len(body), path='/admin/hotkeys/')
+        self.assertEqual(answer['code'], OK)
+        response = answer['response']
+        self.assertEqual(response['interests']['top'],
+                         [{'key': 'i:2', 'count': 2}])
+        self.assertEqual(response['accounts']['top'][0]['key'],
+                         'horns&hoofs')
+        answer, _ = self.post(body, len(body), path='/admin/memory/')
+        self.assertEqual(answer['code'], NOT_FOUND)
+
+    def test_lazy_store(self):
+        factory = MagicMock(return_value=self.store)
+        app = create_app(store_factory=factory)
+        factory.assert_not_called()
+        self.assertIs(app.get_store(), self.store)
+        self.assertIs(app.get_store(), self.store)
+        factory.assert_called_once()
+
+    def test_redis_down_at_start(self):
+        """
+        The store is made once and scores are computed without the cache
+        """
+        factory = MagicMock(side_effect=create_store)
+        with patch.dict(os.environ, {'REDIS_URL': 'localhost:6399'}):
+            app = create_app(store_factory=factory)
+            request = {"account": "horns&hoofs", "login": "h&f",
+                       "token": get_token("horns&hoofs", "h&f"),
+                       "method": "online_score",
+                       "arguments": {"phone": "79175002040",
+                                     "email": "stupnikov@otus.ru"}}
+            body = json.dumps(request).encode('utf-8')
+            answers = [post(app, body, len(body))[0] for _ in range(3)]
+        self.assertEqual(answers, [{'code': OK,
+                                    'response': {'score': 3.0}}] * 3)
+        factory.assert_called_once()
+
+    def test_capture(self):
+        self.app.capture = MagicMock()
+        self.app.capture.sampled = MagicMock(return_value=True)
+        body = b'{"a": 1}'
+        answer, _ = self.post(body, len(body))
+        self.post(b'', MAX_BODY_SIZES['method'] + 1)
+        self.app.capture.record.assert_called_once()
+        _, path, data, code, latency, _ = \
+            self.app.capture.record.call_args[0]
+        self.assertEqual((path, data, code), ('method', '{"a": 1}',
+                                              answer['code']))
+        self.assertTrue(latency > 0)
+
+
+class TestAnswerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MagicMock()
+        self.store.get = MagicMock(return_value='["books"]')
+        self.app = create_app(store=self.store, answer_cache=AnswerCache())
+        self.request = {"account": "horns&hoofs", "login": "h&f",
+                        "method": "clients_interests",
+                        "token": get_token("horns&hoofs", "h&f"),
+                        "arguments": {"client_ids": [2, 1],
+                                      "date": "20.07.2017"}}
+
+    def post(self, request):
+        body = json.dumps(request).encode()
+        return post(self.app, body, len(body))[0]
+
+    def test_repeated_request_served_from_cache(self):
+        answer = self.post(self.request)
+        self.request["arguments"]["client_ids"] = [1, 2]
+        self.assertEqual(self.post(self.request), answer)
+        self.assertEqual(self.store.get.call_count, 2)
+        self.assertEqual(self.app.answer_cache.metrics()['hits'], 1)
+
+    def test_invalidated_on_key_change(self):
+        self.post(self.request)
+        listener, _ = self.store.add_invalidation_listener.call_args[0]
+        listener('i:1')
+        self.post(self.request)
+        self.assertEqual(self.store.get.call_count, 4)
+
+    def test_subscribed(self):
+        self.store.subscribe_invalidations.assert_called_once()
+
+    def test_score_keys_do_not_invalidate(self):
+        cache = AnswerCache()
+        generation = cache.generation
+        cache.invalidate('uid:v1:abc')
+        cache.set('a', b'answer', ['i:1'], generation)
+        self.assertEqual(cache.get('a'), b'answer')
+
+    def test_token_checked(self):
+        self.post(self.request)
+        self.request["token"] = "bad"
+        self.assertEqual(self.post(self.request)["code"], FORBIDDEN)
+
+    def test_errors_not_cached(self):
+        self.store.get = MagicMock(side_effect=StoreUnavailable('down'))
+        self.post(self.request)
+        self.assertEqual(self.app.answer_cache.metrics()['entries'], 0)
+
+    @cases([
+        {"method": "online_score", "arguments": {"client_ids": [1]}},
+        {"method": "clients_interests", "arguments": {"client_ids": ["1"]}},
+        {"method": "clients_interests",
+         "arguments": {"client_ids": [1], "extra": 1}},
+    ])
+    def test_not_cacheable(self, body):
+        self.assertIsNone(interests_cache_key(body))
+
+    def test_memory_bound(self):
+        cache = AnswerCache(max_bytes=10)
+        cache.set('a', b'12345', ['i:1'], cache.generation)
+        cache.set('b', b'12345', ['i:2'], cache.generation)
+        cache.get('a')
+        cache.set('c', b'12345', ['i:3'], cache.generation)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'12345')
+        self.assertEqual(cache.size, 10)
+
+    def test_no_set_after_invalidation(self):
+        cache = AnswerCache()
+        generation = cache.generation
+        cache.invalidate('i:1')
+        cache.set('a', b'stale', ['i:1'], generation)
+        self.assertIsNone(cache.get('a'))
+
+
+class TestStreamedInterests(unittest.TestCase):
+    """
+    clients_interests bodies over STREAM_MIN_BODY
+    """
+
+    def setUp(self):
+        self.store = MagicMock()
+        self.store.get_many = MagicMock(side_effect=lambda keys, timeout: {
+            key: '["books"]' if key != 'i:0' else None for key in keys
+        })
+        self.app = create_app(store=self.store)
+        self.client_ids = list(range(STREAM_MIN_BODY // 5))
+
+    def post(self, client_ids: str):
+        body = ('{"account": "horns&hoofs", "login": "h&f", '
+                '"method": "clients_interests", "token": "%s", '
+                '"arguments": {"client_ids": %s}}'
+                % (get_token("horns&hoofs", "h&f"), client_ids)).encode()
+        self.assertGreaterEqual(len(body), STREAM_MIN_BODY)
+        return post(self.app, body, len(body))[0]
+
+    def test_ok(self):
+        answer = self.post(json.dumps(self.client_ids + [5, 1]))
+        self.assertEqual(answer['code'], OK)
+        response = answer['response']
+        self.assertEqual(len(response), len(self.client_ids))
+        self.assertEqual((response['0'], response['1']), ([], ['books']))
+        batches = [call[0][0] for call in self.store.get_many.call_args_list]
+        self.assertEqual(len(batches[0]), INTERESTS_BATCH_SIZE)
+        self.assertEqual(sum(map(len, batches)), len(self.client_ids))
+
+    def test_rejected_at_first_bad_element(self):
+        client_ids = self.client_ids[:]
+        client_ids[INTERESTS_BATCH_SIZE + 1] = 1.5
+        answer = self.post(json.dumps(client_ids))
+        self.assertEqual(answer['code'], INVALID_REQUEST)
+        self.assertIn('element %s' % (INTERESTS_BATCH_SIZE + 1),
+                      answer['error'])
+        # the first batch was read before the bad element was decoded
+        self.assertEqual(self.store.get_many.call_count, 1)
+
+    @cases(['[1, , 2%s]', '[1%s, x]'])
+    def test_malformed(self, client_ids):
+        padding = ', 1' * STREAM_MIN_BODY
+        answer = self.post(client_ids % padding)
+        self.assertEqual(answer['code'], BAD_REQUEST)
+
+    def test_forbidden(self):
+        body = json.dumps({"account": "horns&hoofs", "login": "h&f",
+                           "method": "clients_interests", "token": "bad",
+                           "arguments": {"client_ids": self.client_ids}})
+        answer, _ = post(self.app, body.encode(), len(body))
+        self.assertEqual(answer['code'], FORBIDDEN)
+        self.store.get_many.assert_not_called()
+
+    def test_store_unavailable(self):
+        self.store.get_many = MagicMock(side_effect=StoreUnavailable('down'))
+        answer = self.post(json.dumps(self.client_ids))
+        self.assertEqual(answer['code'], SERVICE_UNAVAILABLE)
+
+
+class TestMethodRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = MagicMock(side_effect=lambda request, ctx, store,
+                                 is_admin: ({'text': request.text}, OK))
+        self.request = {"account": "horns&hoofs", "login": "h&f",
+                        "method": "echo", "arguments": {"text": "spam"}}
+        self.request["token"] = get_token("horns&hoofs", "h&f")
+
+    def register(self, **policy):
+        register_method('echo', EchoRequest, **policy)(self.handler)
+
+    def call(self, headers: dict or None = None):
+        return method_handler({"body": self.request,
+                               "headers": headers or {}}, {}, MagicMock())
+
+    def test_registered_method_dispatched(self):
+        self.register()
+        self.assertEqual(self.call(), ({'text': 'spam'}, OK))
+        self.request["arguments"] = {}
+        self.assertEqual(self.call()[1], INVALID_REQUEST)
+
+    @cases([('0.5', OK), ('0', BAD_REQUEST), ('-1', BAD_REQUEST),
+            ('abc', BAD_REQUEST), ('nan', BAD_REQUEST), ('inf', BAD_REQUEST),
+            ('-inf', BAD_REQUEST)])
+    def test_request_timeout_header(self, timeout, code):
+        self.register()
+        self.assertEqual(self.call({'X-Request-Timeout': timeout})[1], code)
+
+    def test_response_cache_policy(self):
+        self.register(cache_ttl=60)
+        self.call()
+        self.assertEqual(self.call(), ({'text': 'spam'}, OK))
+        self.handler.assert_called_once()
+
+    def test_concurrency_limit(self):
+        self.register(max_concurrency=1, timeout=0.05)
+        METHODS['echo'].slots.acquire()
+        self.assertEqual(self.call()[1], TOO_MANY_REQUESTS)
+        METHODS['echo'].slots.release()
+        self.assertEqual(self.call()[1], OK)
+
+    def test_concurrency_limit_served(self):
+        # requests served in threads reach the limit of the method
+        entered, release = threading.Event(), threading.Event()
+
+        def slow(request, ctx, store, is_admin):
+            entered.set()
+            release.wait(5)
+            return {'text': request.text}, OK
+        self.handler.side_effect = slow
+        self.register(max_concurrency=1, timeout=0.1)
+        app = create_app(store=MagicMock())
+        app.log_message = lambda *args: None
+        server = ThreadedHTTPServer(('localhost', 0), app)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+
+        def call(codes):
+            client = http.client.HTTPConnection(*server.server_address)
+            client.request('POST', '/method/', json.dumps(self.request))
+            codes.append(json.loads(client.getresponse().read())['code'])
+            client.close()
+        first, second = [], []
+        slow_call = threading.Thread(target=call, args=(first,))
+        slow_call.start()
+        entered.wait(5)
+        call(second)
+        release.set()
+        slow_call.join(5)
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        self.assertEqual((first, second), ([OK], [TOO_MANY_REQUESTS]))
+
+    def tearDown(self):
+        METHODS.pop('echo', None)
@@ -0,0 +1,45 @@
+"""
+Server run by TestSupervisor: supervises workers running this script,
+the way api.py does. GET /<seconds> answers the worker PID after
+sleeping that long. The supervisor port is printed once bound.
+"""
+import os
+import time
+from http.server import BaseHTTPRequestHandler
+from optparse import OptionParser
+
+from supervisor import Supervisor, run_worker
+
+
+class PidHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(float(self.path.strip('/') or 0))
+        body = str(os.getpid()).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option('--workers', type=int, default=2)
+    op.add_option('--max-requests', type=int, default=0)
+    op.add_option('--worker-fd', type=int, default=None)
+    op.add_option('--ready-fd', type=int, default=None)
+    opts, args = op.parse_args()
+    if opts.worker_fd is not None:
+        run_worker(PidHandler, opts.worker_fd, ready_fd=opts.ready_fd,
+                   max_requests=opts.max_requests)
+        raise SystemExit
+    supervisor = Supervisor(
+        ('localhost', 0), os.path.abspath(__file__), workers=opts.workers,
+        worker_args=['--max-requests', str(opts.max_requests)],
+        graceful_timeout=10
+    )
+    print(supervisor.sock.getsockname()[1], flush=True)
+    supervisor.run()
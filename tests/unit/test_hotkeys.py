@@ -0,0 +1,102 @@
+import random
+import unittest
+from collections import Counter
+
+from hotkeys import CountMinSketch, HotKeys, SlidingTopK
+from tests.utils import cases
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def zipf_keys(n: int, seed: int = 1) -> list:
+    rnd = random.Random(seed)
+    return ['i:%d' % int(rnd.paretovariate(1.1)) for _ in range(n)]
+
+
+class TestCountMinSketch(unittest.TestCase):
+
+    @cases([(1000, 1024), (1024, 1024), (3, 4)])
+    def test_width(self, width, rounded):
+        self.assertEqual(CountMinSketch(width).width, rounded)
+
+    def test_never_underestimates(self):
+        sketch = CountMinSketch(width=64)
+        keys = zipf_keys(5000)
+        for key in keys:
+            sketch.add(key)
+        for key, count in Counter(keys).items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+
+    def test_add_returns_estimate(self):
+        sketch = CountMinSketch()
+        sketch.add('a', 5)
+        self.assertEqual(sketch.add('a'), sketch.estimate('a'))
+
+
+class TestSlidingTopK(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.top = SlidingTopK(k=5, window=10, windows=3, clock=self.clock)
+
+    def test_top_keys(self):
+        keys = zipf_keys(20000)
+        for key in keys:
+            self.top.add(key)
+        expected = Counter(keys).most_common(5)
+        self.assertEqual([key for key, _ in self.top.top()],
+                         [key for key, _ in expected])
+        self.assertEqual(self.top.total(), len(keys))
+
+    def test_sliding_windows(self):
+        for _ in range(100):
+            self.top.add('old')
+        self.clock.now = 15
+        self.top.add('new')
+        self.assertEqual(self.top.top(), [('old', 100), ('new', 1)])
+        self.clock.now = 35  # the window of 'old' is gone
+        self.top.add('new')
+        self.assertEqual(self.top.top(), [('new', 2)])
+        self.clock.now = 1000
+        self.top.add('new')
+        self.assertEqual(self.top.top(), [('new', 1)])
+
+    def test_on_rotate(self):
+        rotated = []
+        self.top.on_rotate.append(rotated.append)
+        self.top.add('a')
+        self.clock.now = 10
+        self.top.add('a')
+        self.assertEqual(rotated, [self.top])
+
+
+class TestHotKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.hot_keys = HotKeys(k=3, pin_min=2, clock=self.clock)
+
+    def test_categories(self):
+        self.hot_keys.record_keys(['uid:v1:a', 'i:1', 'i:1', 'other'])
+        self.hot_keys.record_account('horns&hoofs')
+        top = self.hot_keys.top()
+        self.assertEqual(top['scores']['top'], [{'key': 'uid:v1:a',
+                                                 'count': 1}])
+        self.assertEqual(top['interests']['total'], 2)
+        self.assertEqual(top['accounts']['top'][0]['key'], 'horns&hoofs')
+        self.assertEqual(self.hot_keys.hot(), {'i:1'})
+
+    def test_listener_gets_hot_keys(self):
+        pinned = []
+        self.hot_keys.add_listener(pinned.append)
+        self.hot_keys.record_keys(['i:1', 'i:1', 'i:2'])
+        self.clock.now = 10
+        self.hot_keys.record_key('i:3')
+        self.assertEqual(pinned, [{'i:1'}])
@@ -0,0 +1,100 @@
+import json
+import unittest
+
+from jsonstream import loads_request
+from tests.utils import cases
+from thetypes import ClientIDStream, FieldError
+
+
+def request_text(client_ids: str, **fields) -> str:
+    fields = dict({"login": "h&f", "method": "clients_interests"}, **fields)
+    head = json.dumps(fields)[:-1]
+    return head + ', "arguments": {"client_ids": %s, "date": null}}' % (
+        client_ids
+    )
+
+
+class TestLoadsRequest(unittest.TestCase):
+
+    @cases([
+        '{"a": 1}',
+        '  {"arguments": {"client_ids": [], "date": "1.1.2000"}} ',
+        '{"arguments": {"client_ids": [1, "2", [3]]}}',
+        '{"arguments": {"client_ids": 42}}',
+        '{"arguments": null, "method": {"client_ids": [1]}}',
+        '{"arguments": {"x": {"client_ids": [1]}}}',
+        '[{"arguments": {"client_ids": [1]}}]',
+        '{}',
+    ])
+    def test_same_as_json(self, text):
+        self.assertEqual(loads_request(text), json.loads(text))
+
+    @cases([
+        '', '{', '{"a": 1} x', '{"a" 1}', '{"a": 1,}', "{'a': 1}",
+        '{"arguments": {"client_ids": [1, 2}}',
+        '{"arguments": {"client_ids": [1, 2] "date": null}}',
+    ])
+    def test_malformed(self, text):
+        with self.assertRaises(ValueError):
+            loads_request(text)
+
+    def test_client_ids_streamed(self):
+        request = loads_request(request_text('[3, 1 , 2]', token="t"))
+        client_ids = request["arguments"]["client_ids"]
+        self.assertIsInstance(client_ids, ClientIDStream)
+        self.assertEqual(list(client_ids), [3, 1, 2])
+        self.assertEqual(request["token"], "t")
+        self.assertIsNone(request["arguments"]["date"])
+
+
+class TestClientIDStream(unittest.TestCase):
+
+    def stream(self, client_ids: str) -> ClientIDStream:
+        return loads_request(request_text(client_ids))["arguments"][
+            "client_ids"
+        ]
+
+    @cases([
+        ('[1]', [1]),
+        ('[ 5,4 ,\n5, -1, 0, 12148124124 ]',
+         [5, 4, 5, -1, 0, 12148124124]),
+        ('[2, true]', [2, True]),
+    ])
+    def test_ids(self, client_ids, expected):
+        self.assertEqual(list(self.stream(client_ids)), expected)
+
+    def test_batches(self):
+        stream = self.stream(json.dumps(list(range(7)) + [1, 2, 7, 7]))
+        known, batches = {}, []
+        for batch in stream.batches(3, known=known):
+            batches.append(batch)
+            known.update(dict.fromkeys(batch))
+        self.assertEqual(batches, [[0, 1, 2], [3, 4, 5], [6, 7]])
+
+    @cases(['[1, 1.5]', '[1, null]', '[1e3]', '[1, -2.0, 3]'])
+    def test_not_integer(self, client_ids):
+        with self.assertRaises(FieldError):
+            list(self.stream(client_ids))
+
+    @cases(['[1, , 2]', '[1, 2, ]', '[01]', '[1 2]', '[1, -]', '[1, x]'])
+    def test_malformed(self, client_ids):
+        with self.assertRaises(ValueError):
+            list(self.stream(client_ids))
+
+    def test_trailing_comma_after_chunk(self):
+        # the last chunk ends at the comma
+        client_ids = '[%s1,]' % ('1,' * ClientIDStream.chunk_size)
+        with self.assertRaises(ValueError):
+            list(self.stream(client_ids))
+
+    def test_stops_at_first_bad_element(self):
+        stream = self.stream('[1, 2, 2.5, 4]')
+        decoded = []
+        with self.assertRaises(FieldError):
+            for cid in stream:
+                decoded.append(cid)
+        self.assertEqual(decoded, [1, 2])
+        # chunks after the bad element are not decoded at all
+        stream = self.stream('[1.5%s, x]' % (', 1' * stream.chunk_size))
+        with self.assertRaises(FieldError):
+            list(stream)
@@ -0,0 +1,52 @@
+import random
+import unittest
+from unittest.mock import MagicMock
+
+from api import method_handler
+from const import OK
+from loadgen import (LoadGenerator, MemoryStore, clients_interests_request,
+                     online_score_request, percentile, seed_interests)
+from tests.utils import cases
+
+
+class TestLoadGenerator(unittest.TestCase):
+
+    @cases([(50, 50), (90, 90), (99, 99), (99.9, 100), (100, 100)])
+    def test_percentile(self, p, expected):
+        self.assertEqual(percentile(list(range(1, 101)), p), expected)
+
+    def test_generated_requests_are_valid(self):
+        rnd = random.Random(0)
+        store = MagicMock()
+        store.cache_lookup = MagicMock(return_value=(None, False))
+        store.get = MagicMock(return_value='["books"]')
+        for request in (online_score_request(rnd),
+                        clients_interests_request(rnd, 100)):
+            _, code = method_handler({"body": request, "headers": {}}, {},
+                                     store)
+            self.assertEqual(code, OK, request)
+
+    def test_open_loop_schedule(self):
+        loadgen = LoadGenerator('http://localhost:0/', rate=200,
+                                duration=0.1, seed=0)
+        codes = iter([OK, 500] * 10)
+        loadgen.send = MagicMock(side_effect=lambda request: next(codes))
+        report = loadgen.run()
+        self.assertEqual(report['requests'], 20)
+        self.assertEqual(report['errors'], {500: 10})
+        self.assertEqual(report['error_rate'], 0.5)
+        self.assertEqual(set(report['latency_ms']),
+                         {'p50', 'p90', 'p99', 'p999'})
+
+    def test_memory_target(self):
+        """
+        Requests are answered in-process without Redis
+        """
+        loadgen = LoadGenerator('memory', rate=200, duration=0.1, seed=0,
+                                clients=10)
+        self.assertIsInstance(loadgen.store, MemoryStore)
+        seed_interests(loadgen.store, 10, random.Random(0))
+        report = loadgen.run()
+        self.assertEqual(report['requests'], 20)
+        self.assertEqual(report['errors'], {})
+        self.assertTrue(loadgen.store.cache)
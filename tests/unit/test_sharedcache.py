@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from sharedcache import WAYS, SharedCache, instance_path
+from tests.utils import cases
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def fill(path: str, count: int):
+    cache = SharedCache(path, size=1024 * 1024)
+    for i in range(count):
+        cache.set('i:%s' % i, '["%s"]' % i, 60)
+    cache.close()
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'cache')
+        self.clock = FakeClock()
+        self.cache = self.open()
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp.cleanup()
+
+    def open(self, path: str or None = None, **kwargs) -> SharedCache:
+        """
+        Cache of self.path or, for another layout, of another <path>
+        """
+        kwargs = dict(dict(size=64 * 1024, clock=self.clock), **kwargs)
+        return SharedCache(os.path.join(self.tmp.name, path or 'cache'),
+                           **kwargs)
+
+    def test_shared_between_mappings(self):
+        other = self.open()
+        self.cache.set('uid:v1:a', '3.0', 10)
+        self.assertEqual(other.get('uid:v1:a'), '3.0')
+        other.set('uid:v1:a', '4.5', 10)
+        self.assertEqual(self.cache.get('uid:v1:a'), '4.5')
+        other.discard('uid:v1:a')
+        self.assertIsNone(self.cache.get('uid:v1:a'))
+        other.close()
+
+    def test_ttl(self):
+        self.cache.set('i:1', '["books"]', 10)
+        self.clock.now += 9
+        self.assertEqual(self.cache.get('i:1'), '["books"]')
+        self.clock.now += 2
+        self.assertEqual(self.cache.get('i:1', 'missing'), 'missing')
+
+    @cases([('k' * 256, 'v'), ('i:1', 'v' * 300)])
+    def test_too_big(self, key, value):
+        too_big = self.cache.metrics()['too_big']
+        self.cache.set('i:1', 'old', 10)
+        self.assertFalse(self.cache.set(key, value, 10))
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual(self.cache.metrics()['too_big'], too_big + 1)
+
+    def test_clear(self):
+        other = self.open()
+        for i in range(10):
+            self.cache.set('i:%s' % i, '[]', 10)
+        other.clear()
+        self.assertEqual(
+            [self.cache.get('i:%s' % i) for i in range(10)], [None] * 10
+        )
+        other.close()
+
+    def test_clock_eviction(self):
+        cache = self.open('small', size=1)  # a single bucket
+        self.assertEqual(cache.metrics()['slots'], WAYS)
+        for i in range(WAYS):
+            cache.set('i:%s' % i, '[]', 10)
+        cache.get('i:0')
+        cache.set('i:new', '[]', 10)
+        # i:0 was referenced, the hand took i:1
+        self.assertEqual(cache.get('i:0'), '[]')
+        self.assertIsNone(cache.get('i:1'))
+        self.assertEqual(cache.get('i:new'), '[]')
+        self.clock.now += 5
+        cache.set('i:later', '[]', 10)
+        self.clock.now += 6  # all but i:later expired
+        cache.set('i:last', '[]', 10)
+        self.assertEqual(cache.get('i:later'), '[]')
+        self.assertEqual(cache.metrics()['evicted'], 2)
+        cache.close()
+
+    def test_layout_kept(self):
+        self.cache.set('i:1', '[]', 10)
+        same = self.open()
+        self.assertEqual(same.get('i:1'), '[]')
+        same.close()
+
+    @cases([{'slot_size': 128}, {'size': 128 * 1024}])
+    def test_other_layout_refused(self, layout):
+        # the file is mapped by self.cache, it is left as is
+        self.cache.set('i:1', '[]', 10)
+        with self.assertRaises(ValueError):
+            self.open(**layout)
+        self.assertEqual(self.cache.get('i:1'), '[]')
+
+    def test_instance_path(self):
+        path = instance_path('/dev/shm', 'localhost:6379')
+        self.assertEqual(os.path.dirname(path), '/dev/shm')
+        self.assertEqual(path, instance_path('/dev/shm', 'localhost:6379'))
+        self.assertNotEqual(path, instance_path('/dev/shm', 'redis:6379'))
+
+    def test_concurrent_writers(self):
+        cache = self.open('big', size=1024 * 1024, clock=time.monotonic)
+
+        def write(n):
+            for i in range(2000):
+                cache.set('i:%s' % (i % 50), '["%s"]' % n, 60)
+
+        threads = [threading.Thread(target=write, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        seen = set()
+        while any(thread.is_alive() for thread in threads):
+            for i in range(50):
+                seen.add(cache.get('i:%s' % i))
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(seen, {None, '["0"]', '["1"]', '["2"]',
+                                    '["3"]'})
+        cache.close()
+
+    def test_other_process(self):
+        context = multiprocessing.get_context('spawn')
+        path = os.path.join(self.tmp.name, 'big')
+        process = context.Process(target=fill, args=(path, 100))
+        process.start()
+        process.join(30)
+        self.assertEqual(process.exitcode, 0)
+        cache = SharedCache(path, size=1024 * 1024)
+        self.assertEqual(cache.get('i:99'), '["99"]')
+        cache.close()
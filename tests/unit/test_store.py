@@ -1,9 +1,25 @@
 import os
+import tempfile
+import threading
 import unittest
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import monotonic, sleep
 from unittest.mock import MagicMock
 
-from database import RedisStore
+import redis
+
+from cachetool import is_stale, reclaim
+from hotkeys import HotKeys
+from sharedcache import SharedCache
+from database import (CircuitBreaker, Deadline, DeadlineExceeded,
+                      HashRing, InstrumentedPool, KeyspaceSubscriber,
+                      PoolExhausted, PoolStats, RedisStore, ShardedStore,
+                      StoreUnavailable, parse_url, store_from_url)
+from scoring import (ProcessPoolEngine, Revalidator, RulesEngine,
+                     ScoringEngine, get_interests, get_score, get_scores,
+                     revalidator, score_columns, score_key, score_prefix,
+                     set_engine)
 from tests.utils import cases
 
 
@@ -82,3 +98,1004 @@ class TestRedisStore(unittest.TestCase):
     def tearDown(self):
         self.store.r.flushdb()
         self.store.cache.flushdb()
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.metrics()['rejected'], 1)
+
+    def test_half_open_single_trial(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        sleep(0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_failure_reopens(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        sleep(0.1)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+
+class TestDegradedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(connect=False, max_retry=2)
+        self.store._connect = MagicMock(side_effect=self.broken_connection)
+        self.store.r = self.broken_connection()
+        self.store.cache = self.broken_connection()
+
+    @staticmethod
+    def broken_connection(*args):
+        conn = MagicMock()
+        conn.get.side_effect = redis.exceptions.ConnectionError('down')
+        conn.set.side_effect = redis.exceptions.ConnectionError('down')
+        conn.pipeline.side_effect = redis.exceptions.ConnectionError('down')
+        return conn
+
+    def test_fails_fast_when_open(self):
+        with self.assertRaises(StoreUnavailable):
+            self.store.get('i:1')
+        self.assertEqual(self.store.breaker.state, CircuitBreaker.OPEN)
+        calls = self.store.r.get.call_count
+        with self.assertRaises(StoreUnavailable):
+            self.store.get('i:1')
+        self.assertEqual(self.store.r.get.call_count, calls)
+
+    def test_score_without_cache(self):
+        score = get_score(self.store, phone='79175002040',
+                          email='stupnikov@otus.ru')
+        self.assertEqual(score, 3.0)
+
+    @cases([
+        (redis.exceptions.ResponseError('WRONGTYPE'),
+         redis.exceptions.ResponseError),
+        (PoolExhausted('no free connection'), PoolExhausted),
+        (redis.exceptions.TimeoutError('slow'), DeadlineExceeded),
+    ])
+    def test_trial_without_outcome_released(self, error, raised):
+        self.store.breaker = CircuitBreaker(failure_threshold=2,
+                                            reset_timeout=0.05)
+        self.store.r = self.broken_connection()
+        with self.assertRaises(StoreUnavailable):
+            self.store.get('i:1')
+        sleep(0.05)
+        # the trial call ends with an error saying nothing of the store
+        self.store._call_with_timeout = MagicMock(side_effect=error)
+        with self.assertRaises(raised):
+            self.store.get('i:1', timeout=0.1)
+        self.assertEqual(self.store.breaker.state,
+                         CircuitBreaker.HALF_OPEN)
+        # the next call is the trial
+        self.store.r.get = MagicMock(return_value='["books"]')
+        del self.store._call_with_timeout
+        self.assertEqual(self.store.get('i:1'), '["books"]')
+        self.assertEqual(self.store.breaker.state, CircuitBreaker.CLOSED)
+
+
+class TestDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(connect=False)
+        self.store.r = MagicMock()
+        self.store.r.get = MagicMock(return_value='["books"]')
+
+    def test_remaining(self):
+        deadline = Deadline(10)
+        self.assertTrue(0 < deadline.remaining() <= 10)
+        self.assertFalse(deadline.expired)
+
+    def test_expired_deadline_stops_store_calls(self):
+        deadline = Deadline(0.01)
+        sleep(0.02)
+        self.assertTrue(deadline.expired)
+        with self.assertRaises(DeadlineExceeded):
+            deadline.check()
+        with self.assertRaises(DeadlineExceeded):
+            self.store.get('i:1', timeout=deadline.remaining())
+        self.store.r.get.assert_not_called()
+
+    def test_long_budget_uses_default_timeout(self):
+        self.assertEqual(self.store.get('i:1', timeout=10), '["books"]')
+        self.store.r.get.assert_called_once_with('i:1')
+
+
+class TestHashRing(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['i:%s' % i for i in range(2000)]
+        self.ring = HashRing(['a', 'b', 'c'])
+
+    def test_all_nodes_used(self):
+        owners = {self.ring.get_node(key) for key in self.keys}
+        self.assertEqual(owners, {'a', 'b', 'c'})
+
+    def test_minimal_movement_on_add(self):
+        before = {key: self.ring.get_node(key) for key in self.keys}
+        self.ring.add('d')
+        moved = [key for key in self.keys
+                 if self.ring.get_node(key) != before[key]]
+        # only keys taken by the new node move, about 1/4 of them
+        self.assertTrue(all(self.ring.get_node(key) == 'd' for key in moved))
+        self.assertLess(len(moved), len(self.keys) / 2)
+
+    def test_empty_ring(self):
+        with self.assertRaises(LookupError):
+            HashRing().get_node('i:1')
+
+
+class TestShardedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {'i:%s' % i: str(i) for i in range(50)}
+        nodes = {}
+        for name in ('a', 'b'):
+            node = RedisStore(connect=False)
+            node.r = MagicMock()
+            node.r.get = MagicMock(side_effect=self.data.get)
+            node.r.mget = MagicMock(
+                side_effect=lambda keys: [self.data.get(k) for k in keys]
+            )
+            nodes[name] = node
+        self.store = ShardedStore(nodes)
+
+    def test_get_routed_to_owner(self):
+        self.assertEqual(self.store.get('i:7'), '7')
+        owner = self.store.nodes[self.store.ring.get_node('i:7')]
+        owner.r.get.assert_called_once_with('i:7')
+
+    def test_get_many_grouped_by_shard(self):
+        keys = list(self.data) + ['i:missing']
+        result = self.store.get_many(keys)
+        self.assertEqual(list(result), keys)
+        self.assertIsNone(result['i:missing'])
+        self.assertEqual(result['i:3'], '3')
+        for node in self.store.nodes.values():
+            node.r.mget.assert_called_once()
+
+    def test_reads_parallel_after_add_node(self):
+        """
+        Every shard is read at the same time, the added one too
+        """
+        shards = threading.Barrier(3, timeout=2)
+
+        def get_many(keys, timeout=None):
+            shards.wait()
+            return dict.fromkeys(keys)
+        store = ShardedStore(self.store.nodes, concurrency=1)
+        store.add_node('c', RedisStore(connect=False))
+        for node in store.nodes.values():
+            node.get_many = get_many
+        keys = ['i:%s' % i for i in range(50)]
+        self.assertEqual(len(store._group(keys)), 3)
+        self.assertEqual(store.get_many(keys), dict.fromkeys(keys))
+
+    @staticmethod
+    def dict_node(data: dict) -> RedisStore:
+        node = RedisStore(connect=False)
+        node.r = MagicMock()
+        node.r.get = MagicMock(side_effect=data.get)
+        node.r.mget = MagicMock(
+            side_effect=lambda keys: [data.get(k) for k in keys]
+        )
+        node.r.set = MagicMock(side_effect=data.__setitem__)
+        node.r.delete = MagicMock(side_effect=lambda *keys: sum(
+            data.pop(k, None) is not None for k in keys
+        ))
+        node.r.scan_iter = MagicMock(side_effect=lambda **_: iter(list(data)))
+        node.r.pipeline = MagicMock(
+            side_effect=lambda **_: FakePipeline(data, [])
+        )
+        return node
+
+    def test_add_node_moves_keys(self):
+        """
+        Keys of the new node are read from their previous owner until
+        they are migrated, a newer value on the new node is kept
+        """
+        data = {'a': {}, 'b': {}, 'c': {}}
+        store = ShardedStore({n: self.dict_node(data[n]) for n in 'ab'})
+        keys = ['i:%s' % i for i in range(200)]
+        for key in keys:
+            store.set(key, key)
+        store.add_node('c', self.dict_node(data['c']), migrate=False)
+        moving = [key for key in keys if store.ring.get_node(key) == 'c']
+        self.assertTrue(moving)
+        self.assertEqual(store.get(moving[0]), moving[0])
+        self.assertEqual(store.get_many(keys), {key: key for key in keys})
+        store.set(moving[1], 'newer')
+
+        self.assertEqual(store.migrate(), len(moving) - 1)
+        self.assertIsNone(store.previous)
+        self.assertEqual(sorted(data['c']), sorted(moving))
+        self.assertEqual(data['c'][moving[1]], 'newer')
+        for name in 'ab':
+            self.assertTrue(all(store.ring.get_node(key) == name
+                                for key in data[name]))
+        self.assertEqual(store.get(moving[0]), moving[0])
+        data['d'] = {}
+        self.assertEqual(store.add_node('d', self.dict_node(data['d'])),
+                         len(data['d']))
+        self.assertEqual(store.get_many(keys)[moving[2]], moving[2])
+
+
+@unittest.skipUnless(os.environ.get('REDIS_SHARD_URLS'),
+                     'REDIS_SHARD_URLS (host:port,host:port) not set')
+class TestShardedStoreRedis(unittest.TestCase):
+
+    def setUp(self):
+        urls = os.environ['REDIS_SHARD_URLS'].split(',')
+        self.store = ShardedStore.from_urls(urls, db=3, socket_timeout=0.3)
+
+    def test_set_get_many(self):
+        keys = ['i:%s' % i for i in range(100)]
+        for key in keys:
+            self.store.set(key, key)
+        self.assertEqual(self.store.get_many(keys),
+                         {key: key for key in keys})
+
+    def tearDown(self):
+        for node in self.store.nodes.values():
+            node.r.flushdb()
+            node.cache.flushdb()
+
+
+class TestReplicaRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(connect=False,
+                                replicas=['replica1:6379', 'replica2:6379'])
+        self.store.r = MagicMock()
+        self.store.r.get = MagicMock(return_value='primary')
+        for replica in self.store.replicas:
+            replica.r = MagicMock()
+            replica.r.get = MagicMock(return_value=replica.host)
+
+    def test_round_robin(self):
+        values = [self.store.get('i:1') for i in range(4)]
+        self.assertEqual(values, ['replica1', 'replica2'] * 2)
+        self.store.r.get.assert_not_called()
+
+    def test_writes_go_to_primary(self):
+        self.store.set('i:1', 'value')
+        self.store.r.set.assert_called_once_with('i:1', 'value')
+        for replica in self.store.replicas:
+            replica.r.set.assert_not_called()
+
+    def test_unhealthy_replica_ejected(self):
+        broken = self.store.replicas[0]
+        broken.r.get.side_effect = redis.exceptions.ConnectionError('down')
+        broken._connect = MagicMock(return_value=broken.r)
+        values = {self.store.get('i:1') for i in range(6)}
+        self.assertEqual(broken.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(values, {'replica2', 'primary'})
+        self.assertEqual(self.store.get('i:1'), 'replica2')
+
+    def lag(self, offset: int) -> set:
+        """
+        Values read twice 0.1 s apart by replicas at <offset>, the primary
+        at 200, with a link idle for 10 s
+        """
+        self.store.max_replica_lag = 0.05
+        self.store.lag_check_interval = 0
+        self.store.r.info = MagicMock(
+            return_value={'master_repl_offset': 200}
+        )
+        for replica in self.store.replicas:
+            replica.r.info = MagicMock(return_value={
+                'master_link_status': 'up',
+                'master_last_io_seconds_ago': 10,
+                'slave_repl_offset': offset,
+            })
+        values = {self.store.get('i:1')}
+        sleep(0.1)
+        return values | {self.store.get('i:1')}
+
+    def test_lagging_replicas_fall_back_to_primary(self):
+        self.assertEqual(self.lag(100), {'replica1', 'primary'})
+
+    def test_idle_replicas_not_lagging(self):
+        self.assertEqual(self.lag(200), {'replica1', 'replica2'})
+
+    def test_metrics_named_by_url(self):
+        store = RedisStore(connect=False, replicas=[
+            'replica1:6379', 'unix:///run/replica.sock'
+        ])
+        self.assertEqual(list(store.metrics()['replicas']),
+                         ['replica1:6379', 'unix:///run/replica.sock'])
+
+    def test_least_outstanding(self):
+        self.store.read_policy = 'least-outstanding'
+        self.store._outstanding[self.store.replicas[0]] = 3
+        self.assertEqual(self.store.get('i:1'), 'replica2')
+
+
+class TestBatchScoring(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = {
+            'phone': ['79175002040', None, '79175002040'],
+            'email': ['stupnikov@otus.ru', None, None],
+            'birthday': [None, '01.01.2000', '01.01.2000'],
+            'gender': [None, 1, 0],
+            'first_name': [None, 'a', None],
+            'last_name': [None, 'b', None],
+        }
+        self.store = RedisStore(connect=False)
+        self.store.r = MagicMock()
+        self.store.cache = MagicMock()
+
+    def test_score_columns(self):
+        self.assertEqual(score_columns(self.columns), [3.0, 2.0, 1.5])
+
+    def test_get_scores_batches_cache(self):
+        cached_key = score_key(phone='79175002040')
+        self.store.cache.mget = MagicMock(
+            side_effect=lambda keys: ['10' if key == cached_key else None
+                                      for key in keys]
+        )
+        self.store.r.mget = MagicMock(side_effect=lambda keys: [None] * 2)
+        scores = get_scores(self.store, self.columns)
+        self.assertEqual(scores, [10.0, 2.0, 1.5])
+        self.store.cache.mget.assert_called_once()
+        pipe = self.store.cache.pipeline.return_value
+        self.assertEqual(pipe.set.call_count, 2)
+        pipe.execute.assert_called_once()
+
+
+class TestScoreKeys(unittest.TestCase):
+
+    def test_versioned_key(self):
+        key = score_key(phone='79175002040')
+        self.assertTrue(key.startswith(score_prefix()))
+        self.assertFalse(is_stale(key))
+        self.assertNotEqual(score_prefix(1), score_prefix(2))
+
+    @cases(['uid:9e107d9d372bb6826bd81d3542a419d6', 'uid:v0:abc'])
+    def test_stale_keys(self, key):
+        self.assertTrue(is_stale(key, version=1))
+
+    def test_reclaim(self):
+        fresh = [score_key(phone=str(i)) for i in range(3)]
+        stale = ['uid:v0:%s' % i for i in range(5)]
+        store = RedisStore(connect=False)
+        store.cache = MagicMock()
+        store.cache.scan_iter = MagicMock(return_value=iter(fresh + stale))
+        store.cache.unlink = MagicMock(side_effect=lambda *keys: len(keys))
+        self.assertEqual(reclaim(store, batch=2, pause=0), 5)
+        unlinked = [key for call in store.cache.unlink.call_args_list
+                    for key in call.args]
+        self.assertEqual(unlinked, stale)
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(connect=False, negative_ttl=0.1)
+        self.store.r = MagicMock()
+        self.store.r.get = MagicMock(return_value=None)
+        self.store.r.mget = MagicMock(
+            side_effect=lambda keys: [None] * len(keys)
+        )
+
+    def test_unknown_client_without_round_trip(self):
+        self.assertEqual(get_interests(self.store, 42), [])
+        self.assertEqual(get_interests(self.store, 42), [])
+        self.store.r.get.assert_called_once_with('i:42')
+
+    def test_invalidated_on_set(self):
+        get_interests(self.store, 42)
+        self.store.set('i:42', '["books"]')
+        self.store.r.get = MagicMock(return_value='["books"]')
+        self.assertEqual(get_interests(self.store, 42), ['books'])
+
+    def test_expires(self):
+        get_interests(self.store, 42)
+        sleep(0.1)
+        get_interests(self.store, 42)
+        self.assertEqual(self.store.r.get.call_count, 2)
+
+    def test_get_many_skips_known_missing(self):
+        self.store.get_many(['i:1', 'i:2'])
+        self.assertEqual(self.store.get_many(['i:1', 'i:2']),
+                         {'i:1': None, 'i:2': None})
+        self.store.r.mget.assert_called_once()
+
+    def test_max_size(self):
+        self.store.negative.max_size = 2
+        for key in ('a', 'b', 'c'):
+            self.store.negative.add(key)
+        self.assertNotIn('a', self.store.negative)
+        self.assertIn('c', self.store.negative)
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(connect=False, local_ttl=60)
+        self.store.r = MagicMock()
+        self.store.r.get = MagicMock(return_value='["books"]')
+        self.store.cache = MagicMock()
+        self.store.cache.get = MagicMock(return_value='3.0')
+
+    def test_get_served_locally(self):
+        self.assertEqual(self.store.get('i:1'), '["books"]')
+        self.assertEqual(self.store.get('i:1'), '["books"]')
+        self.store.r.get.assert_called_once_with('i:1')
+        self.assertEqual(self.store.metrics()['local_cache']['hits'], 1)
+
+    def test_cache_get_served_locally(self):
+        self.store.cache_get('uid:1')
+        self.assertEqual(self.store.cache_get('uid:1'), '3.0')
+        self.store.cache.get.assert_called_once_with('uid:1')
+
+    def test_keyspace_event_evicts(self):
+        subscriber = KeyspaceSubscriber(self.store, self.store.invalidate,
+                                        self.store.flush_local)
+        self.store.get('i:1')
+        subscriber.handle({'type': 'pmessage',
+                           'channel': '__keyspace@0__:i:1', 'data': 'set'})
+        self.store.get('i:1')
+        self.assertEqual(self.store.r.get.call_count, 2)
+
+    def test_flush_on_reconnect(self):
+        self.store.get('i:1')
+        self.store.negative.add('i:2')
+        pubsub = MagicMock()
+        pubsub.get_message = MagicMock(side_effect=redis.ConnectionError)
+        self.store.r.pubsub = MagicMock(return_value=pubsub)
+        subscriber = KeyspaceSubscriber(self.store, self.store.invalidate,
+                                        self.store.flush_local)
+        with self.assertRaises(redis.ConnectionError):
+            subscriber.listen()
+        pubsub.psubscribe.assert_called_once_with('__keyspace@0__:*',
+                                                  '__keyspace@1__:*')
+        self.assertNotIn('i:2', self.store.negative)
+        self.store.get('i:1')
+        self.assertEqual(self.store.r.get.call_count, 2)
+        pubsub.close.assert_called_once()
+
+    def test_subscriber_stop_and_join(self):
+        pubsub = MagicMock()
+        pubsub.get_message = MagicMock(return_value=None)
+        self.store.r.pubsub = MagicMock(return_value=pubsub)
+        subscriber = KeyspaceSubscriber(self.store, self.store.invalidate,
+                                        self.store.flush_local)
+        subscriber.start()
+        subscriber.stop()
+        subscriber.join(5)
+        self.assertFalse(subscriber.is_alive())
+        pubsub.close.assert_called_once()
+
+    def test_invalidation_listeners(self):
+        on_change, on_flush = MagicMock(), MagicMock()
+        self.store.add_invalidation_listener(on_change, on_flush)
+        self.store.set('i:1', '["pets"]')
+        self.store.delete('i:2')
+        self.store.flush_local()
+        self.assertEqual([c[0][0] for c in on_change.call_args_list],
+                         ['i:1', 'i:2'])
+        on_flush.assert_called_once_with()
+
+    def test_set_evicts(self):
+        self.store.get('i:1')
+        self.store.set('i:1', '["pets"]')
+        self.store.get('i:1')
+        self.assertEqual(self.store.r.get.call_count, 2)
+
+    def test_pinned_kept_when_full(self):
+        local = self.store.local
+        local.max_size = 3
+        local.pin(['i:1'])
+        for i in range(1, 6):
+            local.set('i:%s' % i, i)
+        self.assertEqual(local.get('i:1'), 1)
+        self.assertIsNone(local.get('i:2'))
+        self.assertEqual(local.metrics()['size'], 3)
+        local.pin(['i:%s' % i for i in range(10)])
+        local.set('i:9', 9)
+        self.assertEqual(local.metrics()['size'], 4)
+
+    def test_hot_keys_tracked_and_pinned(self):
+        hot_keys = HotKeys(pin=True, pin_min=2, window=0.05)
+        self.store.track_hot_keys(hot_keys)
+        self.store.get('i:1')
+        self.store.get('i:1')
+        self.store.cache_get('uid:v1:a')
+        self.store.r.mget = MagicMock(return_value=[None])
+        self.store.get_many(['i:2'])
+        top = hot_keys.top()
+        self.assertEqual(top['interests']['top'][0],
+                         {'key': 'i:1', 'count': 2})
+        self.assertEqual(top['interests']['total'], 3)
+        self.assertEqual(top['scores']['total'], 1)
+        sleep(0.06)
+        self.store.get('i:1')
+        self.assertEqual(self.store.local.pinned, {'i:1'})
+
+
+class TestSharedCache(unittest.TestCase):
+    """
+    Two stores sharing a SharedCache, as two worker processes
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'cache')
+        self.workers = []
+        for _ in range(2):
+            store = RedisStore(connect=False, stale_ttl=300,
+                               shared=SharedCache(path, size=64 * 1024))
+            store.r = MagicMock()
+            store.r.get = MagicMock(return_value='["books"]')
+            store.cache = MagicMock()
+            self.workers.append(store)
+
+    def tearDown(self):
+        for store in self.workers:
+            store.shared.close()
+        self.tmp.cleanup()
+
+    def test_get_shared(self):
+        first, second = self.workers
+        self.assertEqual(first.get('i:1'), '["books"]')
+        self.assertEqual(second.get('i:1'), '["books"]')
+        second.r.get.assert_not_called()
+        self.assertEqual(second.metrics()['shared_cache']['hits'], 1)
+
+    def test_set_invalidates_for_all(self):
+        first, second = self.workers
+        first.get('i:1')
+        second.set('i:1', '["pets"]')
+        first.get('i:1')
+        self.assertEqual(first.r.get.call_count, 2)
+
+    def test_cache_lookup_kept_while_fresh(self):
+        first, second = self.workers
+        pipeline = MagicMock()
+        pipeline.execute = MagicMock(return_value=['3.0', 305])
+        first.cache.pipeline = MagicMock(return_value=pipeline)
+        self.assertEqual(first.cache_lookup('uid:v1:a'), ('3.0', False))
+        # kept for 5 s, until it turns stale
+        self.assertEqual(second.shared.get('uid:v1:a'), '3.0')
+        pipeline.execute = MagicMock(return_value=['4.0', 100])
+        self.assertEqual(first.cache_lookup('uid:v1:b'), ('4.0', True))
+        self.assertIsNone(second.shared.get('uid:v1:b'))
+
+    def test_cleared_on_reconnect_only(self):
+        first, second = self.workers
+        first.get('i:1')
+        pubsub = MagicMock()
+        pubsub.get_message = MagicMock(side_effect=redis.ConnectionError)
+        second.r.pubsub = MagicMock(return_value=pubsub)
+        second.subscriber = KeyspaceSubscriber(second, second.invalidate,
+                                               second._resync)
+        # a worker starting does not wipe the cache of the others
+        with self.assertRaises(redis.ConnectionError):
+            second.subscriber.listen()
+        self.assertEqual(second.get('i:1'), '["books"]')
+        second.r.get.assert_not_called()
+        # events may have been missed by all
+        with self.assertRaises(redis.ConnectionError):
+            second.subscriber.listen()
+        self.assertIsNone(first.shared.get('i:1'))
+
+
+class FakePipeline:
+    """
+    Pipeline of a dict: queues get, ttl and set, logs executed sizes
+    """
+
+    def __init__(self, data: dict, executed: list):
+        self.data = data
+        self.executed = executed
+        self.replies = []
+
+    def __len__(self):
+        return len(self.replies)
+
+    def get(self, key):
+        self.replies.append(self.data.get(key))
+
+    def ttl(self, key):
+        self.replies.append(100 if key in self.data else -2)
+
+    def pttl(self, key):
+        self.replies.append(100000 if key in self.data else -2)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.data:
+            self.replies.append(None)
+            return
+        self.data[key] = value
+        self.replies.append(True)
+
+    def execute(self, raise_on_error=True):
+        self.executed.append(len(self.replies))
+        return self.replies
+
+
+class TestCallBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(connect=False, batch_window=5,
+                                batch_size=3)
+        self.data = {'a': '1', 'b': '2', 'c': '3',
+                     'bad': redis.exceptions.ResponseError('WRONGTYPE')}
+        self.executed = []
+        self.entered, self.release = Event(), Event()
+        self.store.cache = MagicMock()
+        self.store.cache.get = MagicMock(side_effect=self.get)
+        self.store.cache.pipeline = MagicMock(
+            side_effect=lambda **_: FakePipeline(self.data, self.executed)
+        )
+
+    def get(self, key):
+        if not self.entered.is_set():
+            # the first call blocks, so that the next callers are not
+            # alone in the store and gather
+            self.entered.set()
+            self.release.wait(5)
+        return self.data.get(key)
+
+    def gather(self, calls: list) -> list:
+        """
+        Results (or errors) of <calls> made by concurrent threads
+        """
+        def run(call):
+            try:
+                return call()
+            except Exception as exc:
+                return exc
+        with ThreadPoolExecutor(len(calls) + 1) as executor:
+            first = executor.submit(self.store.cache_get, 'a')
+            self.entered.wait(5)
+            futures = [executor.submit(run, call) for call in calls]
+            results = [future.result(5) for future in futures]
+            self.release.set()
+            self.assertEqual(first.result(5), '1')
+        return results
+
+    def test_one_pipeline_for_concurrent_calls(self):
+        results = self.gather([
+            lambda: self.store.cache_get('a'),
+            lambda: self.store.cache_lookup('b'),
+            lambda: self.store.cache_set('d', '4'),
+        ])
+        self.assertEqual(results, ['1', ('2', False), None])
+        # get | get, ttl | set; the first call was alone, no pipeline
+        self.assertEqual(self.executed, [4])
+        self.assertEqual(self.data['d'], '4')
+        batching = self.store.metrics()['batching']['cache']
+        self.assertEqual(batching, {'batches': 2, 'calls': 4,
+                                    'max_batch': 3})
+
+    def test_error_goes_to_its_caller(self):
+        results = self.gather([
+            lambda: self.store.cache_get('bad'),
+            lambda: self.store.cache_get('c'),
+            lambda: self.store.cache_lookup('bad'),
+        ])
+        self.assertIsInstance(results[0], redis.exceptions.ResponseError)
+        self.assertEqual(results[1], '3')
+        self.assertIsInstance(results[2], redis.exceptions.ResponseError)
+
+    def test_batch_failure_goes_to_all(self):
+        self.store.breaker = CircuitBreaker(failure_threshold=1)
+        self.store.breaker.record_failure()
+        for _ in range(2):
+            with self.assertRaises(StoreUnavailable):
+                self.store.cache_get('a')
+        self.assertEqual(self.executed, [])
+
+    def test_alone_does_not_wait(self):
+        self.entered.set()
+        for key in 'abc':
+            self.assertEqual(self.store.cache_get(key, timeout=1),
+                             self.data[key])
+        self.store.cache.pipeline.assert_not_called()
+        self.assertEqual(self.store.metrics()['batching']['cache'],
+                         {'batches': 3, 'calls': 3, 'max_batch': 1})
+
+    def test_off_by_default(self):
+        store = RedisStore(connect=False)
+        self.assertEqual(store.batchers, {})
+        self.assertNotIn('batching', store.metrics())
+
+
+class TestStoreUrls(unittest.TestCase):
+
+    def test_parse_url(self):
+        self.assertEqual(parse_url('redis1:6380'),
+                         {'host': 'redis1', 'port': '6380'})
+        self.assertEqual(parse_url('unix:///run/redis.sock'),
+                         {'unix_socket_path': '/run/redis.sock'})
+
+    def test_unix_socket_store(self):
+        store = store_from_url('unix:///run/redis.sock', connect=False,
+                               replicas=['unix:///run/replica.sock'])
+        kwargs = store._connect(store.db).connection_pool.connection_kwargs
+        self.assertEqual(kwargs['path'], '/run/redis.sock')
+        kwargs = store.replicas[0]._connect(1).connection_pool \
+            .connection_kwargs
+        self.assertEqual((kwargs['path'], kwargs['db']),
+                         ('/run/replica.sock', 1))
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(connect=False, ttl=3600, ttl_jitter=0.1,
+                                stale_ttl=300)
+        self.store.cache = MagicMock()
+        self.pipe = self.store.cache.pipeline.return_value
+        self.key = score_key(phone='79175002040')
+
+    def test_ttl_jitter(self):
+        expiries = {self.store.cache_expiry() for _ in range(100)}
+        self.assertTrue(len(expiries) > 1)
+        self.assertTrue(all(3240 + 300 <= ex <= 3960 + 300
+                            for ex in expiries))
+
+    @cases([(3000, False), (299, True), (-1, False)])
+    def test_cache_lookup(self, ttl, stale):
+        self.pipe.execute = MagicMock(return_value=['3.0', ttl])
+        self.assertEqual(self.store.cache_lookup(self.key), ('3.0', stale))
+
+    def test_stale_score_served_and_refreshed_once(self):
+        self.pipe.execute = MagicMock(return_value=['1.5', 10])
+        done = Event()
+        self.store.cache_set = MagicMock(
+            side_effect=lambda *args, **kwargs: done.wait(1)
+        )
+        for _ in range(3):
+            self.assertEqual(get_score(self.store, phone='79175002040',
+                                       email='stupnikov@otus.ru'), 1.5)
+        done.set()
+        while revalidator._pending:
+            sleep(0.01)
+        self.store.cache_set.assert_called_once_with(self.key, 3.0)
+
+    def test_refresh_failure_is_logged(self):
+        revalidator = Revalidator(max_workers=1)
+        refresh = MagicMock(side_effect=StoreUnavailable('down'))
+        with self.assertLogs(level='WARNING'):
+            revalidator.submit('uid:1', refresh)
+            revalidator.executor.shutdown(wait=True)
+        self.assertEqual(revalidator._pending, set())
+
+
+class ConstantEngine(ScoringEngine):
+
+    def score_columns(self, columns, timeout=None):
+        return [7.0] * len(columns['phone'])
+
+
+class TestScoringEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(connect=False)
+        self.store.cache_lookup = MagicMock(return_value=(None, False))
+        self.store.cache_get_many = MagicMock(
+            side_effect=lambda keys, timeout: {
+                key: '1.0' if i == 0 else None for i, key in enumerate(keys)
+            }
+        )
+        self.store.cache_set = MagicMock()
+        self.store.cache_set_many = MagicMock()
+
+    def test_engine_scores_cache_misses(self):
+        previous = set_engine(ConstantEngine())
+        try:
+            self.assertEqual(get_score(self.store, phone='79175002040'), 7.0)
+            self.store.cache_set.assert_called_once()
+            columns = {name: [None, None] for name in (
+                'email', 'birthday', 'gender', 'first_name', 'last_name'
+            )}
+            columns['phone'] = ['79175002040', '79175002041']
+            scores = get_scores(self.store, columns)
+            self.assertEqual(scores, [1.0, 7.0])
+        finally:
+            set_engine(previous)
+
+    def test_process_pool_engine(self):
+        engine = ProcessPoolEngine(RulesEngine(), max_workers=1,
+                                   batch_window=0.05)
+        try:
+            clients = [{'phone': '79175002040'},
+                       {'phone': '79175002040', 'email': 'a@b.ru'},
+                       {'first_name': 'a', 'last_name': 'b'}]
+            with ThreadPoolExecutor(len(clients)) as executor:
+                # the callers wait for the pool to start, all of them
+                # are scoring when the first batch is taken
+                with engine._lock:
+                    futures = [executor.submit(engine.score, **fields)
+                               for fields in clients]
+                    while engine._unbatched < len(clients):
+                        sleep(0.01)
+                scores = [future.result(30) for future in futures]
+            self.assertEqual(scores, [1.5, 3.0, 0.5])
+            self.assertEqual(engine.metrics()['scored'], 3)
+            # concurrent calls are sent to the pool together
+            self.assertTrue(engine.metrics()['batches'] < 3)
+        finally:
+            engine.close()
+
+    def test_process_pool_lone_score_not_delayed(self):
+        engine = ProcessPoolEngine(RulesEngine(), max_workers=1,
+                                   batch_window=10)
+        try:
+            engine.score(phone='79175002040')  # starts the pool
+            started = monotonic()
+            self.assertEqual(engine.score(phone='79175002040'), 1.5)
+            self.assertLess(monotonic() - started, 5)
+            self.assertEqual(engine.metrics()['batches'], 2)
+        finally:
+            engine.close()
+
+    def test_engine_is_abstract(self):
+        with self.assertRaises(TypeError):
+            ScoringEngine()
+
+    def test_process_pool_timeout(self):
+        engine = ProcessPoolEngine(RulesEngine(), max_workers=1)
+        engine.start = MagicMock()
+        with self.assertRaises(DeadlineExceeded):
+            engine.score(timeout=0.01, phone='79175002040')
+
+
+class FakeConnection:
+
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+
+    def connect(self):
+        pass
+
+    def can_read(self):
+        return False
+
+    def disconnect(self):
+        pass
+
+
+class ScriptedConnection(FakeConnection):
+    """
+    Connection answering GET with '3.0' and TTL with 100
+    """
+    replies = {'GET': '3.0', 'TTL': 100}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.socket_timeout = None
+        self._sock = MagicMock()
+        self.retry = redis.retry.Retry(redis.backoff.NoBackoff(), 0)
+        self.pending = []
+
+    def pack_commands(self, commands):
+        return commands
+
+    def send_packed_command(self, commands, check_health=True):
+        self.pending.extend(self.replies[args[0]] for args in commands)
+
+    def send_command(self, *args, **kwargs):
+        self.send_packed_command([args])
+
+    def read_response(self, **kwargs):
+        return self.pending.pop(0)
+
+
+class FlakyConnection(ScriptedConnection):
+    """
+    ScriptedConnection failing the next <failures> commands
+    """
+    failures = 0
+    disconnects = 0
+    retry_on_error = ()
+
+    def send_packed_command(self, commands, check_health=True):
+        if FlakyConnection.failures:
+            FlakyConnection.failures -= 1
+            raise redis.exceptions.ConnectionError('reset by peer')
+        super().send_packed_command(commands, check_health)
+
+    def disconnect(self):
+        FlakyConnection.disconnects += 1
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = InstrumentedPool(PoolStats(), max_connections=2,
+                                     timeout=0.05,
+                                     connection_class=FakeConnection)
+
+    def test_stats(self):
+        first = self.pool.get_connection('get')
+        second = self.pool.get_connection('get')
+        self.pool.release(first)
+        self.assertEqual(self.pool.metrics()['in_use'], 1)
+        self.assertEqual(self.pool.metrics()['idle'], 1)
+        self.pool.release(self.pool.get_connection('get'))
+        self.pool.release(second)
+        metrics = self.pool.metrics()
+        self.assertEqual((metrics['created'], metrics['in_use'],
+                          metrics['idle'], metrics['waits']), (2, 0, 2, 0))
+
+    def test_exhausted(self):
+        held = [self.pool.get_connection('get') for _ in range(2)]
+        with self.assertRaises(PoolExhausted):
+            self.pool.get_connection('get')
+        metrics = self.pool.metrics()
+        self.assertEqual((metrics['waits'], metrics['exhausted']), (1, 1))
+        self.assertTrue(metrics['max_wait'] >= 0.05)
+        self.pool.release(held[0])
+
+    def test_exhaustion_does_not_open_breaker(self):
+        store = RedisStore(connect=False, max_connections=1,
+                           pool_timeout=0.01, max_retry=1)
+        store.r = store._connect(store.db)
+        # the only connection slot is taken
+        store.pools[store.db].pool.get_nowait()
+        with self.assertRaises(StoreUnavailable):
+            store.get('i:1')
+        self.assertEqual(store.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(store.metrics()['pools']['db']['exhausted'], 1)
+
+    def test_pipeline_on_limited_connection(self):
+        store = RedisStore(connect=False, max_connections=1,
+                           pool_timeout=0.01, stale_ttl=300)
+        store.cache = store._connect(store.db_cache)
+        store.pools[store.db_cache].connection_class = ScriptedConnection
+        # GET and TTL on the one connection, with the request deadline
+        self.assertEqual(store.cache_lookup('uid:1', timeout=0.2),
+                         ('3.0', True))
+        conn = store.pools[store.db_cache].get_connection('get')
+        self.assertEqual(conn.socket_timeout, store.socket_timeout)
+        conn._sock.settimeout.assert_any_call(0.2)
+        self.assertEqual(store.metrics()['pools']['cache']['created'], 1)
+
+    def test_reconnect_keeps_pool(self):
+        """
+        A connection error closes idle connections of the pool, no new
+        pool is made beside it
+        """
+        store = RedisStore(connect=False, max_connections=2,
+                           pool_timeout=0.01)
+        store.r = store._connect(store.db)
+        pool = store.pools[store.db]
+        pool.connection_class = FlakyConnection
+        held = pool.get_connection('get')
+        FlakyConnection.failures, FlakyConnection.disconnects = 1, 0
+        self.assertEqual(store.get('i:1'), '3.0')
+        self.assertIs(store.r.connection_pool, pool)
+        self.assertIs(store.pools[store.db], pool)
+        self.assertGreater(FlakyConnection.disconnects, 0)
+        metrics = store.metrics()['pools']['db']
+        self.assertEqual((metrics['created'], metrics['in_use'],
+                          metrics['idle']), (2, 1, 1))
+        pool.release(held)
+
+    def test_pool_options(self):
+        store = RedisStore(connect=False, max_connections=7,
+                           socket_connect_timeout=0.2)
+        pool = store._connect(store.db_cache).connection_pool
+        self.assertEqual(pool.max_connections, 7)
+        self.assertEqual(pool.connection_kwargs['socket_connect_timeout'],
+                         0.2)
+        self.assertTrue(pool.connection_kwargs['socket_keepalive'])
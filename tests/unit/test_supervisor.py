@@ -0,0 +1,275 @@
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler
+
+from supervisor import (ThreadedHTTPServer, UnixHTTPServer,
+                        WorkerHTTPServer, bind_socket, get_rss)
+
+
+class PingHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'pong')
+
+    def log_message(self, *args):
+        pass
+
+
+def unix_get(path: str) -> bytes:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        return b''.join(iter(lambda: client.recv(4096), b''))
+
+
+class TestWorkerHTTPServer(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = socket.create_server(('localhost', 0))
+        self.server = WorkerHTTPServer(self.sock, BaseHTTPRequestHandler,
+                                       max_requests=2)
+
+    def test_shared_socket_not_blocking(self):
+        self.assertIs(self.server.socket, self.sock)
+        self.assertEqual(self.sock.gettimeout(), self.server.timeout)
+        # no pending connection: returns instead of blocking in accept()
+        started = time.monotonic()
+        self.server._handle_request_noblock()
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_idle_does_not_spin(self):
+        handlers = {sig: signal.getsignal(sig)
+                    for sig in (signal.SIGTERM, signal.SIGINT)}
+        passes = []
+        handle_request = self.server.handle_request
+        self.server.handle_request = lambda: (passes.append(1),
+                                              handle_request())
+        timer = threading.Timer(1, self.server.stop)
+        timer.start()
+        cpu = time.process_time()
+        self.server.serve()
+        cpu = time.process_time() - cpu
+        timer.join()
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+        # one pass per timeout, no busy loop
+        self.assertLessEqual(len(passes), 4)
+        self.assertLess(cpu, 0.3)
+
+    def test_recycle_after_max_requests(self):
+        self.assertFalse(self.server.should_recycle())
+        self.server.handled = 2
+        self.assertTrue(self.server.should_recycle())
+
+    def test_recycle_on_rss(self):
+        self.server.max_requests = 0
+        self.server.max_rss = 1  # MB, any python process is bigger
+        self.assertTrue(get_rss() > 0)
+        self.assertTrue(self.server.should_recycle())
+
+    def test_stop(self):
+        handlers = {sig: signal.getsignal(sig)
+                    for sig in (signal.SIGTERM, signal.SIGINT)}
+        self.server.stop()
+        self.server.serve()
+        self.assertEqual(self.sock.fileno(), -1)
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+
+    def tearDown(self):
+        self.server.server_close()
+
+
+class BarrierHandler(PingHandler):
+    """
+    Answers once <barrier> parties are handled at the same time
+    """
+    barrier = None
+
+    def do_GET(self):
+        self.barrier.wait()
+        super().do_GET()
+
+
+class TestThreadedServer(unittest.TestCase):
+
+    def serve(self, max_threads: int, clients: int) -> list:
+        server = ThreadedHTTPServer(('localhost', 0), BarrierHandler)
+        server.max_threads = max_threads
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        answers = []
+
+        def get():
+            with socket.create_connection(server.server_address) as client:
+                client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+                answers.append(client.recv(4096))
+        clients = [threading.Thread(target=get) for _ in range(clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join(5)
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        return answers
+
+    def test_concurrent_requests(self):
+        BarrierHandler.barrier = threading.Barrier(3, timeout=5)
+        answers = self.serve(max_threads=3, clients=3)
+        self.assertEqual(len(answers), 3)
+        self.assertTrue(all(answer.startswith(b'HTTP/1.0 200')
+                            for answer in answers))
+
+    def test_max_threads(self):
+        # a third request is not handled while two are in flight
+        BarrierHandler.barrier = threading.Barrier(3, timeout=0.5)
+        answers = self.serve(max_threads=2, clients=3)
+        self.assertFalse(any(answer.startswith(b'HTTP/1.0 200')
+                             for answer in answers))
+
+
+class TestUnixSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'api.sock')
+
+    def test_unix_http_server(self):
+        # stale socket of a previous run is replaced
+        bind_socket(self.path).close()
+        server = UnixHTTPServer(self.path, PingHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        answer = unix_get(self.path)
+        thread.join()
+        server.server_close()
+        self.assertTrue(answer.startswith(b'HTTP/1.0 200'))
+        self.assertTrue(answer.endswith(b'pong'))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_worker_on_unix_socket(self):
+        server = WorkerHTTPServer(bind_socket(self.path), PingHandler)
+        self.assertEqual(server.server_name, self.path)
+        client = threading.Thread(target=unix_get, args=(self.path,))
+        client.start()
+        while not server.handled:
+            server.handle_request()
+        client.join()
+        server.server_close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class TestSupervisor(unittest.TestCase):
+    """
+    Supervisor process serving workers of pid_server.py
+    """
+
+    def setUp(self):
+        self.failures = []
+        self.process = None
+
+    def start(self, *args):
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ,
+                   PYTHONPATH=os.path.dirname(os.path.dirname(here)))
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(here, 'pid_server.py'), *args],
+            stdout=subprocess.PIPE, env=env
+        )
+        self.port = int(self.process.stdout.readline())
+
+    def get(self, seconds: float = 0) -> int or None:
+        """
+        PID of the worker answering after <seconds>, failures are kept
+        """
+        try:
+            client = http.client.HTTPConnection('localhost', self.port,
+                                                timeout=5)
+            client.request('GET', '/%s' % seconds)
+            response = client.getresponse()
+            body = response.read()
+            client.close()
+        except OSError as exc:
+            self.failures.append(exc)
+            return None
+        if response.status != 200:
+            self.failures.append(response.status)
+            return None
+        return int(body)
+
+    def load(self, stop: threading.Event, pids: list):
+        while not stop.is_set():
+            pids.append(self.get(0.01))
+
+    def test_reload_and_stop(self):
+        """
+        SIGHUP replaces the workers, SIGTERM drains them: no request
+        fails on the way
+        """
+        self.start('--workers', '2')
+        old = {self.get() for _ in range(10)}
+        stop, pids = threading.Event(), []
+        loaders = [threading.Thread(target=self.load, args=(stop, pids))
+                   for _ in range(4)]
+        for loader in loaders:
+            loader.start()
+        time.sleep(0.3)
+        self.process.send_signal(signal.SIGHUP)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            new = set(pids[-20:])
+            if new and not new & old:
+                break
+            time.sleep(0.1)
+        # slow requests in flight when the supervisor is stopped
+        slow = []
+        slow_calls = [threading.Thread(target=lambda: slow.append(
+            self.get(0.5))) for _ in range(2)]
+        for call in slow_calls:
+            call.start()
+        time.sleep(0.2)
+        stop.set()
+        for loader in loaders:
+            loader.join()
+        self.process.send_signal(signal.SIGTERM)
+        for call in slow_calls:
+            call.join()
+        self.assertEqual(self.process.wait(15), 0)
+        self.assertEqual(self.failures, [])
+        self.assertNotIn(None, old)
+        self.assertTrue(new)
+        self.assertFalse(new & old)
+        self.assertEqual(len(slow), 2)
+        self.assertTrue(set(slow) <= new)
+
+    def test_recycled_workers_respawned(self):
+        self.start('--workers', '2', '--max-requests', '3')
+        pids = []
+        while len(pids) < 20 and not self.failures:
+            pids.append(self.get())
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(15), 0)
+        self.assertEqual(self.failures, [])
+        # a worker serves 3 requests at most
+        self.assertGreaterEqual(len(set(pids)), 7)
+
+    def tearDown(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            self.process.stdout.close()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from time import perf_counter
+from unittest.mock import MagicMock
+
+from tests.utils import cases
+from traffic import Replayer, TrafficCapture, read_capture
+
+
+class TestTrafficCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'capture.log')
+
+    def test_record_and_read(self):
+        capture = TrafficCapture(self.path)
+        capture.record(1000.5, 'method', '{"a": 1}', 200, 0.002,
+                       {'X-Request-Timeout': '0.5', 'Host': 'localhost'})
+        capture.record(1000.0, 'method', '{"a": 2}', 422, 0.001)
+        capture.close()
+        # the file is only appended to
+        capture = TrafficCapture(self.path)
+        capture.record(1001.0, 'method', '{"a": 3}', 200, 0.001)
+        capture.close()
+        records = read_capture(self.path)
+        self.assertEqual([record['b'] for record in records],
+                         ['{"a": 2}', '{"a": 1}', '{"a": 3}'])
+        self.assertEqual(records[1], {
+            't': 1000.5, 'p': 'method', 'c': 200, 'l': 2.0,
+            'b': '{"a": 1}', 'h': {'X-Request-Timeout': '0.5'}
+        })
+
+    def test_broken_line_skipped(self):
+        with open(self.path, 'w') as capture:
+            capture.write('{"t": 1, "p": "method", "c": 200, "l": 1, '
+                          '"b": "{}"}\n{"t": 2, "p": "met')
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(len(read_capture(self.path)), 1)
+
+    def test_sampling(self):
+        capture = TrafficCapture(self.path, sample_rate=0.1, seed=0)
+        sampled = sum(capture.sampled() for _ in range(10000))
+        capture.close()
+        self.assertTrue(800 < sampled < 1200)
+        with self.assertRaises(ValueError):
+            TrafficCapture(self.path, sample_rate=0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class TestReplayer(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [
+            {'t': 100.0 + i * 0.05, 'p': 'method', 'c': 200, 'l': 1.0,
+             'b': '{}'}
+            for i in range(5)
+        ]
+
+    def test_compare(self):
+        replayer = Replayer('http://localhost:0', self.records, speed=0)
+        codes = iter([200, 200, 503, 200, 503])
+        replayer.send = MagicMock(side_effect=lambda record: next(codes))
+        report = replayer.run()
+        self.assertEqual(report['requests'], 5)
+        self.assertEqual(report['codes_changed'], 2)
+        self.assertEqual(report['code_changes'], {'200->503': 2})
+        self.assertEqual(report['latency_ms']['p50']['captured'], 1.0)
+
+    @cases([(1, 0.2), (2, 0.1)])
+    def test_speed_keeps_inter_arrival(self, speed, span):
+        sent = []
+        replayer = Replayer('http://localhost:0', self.records, speed=speed)
+        replayer.send = MagicMock(
+            side_effect=lambda record: sent.append(perf_counter()) or 200
+        )
+        replayer.run()
+        # 4 gaps of 50 ms captured
+        self.assertAlmostEqual(max(sent) - min(sent), span, delta=0.03)
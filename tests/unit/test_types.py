@@ -1,8 +1,10 @@
 import unittest
+from unittest.mock import patch
 
 from thetypes import (Field, CharField, ArgumentsField, EmailField,
                       MethodRequest, PhoneField, DateField, BirthDayField,
-                      GenderField, ClientIDsField, FieldError, Request)
+                      GenderField, ClientIDsField, FieldError, Request,
+                      OnlineScoreBatchRequest)
 from const import ADMIN_LOGIN
 from tests.utils import cases
 
@@ -263,6 +265,17 @@ class TestRequest(unittest.TestCase):
             # should be no errors, just None in all the Fields
             self.assertEqual(getattr(r, f), None)
 
+    def test_slotted_instance(self):
+        r = Req(self.valid_dct)
+        self.assertFalse(hasattr(r, '__dict__'))
+        with self.assertRaises(AttributeError):
+            r.spam = 'eggs'
+
+    def test_not_validated_field(self):
+        r = Simple(dict(), validate=False)
+        with self.assertRaises(AttributeError):
+            r.field1
+
     def test_demanding_with_random_dict(self):
         dct = dict(nobody_expects=' ===> Spanish Inquisition')
         with self.assertRaises(FieldError):
@@ -304,3 +317,31 @@ class TestMethodRequest(unittest.TestCase):
         )
         r = MethodRequest(dct)
         self.assertTrue(r.is_admin)
+
+
+class TestOnlineScoreBatchRequest(unittest.TestCase):
+
+    def test_distinct_values_validated_once(self):
+        clients = [{'birthday': '01.01.1990', 'phone': 79175002040},
+                   {'birthday': '01.01.1990', 'phone': '79175002040'},
+                   {'birthday': '02.01.1990', 'phone': 79175002040}]
+        with patch.object(DateField, 'parse', autospec=True,
+                          side_effect=DateField.parse) as parse:
+            columns = OnlineScoreBatchRequest({'clients': clients}).columns()
+        self.assertEqual(parse.call_count, 2)
+        self.assertEqual(columns['birthday'],
+                         ['01.01.1990', '01.01.1990', '02.01.1990'])
+        self.assertEqual(columns['phone'], ['79175002040'] * 3)
+        self.assertEqual(columns['gender'], [None] * 3)
+
+    @cases([
+        ([{'gender': 1}, {'gender': 1}, {'gender': '1'}], 'Client 2'),
+        ([{'gender': 1}, {'first_name': ['a']}], 'Client 1'),
+    ])
+    def test_bad_client(self, clients, message):
+        """
+        The first bad value is reported, hashable or not
+        """
+        request = OnlineScoreBatchRequest({'clients': clients})
+        with self.assertRaisesRegex(FieldError, message):
+            request.columns()
@@ -1,3 +1,4 @@
+import json
 import re
 from abc import ABC, abstractmethod
 from datetime import datetime
@@ -10,6 +11,10 @@ class FieldError(Exception):
     pass
 
 
+# value of a field not validated yet
+_MISSING = object()
+
+
 class Validator(ABC):
     """
     Data-descriptor and base class for field descriptors.
@@ -18,15 +23,35 @@ class Validator(ABC):
         self.name = name
         self.private_name = '_' + name
 
+    # position in Request._values, set by RequestMeta
+    index = None
+
     def __get__(self, obj, objtype=None):
         if obj is None:
             # instance attribute accessed on class
             return self
-        return getattr(obj, self.private_name)
+        if self.index is None:
+            return getattr(obj, self.private_name)
+        value = obj._values[self.index]
+        if value is _MISSING:
+            raise AttributeError(f'Field {self.name} is not validated yet')
+        return value
 
     def __set__(self, obj, value):
         self.validate(value)
-        setattr(obj, self.private_name, value)
+        self.store(obj, self.clean(value))
+
+    def clean(self, value):
+        """
+        Normalize a validated value before it is stored.
+        """
+        return value
+
+    def store(self, obj, value):
+        if self.index is None:
+            setattr(obj, self.private_name, value)
+        else:
+            obj._values[self.index] = value
 
     @abstractmethod
     def validate(self, value):
@@ -94,12 +119,8 @@ class PhoneField(Field):
                 f'Bad phone number in field {self.name} ({value!r} not valid)'
             )
 
-    def __set__(self, obj, value):
-        self.validate(value)
-        if value:
-            setattr(obj, self.private_name, str(value))
-        else:
-            setattr(obj, self.private_name, value)
+    def clean(self, value):
+        return str(value) if value else value
 
 
 class DateField(CharField):
@@ -109,8 +130,11 @@ class DateField(CharField):
         super().validate(value)
         if value is None:
             return
+        self.parse(value)
+
+    def parse(self, value: str) -> datetime:
         try:
-            datetime.strptime(value, DateField.format)
+            return datetime.strptime(value, DateField.format)
         except ValueError:
             raise FieldError(
                 f'Bad date format in field {self.name} ({value!r} not valid)'
@@ -120,10 +144,11 @@ class DateField(CharField):
 class BirthDayField(DateField):
 
     def validate(self, value):
-        super().validate(value)
+        # the date is parsed once, not by DateField.validate too
+        CharField.validate(self, value)
         if value is None:
             return
-        date = datetime.strptime(value, DateField.format)
+        date = self.parse(value)
         delta = datetime.today() - date
         if delta.days > 365*70:
             raise FieldError(
@@ -146,24 +171,128 @@ class GenderField(Field):
             )
 
 
+class ClientIDStream:
+    """
+    client_ids array left undecoded in the request text:
+    <text>[<start>:<end>] is the array. Ids are decoded and checked
+    a chunk of a few hundred at a time while iterated, so a bad element
+    stops the request before the rest of the array is read.
+    See jsonstream.loads_request.
+    """
+    __slots__ = ('text', 'start', 'end')
+
+    # characters decoded at a time
+    chunk_size = 4096
+
+    def __init__(self, text: str, start: int, end: int):
+        self.text = text
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        """
+        Ids in request order. FieldError is raised at the first element
+        that is not an integer, ValueError if the array is malformed.
+        """
+        text, close = self.text, self.end - 1
+        pos, index, stop = self.start + 1, 0, None
+        while stop != close:
+            # the array holds no strings, so any comma splits elements
+            stop = text.find(',', pos + self.chunk_size, close)
+            if stop == -1:
+                stop = close
+            try:
+                values = json.loads('[%s]' % text[pos:stop])
+            except ValueError as exc:
+                raise ValueError(f'Malformed client_ids array near char '
+                                 f'{pos + exc.pos - 1}')
+            if not values:
+                raise ValueError(f'Missing client_ids element at char {pos}')
+            for value in values:
+                if not isinstance(value, int):
+                    raise FieldError(
+                        f'Bad value for client_ids field (element {index}: '
+                        f'{value!r}). Should be a list-like object of '
+                        'integers'
+                    )
+                yield value
+                index += 1
+            pos = stop + 1
+
+    def batches(self, size: int, known=()):
+        """
+        Unique ids missing in <known> (ids of the batches already
+        handled), in lists of up to <size>, each one yielded as soon as
+        it is decoded.
+        """
+        batch = {}
+        for cid in self:
+            if cid not in batch and cid not in known:
+                batch[cid] = None
+                if len(batch) == size:
+                    yield list(batch)
+                    batch = {}
+        if batch:
+            yield list(batch)
+
+
 class ClientIDsField(Field):
 
     def validate(self, value):
         super().validate(value)
-        if value is None:
+        if value is None or isinstance(value, ClientIDStream):
+            # a stream is validated while it is read
             return
         err_message = (f'Bad value for {self.name} field ({value!r}). '
                        'Should be a list-like object of integers')
         if not isinstance(value, list):
             raise FieldError(err_message)
-        if not all(
-            [True if isinstance(el, int) else False
-             for el in value]
-        ):
+        if not all(isinstance(el, int) for el in value):
             raise FieldError(err_message)
 
 
-class Request:
+class RequestMeta(type):
+    """
+    Builds slotted request classes from Field declarations.
+    Field values are kept in a list (<_values> slot), each Field gets
+    its position in it, so request instances have no __dict__.
+    """
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        cls = super().__new__(mcs, name, bases, namespace)
+        inherited = [
+            field for base in reversed(cls.__mro__[1:])
+            for field in vars(base).values() if isinstance(field, Field)
+        ]
+        own = [field for field in namespace.values()
+               if isinstance(field, Field)]
+        for index, field in enumerate(own, start=len(inherited)):
+            field.index = index
+        cls._size = len(inherited) + len(own)
+        # validation order is alphabetical, the way dir() lists fields
+        cls._fields = tuple(sorted(
+            key for key in dir(cls)
+            if isinstance(getattr(cls, key), Field)
+        ))
+        return cls
+
+
+class ClientsField(Field):
+
+    def validate(self, value):
+        super().validate(value)
+        if value is None:
+            return
+        if (not isinstance(value, list)
+                or not all(isinstance(el, dict) for el in value)):
+            raise FieldError(
+                f'Bad value for {self.name} field. '
+                'Should be a list of dict-like objects'
+            )
+
+
+class Request(metaclass=RequestMeta):
+    __slots__ = ('_values', '_dct', '_default')
 
     def __init__(self, dct: dict,
                  validate: bool = True,
@@ -181,25 +310,19 @@ class Request:
         Warning: change default value (self.default) only if all the Fields in
         request accespt that value. Beware of FieldError.
         """
-        self._attrs = [
-            key for key in dir(self)
-            if isinstance(
-                getattr(type(self), key),  # returns the descriptor
-                Field
-            )
-        ]
+        self._values = [_MISSING] * self._size
         self._dct = dct
         self._default = default
         if validate:
             self.validate()
 
     def validate(self):
-        for attr in self._attrs:
+        for attr in self._fields:
             setattr(self, attr, self._dct.get(attr, self._default))
 
     @property
     def fields(self) -> list:
-        return self._attrs
+        return list(self._fields)
 
 
 class ClientsInterestsRequest(Request):
@@ -226,3 +349,42 @@ class MethodRequest(Request):
     @property
     def is_admin(self):
         return self.login == ADMIN_LOGIN
+
+
+class OnlineScoreBatchRequest(Request):
+    clients = ClientsField(required=True, nullable=False)
+
+    def columns(self, request_class=OnlineScoreRequest) -> dict:
+        """
+        Validate client records column by column against the fields of
+        <request_class>. Returns {field name: list of cleaned values}.
+        A value repeated in a column is validated and cleaned once.
+        """
+        columns = {}
+        for name in request_class._fields:
+            field = getattr(request_class, name)
+            # (type, value) -> cleaned value; the type keeps 1 and True
+            # apart, they may not pass the same validation
+            cleaned = {}
+            column = []
+            for i, client in enumerate(self.clients):
+                value = client.get(name)
+                key = (type(value), value)
+                try:
+                    known = cleaned.get(key, _MISSING)
+                except TypeError:
+                    # unhashable values are validated every time
+                    known = key = _MISSING
+                if known is not _MISSING:
+                    column.append(known)
+                    continue
+                try:
+                    field.validate(value)
+                except FieldError as exc:
+                    raise FieldError(f'Client {i}: {exc}')
+                value = field.clean(value)
+                column.append(value)
+                if key is not _MISSING:
+                    cleaned[key] = value
+            columns[name] = column
+        return columns
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+'''
+Traffic capture and replay.
+
+The API server started with --capture writes a sample of POST requests
+to an append-only file, one JSON record per line:
+{"t": <unix time>, "p": <path>, "c": <code>, "l": <latency, ms>,
+ "b": <raw body>, "h": {<header>: <value>}}
+Capture files hold raw request bodies (tokens, personal data): keep them
+private.
+
+Usage:
+$ python3 traffic.py <capture file>
+                     [-t, --target (default: http://localhost:8080)]
+                     [-s, --speed (default: 1, N times faster, or max)]
+
+Requests are re-sent with the captured inter-arrival times divided by
+<speed>, and response codes and latencies are compared to the capture.
+'''
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# request headers changing the server behaviour, captured with the body
+CAPTURED_HEADERS = ("X-Request-Timeout",)
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Nearest-rank percentile of sorted <values> (p in 0..100).
+    """
+    if not values:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class TrafficCapture:
+    """
+    Append sampled requests to <path>: a share of <sample_rate>
+    of all requests is written. Each record is written with a single
+    write() to a file opened in append mode, so prefork workers can
+    share the file.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0,
+                 seed: int or None = None):
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f'Sample rate should be in (0, 1], '
+                             f'got {sample_rate}')
+        self.path = path
+        self.sample_rate = sample_rate
+        self.rnd = random.Random(seed)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o600)
+        self.captured = 0
+        self._lock = threading.Lock()
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1 or self.rnd.random() < self.sample_rate
+
+    def record(self, timestamp: float, path: str, body: str, code: int,
+               latency: float, headers=None):
+        """
+        Write a request received at <timestamp> and answered with <code>
+        in <latency> seconds.
+        """
+        record = {"t": round(timestamp, 6), "p": path, "c": code,
+                  "l": round(latency * 1000, 3),
+                  "b": body}
+        captured = {name: headers[name] for name in CAPTURED_HEADERS
+                    if headers is not None and name in headers}
+        if captured:
+            record["h"] = captured
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            os.write(self.fd, line.encode('utf-8'))
+            self.captured += 1
+
+    def close(self):
+        os.close(self.fd)
+
+
+def read_capture(path: str) -> list:
+    """
+    Records of a capture file ordered by time. A line cut short by
+    a crash is skipped.
+    """
+    records = []
+    with open(path, encoding='utf-8') as capture:
+        for line in capture:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.warning('Skipping broken capture line: %r' % line)
+    records.sort(key=lambda record: record["t"])
+    return records
+
+
+class Replayer:
+    """
+    Re-send captured <records> to <target> (base URL of the server),
+    <speed> times faster than captured; speed 0 sends them as fast
+    as possible.
+    """
+
+    def __init__(self, target: str, records: list, speed: float = 1.0,
+                 max_workers: int = 256):
+        self.target = target.rstrip('/')
+        self.records = records
+        self.speed = speed
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.results = []
+        self._lock = threading.Lock()
+
+    def send(self, record: dict) -> int:
+        http_request = urllib.request.Request(
+            "%s/%s/" % (self.target, record["p"]),
+            data=record["b"].encode('utf-8'),
+            headers=dict(record.get("h", {}),
+                         **{"Content-Type": "application/json"})
+        )
+        try:
+            with urllib.request.urlopen(http_request, timeout=30) as answer:
+                answer.read()
+                return answer.status
+        except urllib.error.HTTPError as exc:
+            return exc.code
+        except OSError:
+            return 0  # connection failure
+
+    def call(self, record: dict, scheduled: float):
+        code = self.send(record)
+        latency = time.perf_counter() - scheduled
+        with self._lock:
+            self.results.append((record, code, latency))
+
+    def run(self) -> dict:
+        """
+        Replay keeping the captured inter-arrival pattern (open loop,
+        latency is measured from the scheduled time) and compare.
+        """
+        if not self.records:
+            return self.report(0.0)
+        first = self.records[0]["t"]
+        start = time.perf_counter()
+        for record in self.records:
+            if self.speed:
+                scheduled = start + (record["t"] - first) / self.speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+            self.executor.submit(self.call, record, scheduled)
+        self.executor.shutdown(wait=True)
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed: float) -> dict:
+        changed = {}
+        for record, code, _ in self.results:
+            if code != record["c"]:
+                transition = "%s->%s" % (record["c"], code)
+                changed[transition] = changed.get(transition, 0) + 1
+        captured = sorted(record["l"] for record, _, _ in self.results)
+        replayed = sorted(latency * 1000 for _, _, latency in self.results)
+        count = len(self.results)
+        return {
+            "requests": count,
+            "throughput": count / elapsed if elapsed else 0.0,
+            "codes_changed": sum(changed.values()),
+            "code_changes": changed,
+            "latency_ms": {
+                name: {"captured": percentile(captured, p),
+                       "replayed": percentile(replayed, p)}
+                for name, p in (("p50", 50), ("p90", 90), ("p99", 99),
+                                ("p999", 99.9))
+            },
+        }
+
+
+if __name__ == "__main__":
+    argpars = argparse.ArgumentParser()
+    argpars.add_argument('capture')
+    argpars.add_argument('-t', '--target', default='http://localhost:8080')
+    argpars.add_argument('-s', '--speed', default='1',
+                         help='replay N times faster, "max" for no pauses')
+    args = argpars.parse_args()
+    speed = 0 if args.speed == 'max' else float(args.speed)
+    replayer = Replayer(args.target, read_capture(args.capture), speed)
+    print(json.dumps(replayer.run(), indent=2))